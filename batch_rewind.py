@@ -0,0 +1,252 @@
+"""
+(c) 2024 CyberCX
+
+Batch mode, rewinds many volumes (MFT and USN pairs) in one run. The
+volumes are listed in a manifest csv, or found in the sub folders of an
+input folder. Each volume is a job for rewind(), the jobs run in a
+process pool. How many run at once is limited by the number of jobs
+and by a memory limit, using an estimate of each job's peak memory
+from the size of its input files, so that large volumes do not run the
+host out of memory. The largest jobs are started first.
+
+Each volume gets its own output folder (named after the volume) with
+the usual output, the console output of its run (rewind.log) and its
+run metrics (metrics.json). A summary of all jobs, with their times, is
+printed and saved as batch_summary.json in the output folder.
+
+License : MIT
+
+"""
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import traceback
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from metrics import format_duration
+from mft_parser import is_raw_mft
+
+MANIFEST_FIELDS = ('name', 'mft', 'usn') # required columns, an 'output' column is optional
+SUMMARY_FILE_NAME = 'batch_summary.json'
+JOB_LOG_FILE_NAME = 'rewind.log'
+JOB_METRICS_FILE_NAME = 'metrics.json'
+
+# Peak memory estimate of a job (see estimate_memory_mb), measured on MFTECmd
+# csv files with 1 worker. The parent lookup takes about 3.5 times the size of
+# the MFT csv, a raw $MFT is about 8 times the size of its csv.
+BASE_MEMORY_MB = 64
+MFT_CSV_FACTOR = 3.5
+MFT_RAW_FACTOR = 0.5
+USN_FACTOR = 3.5
+
+class BatchJob:
+    '''One volume to rewind, output goes in output_path'''
+    def __init__(self, name, mft_path, usn_path, output_path=''):
+        self.name = name
+        self.mft_path = mft_path
+        self.usn_path = usn_path
+        self.output_path = output_path
+        self.estimated_mb = 0
+
+def safe_name(name):
+    '''name with characters that are not valid in a folder name replaced by _'''
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', name).strip(' .') or 'volume'
+
+def read_manifest(manifest_path):
+    '''
+        Returns a list of BatchJob from the csv at manifest_path, which
+        has the columns name, mft and usn (and optionally output). Relative
+        paths are taken from the folder of the manifest. Raises ValueError
+        if a column is missing.
+    '''
+    base_folder = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    with open(manifest_path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        missing = [ field for field in MANIFEST_FIELDS if field not in (reader.fieldnames or []) ]
+        if missing:
+            raise ValueError(f'Manifest {manifest_path} is missing the column(s) {", ".join(missing)}')
+        for row in reader:
+            if not row['name'] and not row['mft']:
+                continue # empty line
+            output_path = row.get('output') or ''
+            jobs.append(BatchJob(row['name'] or os.path.basename(row['mft']),
+                                 os.path.join(base_folder, row['mft']),
+                                 os.path.join(base_folder, row['usn']),
+                                 os.path.join(base_folder, output_path) if output_path else ''))
+    return jobs
+
+def is_mft_file_name(name):
+    name = name.lower()
+    return '$mft' in name and '$mftmirr' not in name
+
+def is_usn_file_name(name):
+    name = name.lower()
+    return '$j' in name and not name.endswith('.fullpaths.csv')
+
+def find_volumes(input_folder):
+    '''
+        Returns a list of BatchJob, one for each folder under input_folder
+        that has one MFT file (name has $MFT, eg. MFTECmd's *_$MFT_Output.csv
+        or a raw $MFT) and one USN file (name has $J). The job is named after
+        the folder's path relative to input_folder. Folders with more than
+        one of either are reported and skipped, list those in a manifest.
+    '''
+    jobs = []
+    for folder, sub_folders, file_names in os.walk(input_folder):
+        sub_folders.sort()
+        mft_names = [ name for name in file_names if is_mft_file_name(name) ]
+        usn_names = [ name for name in file_names if is_usn_file_name(name) ]
+        if not mft_names and not usn_names:
+            continue
+        if len(mft_names) != 1 or len(usn_names) != 1:
+            print(f'[!] Skipping {folder}, it has {len(mft_names)} MFT and {len(usn_names)} USN files, '
+                   'expected one of each (use a manifest instead)')
+            continue
+        name = os.path.relpath(folder, input_folder)
+        if name == '.':
+            name = os.path.basename(os.path.abspath(input_folder))
+        jobs.append(BatchJob(name.replace(os.sep, '_'), os.path.join(folder, mft_names[0]),
+                             os.path.join(folder, usn_names[0])))
+    return jobs
+
+def estimate_memory_mb(mft_path, usn_path, num_workers=1, no_db=False, memory_budget_mb=512, lookup_memory_mb=0):
+    '''
+        Rough peak memory (MB) of rewinding these files. The parent lookup
+        (from the MFT) is held by every worker of a sharded rewind, or takes
+        lookup_memory_mb (without shards) if it is kept on disk. The USN
+        data is sorted in memory_budget_mb in --no_db mode.
+    '''
+    mft_mb = os.path.getsize(mft_path) / (1024 * 1024)
+    usn_mb = os.path.getsize(usn_path) / (1024 * 1024)
+    lookup_mb = mft_mb * (MFT_RAW_FACTOR if is_raw_mft(mft_path) else MFT_CSV_FACTOR)
+    if lookup_memory_mb:
+        lookup_mb = min(lookup_mb, lookup_memory_mb)
+        num_workers = 1
+    journal_mb = usn_mb * USN_FACTOR
+    if no_db:
+        journal_mb = min(journal_mb, memory_budget_mb)
+    return int(BASE_MEMORY_MB + lookup_mb * max(1, num_workers) + journal_mb)
+
+def total_memory_mb():
+    '''Physical memory (MB) of the host, None if not known'''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError): # Windows
+        return None
+
+def run_job(rewind_function, job, options):
+    '''
+        Runs rewind_function (ie. rewind()) for job in a worker process, with
+        its console output going to rewind.log in the job's output folder.
+        Returns a dict for the batch summary, with the run metrics if it
+        succeeded.
+    '''
+    os.makedirs(job.output_path, exist_ok=True)
+    metrics_json_path = os.path.join(job.output_path, JOB_METRICS_FILE_NAME)
+    result = { 'name' : job.name, 'mft' : job.mft_path, 'usn' : job.usn_path, 'output_path' : job.output_path,
+               'estimated_mb' : job.estimated_mb, 'status' : 'failed', 'error' : '' }
+    try:
+        # Of an earlier run, it must not be taken for this one's
+        if os.path.exists(metrics_json_path):
+            os.remove(metrics_json_path)
+    except OSError as ex:
+        result['error'] = f'Failed to remove the metrics of an earlier run: {ex}'
+        return result
+    start_time = time.perf_counter()
+    with open(os.path.join(job.output_path, JOB_LOG_FILE_NAME), 'w', encoding='utf8') as log:
+        # The stdout file descriptor too, for the processes the rewind starts
+        sys.stdout.flush()
+        saved_stdout_fd = os.dup(1)
+        os.dup2(log.fileno(), 1)
+        try:
+            with contextlib.redirect_stdout(log):
+                if rewind_function(job.output_path, job.mft_path, job.usn_path,
+                                   metrics_json_path=metrics_json_path, **options):
+                    result['status'] = 'ok'
+        except Exception as ex: # one bad volume should not stop the batch
+            traceback.print_exc(file=log)
+            result['error'] = f'{type(ex).__name__}: {ex}'
+        finally:
+            log.flush()
+            os.dup2(saved_stdout_fd, 1)
+            os.close(saved_stdout_fd)
+    result['seconds'] = round(time.perf_counter() - start_time, 3)
+    if result['status'] != 'ok':
+        return result
+    try:
+        with open(metrics_json_path, 'r', encoding='utf8') as f:
+            metrics = json.load(f)
+        result['peak_rss_mb'] = metrics.get('peak_rss_mb')
+        result['phases'] = { phase['name'] : phase['seconds'] for phase in metrics.get('phases', []) }
+        result['rows'] = next((phase['rows'] for phase in metrics.get('phases', []) if phase['name'] == 'rewind'), None)
+        result['unknown_paths'] = metrics.get('unknown_paths', {}).get('rows')
+    except (OSError, ValueError):
+        pass
+    return result
+
+def run_batch(jobs, rewind_function, options, max_jobs, memory_limit_mb):
+    '''
+        Runs rewind_function for each job (with job.estimated_mb set) in a
+        process pool of max_jobs, largest first. A job is only started if
+        the estimates of the running jobs and it fit in memory_limit_mb (a
+        job larger than the limit runs on its own). options are passed on
+        to rewind_function. Returns the list of job results, in the order
+        of jobs.
+    '''
+    waiting = sorted(jobs, key=lambda job: job.estimated_mb, reverse=True)
+    running = {} # { future : job }
+    results = {} # { job name : result }
+    used_mb = 0
+    pool_args = {}
+    if sys.version_info >= (3, 11):
+        # A new process for each job, so memory is given back and peak_rss_mb is of that job alone
+        pool_args = { 'max_tasks_per_child' : 1, 'mp_context' : multiprocessing.get_context('spawn') }
+    with ProcessPoolExecutor(max_workers=max_jobs, **pool_args) as executor:
+        while waiting or running:
+            for job in list(waiting):
+                if len(running) >= max_jobs:
+                    break
+                if running and used_mb + job.estimated_mb > memory_limit_mb:
+                    continue # try a smaller job
+                waiting.remove(job)
+                if job.estimated_mb > memory_limit_mb:
+                    print(f'[!] {job.name} needs about {job.estimated_mb} MB, more than the limit, running it alone')
+                print(f'[.] Started {job.name} (about {job.estimated_mb} MB)', flush=True)
+                running[executor.submit(run_job, rewind_function, job, options)] = job
+                used_mb += job.estimated_mb
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                used_mb -= job.estimated_mb
+                try:
+                    result = future.result()
+                except Exception as ex: # eg. the worker process was killed
+                    result = { 'name' : job.name, 'mft' : job.mft_path, 'usn' : job.usn_path,
+                               'output_path' : job.output_path, 'estimated_mb' : job.estimated_mb,
+                               'status' : 'failed', 'error' : f'{type(ex).__name__}: {ex}' }
+                results[job.name] = result
+                print(f'[.] Finished {job.name}: {result["status"]} in {format_duration(result.get("seconds", 0))}, '
+                      f'{len(results)} of {len(jobs)} done', flush=True)
+    return [ results[job.name] for job in jobs ]
+
+def print_batch_summary(results):
+    print('[.] Batch summary:')
+    for result in results:
+        text = f'[.]   {result["name"]:<30} {result["status"]:<6} {format_duration(result.get("seconds", 0))}'
+        if result.get('rows') is not None:
+            text += f', {result["rows"]} rows'
+        if result.get('peak_rss_mb') is not None:
+            text += f', peak {result["peak_rss_mb"]} MB (estimate {result["estimated_mb"]} MB)'
+        if result['error']:
+            text += f', {result["error"]}'
+        print(text)
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    if failed:
+        print(f'[!] {failed} of {len(results)} volumes failed, see {JOB_LOG_FILE_NAME} in their output folders')
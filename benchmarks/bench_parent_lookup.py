@@ -0,0 +1,182 @@
+"""
+(c) 2024 CyberCX
+
+Benchmark of the MFT parent lookup construction. Compares the original
+three-way UNION ALL self-join of the MFT table against the single pass
+over the MFT rows done by path_resolver.build_parent_lookup, then
+resolves the full path of every entry. Each step is timed, then run again
+under tracemalloc for the memory it takes: the peak while building and
+what the lookup holds after, and the (bounded) path cache filled by the
+resolving.
+
+Usage:
+    python3 benchmarks/bench_parent_lookup.py -n 1000000
+    python3 benchmarks/bench_parent_lookup.py -m mft_from_mftecmd.csv
+    python3 benchmarks/bench_parent_lookup.py -n 1200000 -c 16 -s
+
+License : MIT
+
+"""
+import argparse
+import csv
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csv_to_sqlite import import_csv
+from path_resolver import DEFAULT_CACHE_BYTES, ParentLookup, build_parent_lookup, make_key, mft_records
+
+# The query used by create_journal_rewind_csv up to v0.6.1
+LEGACY_QUERY = '''
+    SELECT m1.EntryNumber || '-' || m1.SequenceNumber as Entry, m1.FileName,
+    m1.ParentEntryNumber || '-' || m1.ParentSequenceNumber as ParentEntry, 
+    ifnull(m2.FileName, '') as ParentName
+    FROM MFT m1 LEFT JOIN MFT m2 
+    ON m1.ParentEntryNumber = m2.EntryNumber AND m1.ParentSequenceNumber = m2.SequenceNumber 
+    WHERE m1.InUse = "True"
+    UNION ALL
+    SELECT m1.EntryNumber || '-' || (m1.SequenceNumber - 1) as Entry, m1.FileName,
+    m1.ParentEntryNumber || '-' || m1.ParentSequenceNumber as ParentEntry, 
+    ifnull(m2.FileName, '') as ParentName
+    FROM MFT m1 LEFT JOIN MFT m2 
+    ON m1.ParentEntryNumber = m2.EntryNumber AND m1.ParentSequenceNumber = m2.SequenceNumber 
+    WHERE m1.InUse = "False" and m2.Inuse = "True"
+    UNION ALL
+    SELECT m1.EntryNumber || '-' || (m1.SequenceNumber - 1) as Entry, m1.FileName,
+    m1.ParentEntryNumber || '-' || m1.ParentSequenceNumber as ParentEntry, 
+    ifnull(m2.FileName, '') as ParentName
+    FROM MFT m1 LEFT JOIN MFT m2 
+    ON m1.ParentEntryNumber = m2.EntryNumber AND m1.ParentSequenceNumber = (m2.SequenceNumber  - 1)
+    WHERE m1.InUse = "False"  and m2.Inuse = "False"
+'''
+
+SINGLE_PASS_QUERY = '''
+    SELECT EntryNumber, SequenceNumber, InUse, ParentEntryNumber, 
+    ParentSequenceNumber, FileName
+    FROM MFT
+'''
+
+def write_synthetic_mft_csv(path, num_entries, seed=1):
+    '''Writes a minimal MFTECmd style $MFT csv with num_entries rows'''
+    rnd = random.Random(seed)
+    # MFTECmd writes ~35 columns, most of them timestamps, pad rows similarly
+    # so the table is as wide as a real one.
+    timestamps = ('Created0x10', 'Created0x30', 'LastModified0x10', 'LastModified0x30', 
+                  'LastRecordChange0x10', 'LastRecordChange0x30', 'LastAccess0x10', 'LastAccess0x30')
+    padding = ('2023-05-01 10:11:12.1234567',) * len(timestamps)
+    folders = [(5, 5, True)]
+    with open(path, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('EntryNumber', 'SequenceNumber', 'InUse', 'ParentEntryNumber', 
+                         'ParentSequenceNumber', 'FileName', 'IsDirectory') + timestamps)
+        writer.writerow((5, 5, 'True', 5, 5, '.', 'True') + padding)
+        for entry_num in range(16, num_entries + 16):
+            seq_num = rnd.randint(1, 20)
+            in_use = rnd.random() > 0.1
+            parent_entry_num, parent_seq_num, parent_in_use = rnd.choice(folders[-500:])
+            if not parent_in_use:
+                parent_seq_num -= 1
+            is_dir = rnd.random() < 0.15
+            name = f'folder{entry_num}' if is_dir else f'file{entry_num}.txt'
+            writer.writerow((entry_num, seq_num, str(in_use), parent_entry_num, parent_seq_num, name, str(is_dir)) + padding)
+            if rnd.random() < 0.01:
+                writer.writerow((entry_num, seq_num, str(in_use), parent_entry_num, parent_seq_num, 
+                                 name + ':Zone.Identifier', str(is_dir)) + padding)
+            if is_dir:
+                folders.append((entry_num, seq_num, in_use))
+
+def legacy_lookup(db):
+    lookup = {}
+    for entry, file_name, parent_entry, parent_name in db.execute(LEGACY_QUERY):
+        if ':' in file_name:
+            continue
+        lookup[entry] = (file_name, parent_entry, parent_name)
+    return lookup
+
+def str_to_key(entry):
+    '''Converts an 'Entry-Seq' key of the legacy query to a make_key() key'''
+    entry_num, seq_num = entry.split('-', 1)
+    return make_key(int(entry_num), int(seq_num))
+
+def single_pass_lookup(db, max_cache_bytes=DEFAULT_CACHE_BYTES):
+    return build_parent_lookup(mft_records(db.execute(SINGLE_PASS_QUERY)), ParentLookup(max_cache_bytes))
+
+def resolve_all(lookup):
+    '''Resolves the full path of every entry, filling the path cache'''
+    for entry in lookup: # full_path() does not change the lookup, only its cache
+        lookup.full_path(entry)
+
+def time_it(func, *args):
+    start_time = time.perf_counter()
+    ret = func(*args)
+    return ret, time.perf_counter() - start_time
+
+def trace_memory(func, *args):
+    '''Returns func(*args) and the memory (MB) it allocated that is still held, and its peak'''
+    tracemalloc.start()
+    try:
+        ret = func(*args)
+        held, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return ret, held / (1024 * 1024), peak / (1024 * 1024)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MFT parent lookup construction')
+    parser.add_argument('-n', '--num_entries', type=int, default=1000000, help='Synthetic MFT entries (default 1000000)')
+    parser.add_argument('-m', '--mft_csv', help='Use this MFTECmd $MFT csv instead of synthetic data')
+    parser.add_argument('-s', '--skip_legacy', action='store_true', help='Only time the single pass build')
+    parser.add_argument('-c', '--cache_mb', type=int, default=DEFAULT_CACHE_BYTES // (1024 * 1024),
+                        help=f'Path cache limit in MB (default {DEFAULT_CACHE_BYTES // (1024 * 1024)})')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        mft_csv_path = args.mft_csv
+        if not mft_csv_path:
+            mft_csv_path = os.path.join(temp_folder, 'mft.csv')
+            print(f'[.] Writing {args.num_entries} synthetic MFT rows')
+            write_synthetic_mft_csv(mft_csv_path, args.num_entries)
+        db_path = os.path.join(temp_folder, 'bench.sqlite')
+        import_csv(mft_csv_path, db_path, 'MFT', guess_column_types=True)
+
+        db = sqlite3.connect(db_path)
+        # Same fix create_journal_rewind_csv applies before building the lookup
+        db.execute('UPDATE MFT SET ParentSequenceNumber=ParentSequenceNumber&65535 where ParentSequenceNumber < 0')
+        db.commit()
+        cache_bytes = args.cache_mb * 1024 * 1024
+        new_lookup, new_time = time_it(single_pass_lookup, db, cache_bytes)
+        print(f'[.] Single pass build    : {new_time:8.2f} s  ({len(new_lookup)} entries)')
+        _, resolve_time = time_it(resolve_all, new_lookup)
+        print(f'[.] Resolve all paths    : {resolve_time:8.2f} s  ({len(new_lookup._path_cache)} paths cached, '
+              f'~{new_lookup._cache_bytes / (1024 * 1024):.1f} MB by its estimate)')
+        new_lookup = None
+
+        # Again with tracemalloc, which slows them down
+        new_lookup, held, peak = trace_memory(single_pass_lookup, db, cache_bytes)
+        print(f'[.] Single pass memory   : {peak:8.1f} MB peak, {held:.1f} MB held after')
+        _, held, peak = trace_memory(resolve_all, new_lookup)
+        print(f'[.] Path cache memory    : {peak:8.1f} MB peak, {held:.1f} MB held after (limit {args.cache_mb} MB)')
+        if not args.skip_legacy:
+            old_lookup, old_time = time_it(legacy_lookup, db)
+            print(f'[.] Legacy self-join     : {old_time:8.2f} s  ({len(old_lookup)} entries)')
+            print(f'[.] Speedup              : {old_time / max(new_time, 1e-9):8.1f} x')
+            old_lookup = None
+            old_lookup, held, peak = trace_memory(legacy_lookup, db)
+            print(f'[.] Legacy memory        : {peak:8.1f} MB peak, {held:.1f} MB held after')
+            # ParentName may legitimately differ where the legacy join picked an ADS row
+            old_lookup = { str_to_key(entry) : (file_name, str_to_key(parent_entry))
+                           for entry, (file_name, parent_entry, _) in old_lookup.items() }
+            mismatches = sum(1 for entry, value in old_lookup.items() 
+                             if entry not in new_lookup or new_lookup[entry][:2] != value)
+            mismatches += sum(1 for entry in new_lookup if entry not in old_lookup)
+            print(f'[.] Mismatched entries   : {mismatches}')
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+(c) 2024 CyberCX
+
+Generator of synthetic MFTECmd style $MFT and $J csv files, for the
+benchmarks. It simulates a volume: a folder tree is created up front (the
+MFT as it was before the journal starts), then the journal is written as
+files are created, renamed, moved, deleted and modified, and at the end
+the MFT csv is written with the final state of every entry. The rewind
+of the output gives known good paths, no row resolves to <UNKNOWN>.
+
+State is kept in arrays, not per entry objects, so 100M rows can be
+generated in a few GB of memory. Names are derived from the entry number
+and how many times it has been renamed, so they are not stored either.
+
+Also generated, as seen in real MFTECmd output:
+  - ADS rows in the MFT csv (FileName 'name:Zone.Identifier')
+  - Lines with NUL bytes in front of them (MFTECmd bug)
+  - Negative ParentSequenceNumber values (MFTECmd bug, fixed on 9 Mar 2024)
+  - Reasons written as a number instead of flag names
+
+Usage:
+    python3 benchmarks/generate_workload.py --mft_rows 1000000 --usn_rows 5000000 out_folder
+
+License : MIT
+
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mftecmd_schema import ticks_to_timestamp
+
+MFT_COLUMNS = ('EntryNumber', 'SequenceNumber', 'InUse', 'ParentEntryNumber', 'ParentSequenceNumber', 'ParentPath',
+               'FileName', 'Extension', 'FileSize', 'ReferenceCount', 'ReparseTarget', 'IsDirectory', 'HasAds',
+               'IsAds', 'SI<FN', 'uSecZeros', 'Copied', 'SiFlags', 'NameType', 'Created0x10', 'Created0x30',
+               'LastModified0x10', 'LastModified0x30', 'LastRecordChange0x10', 'LastRecordChange0x30',
+               'LastAccess0x10', 'LastAccess0x30', 'UpdateSequenceNumber', 'LogfileSequenceNumber', 'SecurityId',
+               'ObjectIdFileDroid', 'LoggedUtilStream', 'ZoneIdContents', 'SourceFile')
+USN_COLUMNS = ('Name', 'Extension', 'EntryNumber', 'SequenceNumber', 'ParentEntryNumber', 'ParentSequenceNumber',
+               'ParentPath', 'UpdateSequenceNumber', 'UpdateTimestamp', 'UpdateReasons', 'FileAttributes',
+               'OffsetToData', 'SourceFile')
+
+ROOT = 5
+FIRST_USER_ENTRY = 40 # 0-39 are the metafiles and reserved entries
+SYSTEM_FILES = { 0 : '$MFT', 1 : '$MFTMirr', 2 : '$LogFile', 3 : '$Volume', 4 : '$AttrDef', 5 : '.', 6 : '$Bitmap',
+                 7 : '$Boot', 8 : '$BadClus', 9 : '$Secure', 10 : '$UpCase', 11 : '$Extend' }
+EXTENSIONS = ('.txt', '.dat', '.exe', '.dll', '.lnk', '.log', '.pf', '')
+START_TICKS = 133485408000000000 # 2024-01-01 00:00:00
+MFT_TIMESTAMP = '2023-01-01 00:00:00.0000000'
+BATCH_SIZE = 10000
+MAX_PARENT_TRIES = 10
+
+class Volume:
+    '''Final and intermediate state of every entry, in arrays indexed by entry number'''
+    def __init__(self, rnd, max_depth):
+        self.rnd = rnd
+        self.max_depth = max_depth
+        self.seqs = array('H')
+        self.in_use = bytearray()
+        self.is_dir = bytearray()
+        self.parents = array('Q')        # parent entry number
+        self.parent_seqs = array('H')    # parent sequence number
+        self.depths = array('B')
+        self.renames = array('I')        # times renamed, part of the name
+        self.children = array('I')       # entries in use in this folder
+        self.dirs = array('Q')           # entries that were created as folders
+        self.free = array('Q')           # deleted entries that can be reused
+        for entry_num in range(FIRST_USER_ENTRY):
+            self._add_slot()
+        for entry_num in SYSTEM_FILES:
+            self.seqs[entry_num] = entry_num or 1
+            self.in_use[entry_num] = 1
+            self.parents[entry_num] = ROOT
+            self.parent_seqs[entry_num] = ROOT
+        self.is_dir[ROOT] = 1
+        self.is_dir[11] = 1
+        self.dirs.append(ROOT)
+
+    def _add_slot(self):
+        self.seqs.append(0)
+        self.in_use.append(0)
+        self.is_dir.append(0)
+        self.parents.append(0)
+        self.parent_seqs.append(0)
+        self.depths.append(0)
+        self.renames.append(0)
+        self.children.append(0)
+
+    def name(self, entry_num):
+        if entry_num in SYSTEM_FILES:
+            return SYSTEM_FILES[entry_num]
+        if self.is_dir[entry_num]:
+            name = f'Dir{entry_num}'
+        elif entry_num % 101 == 0:
+            name = str(entry_num) # all digit names, as seen in real data
+        else:
+            name = f'file{entry_num}'
+        renames = self.renames[entry_num]
+        if renames:
+            name = f'ren{renames}_{name}'
+        return name if self.is_dir[entry_num] else name + EXTENSIONS[entry_num % len(EXTENSIONS)]
+
+    def pick_folder(self):
+        '''A random folder in use that is not too deep, the root if none is found quickly'''
+        for _ in range(MAX_PARENT_TRIES):
+            entry_num = self.dirs[self.rnd.randrange(len(self.dirs))]
+            if self.in_use[entry_num] and self.is_dir[entry_num] and self.depths[entry_num] < self.max_depth:
+                return entry_num
+        return ROOT
+
+    def pick_in_use(self):
+        '''A random user entry in use, or -1'''
+        end = len(self.seqs)
+        if end <= FIRST_USER_ENTRY:
+            return -1
+        for _ in range(5):
+            entry_num = self.rnd.randrange(FIRST_USER_ENTRY, end)
+            if self.in_use[entry_num]:
+                return entry_num
+        return -1
+
+    def create(self, is_dir):
+        if self.free and self.rnd.random() < 0.5:
+            index = self.rnd.randrange(len(self.free))
+            entry_num = self.free[index]
+            self.free[index] = self.free[-1]
+            self.free.pop()
+        else:
+            entry_num = len(self.seqs)
+            self._add_slot()
+            self.seqs[entry_num] = 1
+        parent = self.pick_folder()
+        self.in_use[entry_num] = 1
+        self.is_dir[entry_num] = is_dir
+        self.renames[entry_num] = 0
+        self.children[entry_num] = 0
+        self.set_parent(entry_num, parent)
+        if is_dir:
+            self.dirs.append(entry_num)
+        return entry_num
+
+    def set_parent(self, entry_num, parent):
+        self.parents[entry_num] = parent
+        self.parent_seqs[entry_num] = self.seqs[parent]
+        self.depths[entry_num] = self.depths[parent] + 1
+        self.children[parent] += 1
+
+    def delete(self, entry_num):
+        self.children[self.parents[entry_num]] -= 1
+        self.in_use[entry_num] = 0
+        self.seqs[entry_num] = (self.seqs[entry_num] + 1) & 0xFFFF or 1
+        self.free.append(entry_num)
+
+def journal_rows(volume, rnd, num_rows, rename_rate, delete_rate, numeric_reason_rate):
+    '''Generator, yields lists of $J csv rows, simulating activity on volume until num_rows are written'''
+    ticks = START_TICKS
+    usn = 1000
+    written = 0
+    batch = []
+
+    def row(entry_num, reasons):
+        nonlocal ticks, usn
+        name = volume.name(entry_num)
+        dot = name.rfind('.')
+        batch.append((name, name[dot:] if dot > 0 else '', entry_num, volume.seqs[entry_num],
+                      volume.parents[entry_num], volume.parent_seqs[entry_num], '', usn, ticks_to_timestamp(ticks),
+                      reasons, 'Directory' if volume.is_dir[entry_num] else 'Archive', usn, 'J'))
+        usn += (0x40 + 2 * len(name) + 7) & ~7
+        ticks += rnd.randrange(200000) # up to 20 ms between records
+
+    while written < num_rows:
+        action = rnd.random()
+        entry_num = volume.pick_in_use()
+        if entry_num < 0 or action >= rename_rate + delete_rate + 0.25:
+            entry_num = volume.create(rnd.random() < 0.15)
+            row(entry_num, 'FileCreate')
+            row(entry_num, str(0x80000100) if rnd.random() < numeric_reason_rate else 'FileCreate|Close')
+        elif action < rename_rate:
+            row(entry_num, 'RenameOldName')
+            volume.renames[entry_num] += 1
+            if not volume.is_dir[entry_num] and rnd.random() < 0.5:
+                # files also move between folders, folders are only renamed
+                # so the tree can not get loops
+                volume.children[volume.parents[entry_num]] -= 1
+                volume.set_parent(entry_num, volume.pick_folder())
+            row(entry_num, 'RenameNewName')
+            row(entry_num, 'RenameNewName|Close')
+        elif action < rename_rate + delete_rate and not volume.children[entry_num]:
+            row(entry_num, 'FileDelete|Close')
+            volume.delete(entry_num)
+        else:
+            row(entry_num, rnd.choice(('DataExtend', 'DataOverwrite|Close', 'BasicInfoChange|Close', 'SecurityChange')))
+        if len(batch) >= BATCH_SIZE:
+            written += len(batch)
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def write_rows(f, batches, null_rate, rnd):
+    '''Writes batches of rows to the csv file f, putting NUL bytes in front of about null_rate of the lines'''
+    writer = csv.writer(f)
+    count = 0
+    for batch in batches:
+        if null_rate and rnd.random() < null_rate * len(batch):
+            index = rnd.randrange(len(batch))
+            writer.writerows(batch[:index])
+            f.write('\x00' * rnd.randint(1, 64))
+            writer.writerows(batch[index:])
+        else:
+            writer.writerows(batch)
+        count += len(batch)
+    return count
+
+def mft_rows(volume, rnd, ads_rate, negative_rate):
+    '''Generator, yields lists of $MFT csv rows for the final state of volume'''
+    column = { name : index for index, name in enumerate(MFT_COLUMNS) }
+    batch = []
+    for entry_num in range(len(volume.seqs)):
+        if not volume.seqs[entry_num]:
+            continue # never used
+        name = volume.name(entry_num)
+        dot = name.rfind('.')
+        parent_seq = volume.parent_seqs[entry_num]
+        if rnd.random() < negative_rate and parent_seq:
+            parent_seq -= 65536 # written as a signed 16 bit value by older MFTECmd
+        is_dir = bool(volume.is_dir[entry_num])
+        has_ads = not is_dir and rnd.random() < ads_rate
+        row = [''] * len(MFT_COLUMNS)
+        row[column['EntryNumber']] = entry_num
+        row[column['SequenceNumber']] = volume.seqs[entry_num]
+        row[column['InUse']] = str(bool(volume.in_use[entry_num]))
+        row[column['ParentEntryNumber']] = volume.parents[entry_num]
+        row[column['ParentSequenceNumber']] = parent_seq
+        row[column['FileName']] = name
+        row[column['Extension']] = name[dot:] if dot > 0 else ''
+        row[column['IsDirectory']] = str(is_dir)
+        row[column['HasAds']] = str(has_ads)
+        row[column['IsAds']] = 'False'
+        row[column['Created0x10']] = MFT_TIMESTAMP
+        row[column['SourceFile']] = 'M'
+        batch.append(row)
+        if has_ads:
+            ads_row = list(row)
+            ads_row[column['FileName']] = name + ':Zone.Identifier'
+            ads_row[column['Extension']] = '.Identifier'
+            ads_row[column['IsAds']] = 'True'
+            batch.append(ads_row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def generate_workload(mft_csv_path, usn_csv_path, mft_rows_count, usn_rows_count, max_depth=12, rename_rate=0.15,
+                      delete_rate=0.1, ads_rate=0.01, null_rate=0.00001, negative_rate=0.001,
+                      numeric_reason_rate=0.001, seed=1):
+    '''
+        Writes the $MFT csv (about mft_rows_count rows before the journal
+        starts, plus the files the journal creates) and the $J csv (at least
+        usn_rows_count rows). Returns (mft rows, usn rows) written.
+    '''
+    rnd = random.Random(seed)
+    volume = Volume(rnd, max_depth)
+    for _ in range(mft_rows_count):
+        volume.create(rnd.random() < 0.15)
+    with open(usn_csv_path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(USN_COLUMNS)
+        usn_count = write_rows(f, journal_rows(volume, rnd, usn_rows_count, rename_rate, delete_rate,
+                                               numeric_reason_rate), null_rate, rnd)
+    with open(mft_csv_path, 'w', newline='', encoding='utf-8') as f:
+        csv.writer(f).writerow(MFT_COLUMNS)
+        mft_count = write_rows(f, mft_rows(volume, rnd, ads_rate, negative_rate), null_rate, rnd)
+    return mft_count, usn_count
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic MFTECmd $MFT and $J csv files for benchmarks')
+    parser.add_argument('--mft_rows', type=int, default=1000000, help='MFT entries before the journal starts (default 1000000)')
+    parser.add_argument('--usn_rows', type=int, default=1000000, help='Journal rows (default 1000000)')
+    parser.add_argument('--max_depth', type=int, default=12, help='Deepest folder level (default 12)')
+    parser.add_argument('--rename_rate', type=float, default=0.15, help='Fraction of journal actions that are renames (default 0.15)')
+    parser.add_argument('--delete_rate', type=float, default=0.1, help='Fraction of journal actions that are deletes (default 0.1)')
+    parser.add_argument('--ads_rate', type=float, default=0.01, help='Fraction of files with an ADS row (default 0.01)')
+    parser.add_argument('--null_rate', type=float, default=0.00001, help='Fraction of lines with NULs in front (default 0.00001)')
+    parser.add_argument('--negative_rate', type=float, default=0.001,
+                        help='Fraction of MFT rows with a negative ParentSequenceNumber (default 0.001)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default 1)')
+    parser.add_argument('output_path', help='Folder to write mft.csv and usn.csv to')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_path, exist_ok=True)
+    mft_csv_path = os.path.join(args.output_path, 'mft.csv')
+    usn_csv_path = os.path.join(args.output_path, 'usn.csv')
+    start_time = time.perf_counter()
+    mft_count, usn_count = generate_workload(mft_csv_path, usn_csv_path, args.mft_rows, args.usn_rows, args.max_depth,
+                                             args.rename_rate, args.delete_rate, args.ads_rate, args.null_rate,
+                                             args.negative_rate, seed=args.seed)
+    print(f'[.] Wrote {mft_count} MFT rows to {mft_csv_path} and {usn_count} USN rows to {usn_csv_path} '
+          f'in {time.perf_counter() - start_time:.1f} s')
+
+if __name__ == "__main__":
+    main()
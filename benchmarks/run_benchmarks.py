@@ -0,0 +1,222 @@
+"""
+(c) 2024 CyberCX
+
+Phase by phase benchmark of the rewind, on csv files from
+generate_workload.py (generated at the given scale if not supplied) or
+on real MFTECmd output. Each phase is timed on its own:
+
+    sanitize_remove_nulls  the (legacy) NUL removal pass over both csv files
+    import_mft             MFT csv -> MFT table
+    import_usn             USN csv -> USNJRNL table
+    lookup                 MFT table -> parent lookup (build_parent_lookup)
+    rewind                 the rewind loop over the journal, output discarded
+    write_output           the full rewind as the tool runs it, writing the
+                           csv, the USNJRNL_FullPaths and PathHistory tables
+
+Results (time, rows/sec, MB/sec and peak RSS so far) are printed and can
+be saved as JSON with --json, to compare with a run of another version
+with --compare. Peak RSS is the high water mark of this process (and of
+its worker processes) at the end of the phase, it is not available on
+Windows.
+
+Usage:
+    python3 benchmarks/run_benchmarks.py --mft_rows 1000000 --usn_rows 10000000 --json results.json
+    python3 benchmarks/run_benchmarks.py -m mft.csv -u usn.csv --compare results.json
+
+License : MIT
+
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from csv_stream import USN_FIELDS
+from csv_to_sqlite import sanitize_remove_nulls
+from generate_workload import generate_workload
+from metrics import peak_rss_mb
+from mftecmd_schema import MFT_SCHEMA, USN_SCHEMA
+from path_resolver import build_parent_lookup, mft_records, UNKNOWN_PATH
+from rewind_engine import rewind_journal, USN_ORDER
+from usnjrnl_rewind import add_to_sqlite, create_journal_rewind_csv, version
+
+MFT_QUERY = '''
+    SELECT EntryNumber, SequenceNumber, InUse, ParentEntryNumber,
+    ParentSequenceNumber, FileName
+    FROM MFT
+'''
+USN_QUERY = f'SELECT {", ".join(USN_FIELDS)} FROM USNJRNL ORDER BY {USN_ORDER}'
+
+class PhaseTimer:
+    '''Times phases and collects their results'''
+    def __init__(self, quiet=True):
+        self.quiet = quiet
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name, num_bytes=None):
+        '''Times the with block. Set 'rows' in the yielded dict to the rows processed.'''
+        result = { 'name' : name, 'rows' : None }
+        start_time = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if self.quiet else sys.stdout):
+            yield result
+        seconds = time.perf_counter() - start_time
+        result['seconds'] = round(seconds, 3)
+        result['rows_per_sec'] = int(result['rows'] / seconds) if result['rows'] and seconds > 0 else None
+        result['mb_per_sec'] = round(num_bytes / (1024 * 1024) / seconds, 1) if num_bytes and seconds > 0 else None
+        result['peak_rss_mb'] = peak_rss_mb()
+        self.phases.append(result)
+        print(format_phase(result))
+
+def format_phase(result):
+    text = f'[.] {result["name"]:<22}: {result["seconds"]:9.2f} s'
+    if result['rows_per_sec']:
+        text += f'  {result["rows_per_sec"]:>10} rows/sec'
+    if result['mb_per_sec']:
+        text += f'  {result["mb_per_sec"]:>7} MB/sec'
+    if result['peak_rss_mb'] is not None:
+        text += f'  peak RSS {result["peak_rss_mb"]} MB'
+    return text
+
+def count_rows(db_path, table_name):
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+    finally:
+        db.close()
+
+def run_phases(mft_csv_path, usn_csv_path, temp_folder, num_workers=1, quiet=True):
+    '''Runs all the phases, returns the list of phase results'''
+    timer = PhaseTimer(quiet)
+    mft_size = os.path.getsize(mft_csv_path)
+    usn_size = os.path.getsize(usn_csv_path)
+    db_path = os.path.join(temp_folder, 'NTFS.sqlite')
+
+    with timer.phase('sanitize_remove_nulls', mft_size + usn_size):
+        for path in (mft_csv_path, usn_csv_path):
+            cleaned_path = sanitize_remove_nulls(path, temp_folder)
+            if cleaned_path != path:
+                os.remove(cleaned_path)
+
+    with timer.phase('import_mft', mft_size) as result:
+        if not add_to_sqlite(mft_csv_path, db_path, 'MFT', bulk_load=True, schema=MFT_SCHEMA, num_workers=num_workers):
+            raise RuntimeError('MFT import failed')
+        result['rows'] = count_rows(db_path, 'MFT')
+
+    with timer.phase('import_usn', usn_size) as result:
+        if not add_to_sqlite(usn_csv_path, db_path, 'USNJRNL', bulk_load=True, schema=USN_SCHEMA,
+                             num_workers=num_workers):
+            raise RuntimeError('USN import failed')
+        result['rows'] = count_rows(db_path, 'USNJRNL')
+
+    db = sqlite3.connect(db_path)
+    try:
+        with timer.phase('lookup') as result:
+            # Same fix create_journal_rewind_csv applies before building the lookup
+            db.execute('UPDATE MFT SET ParentSequenceNumber=ParentSequenceNumber&65535 where ParentSequenceNumber < 0')
+            db.commit()
+            parent_lookup = build_parent_lookup(mft_records(db.execute(MFT_QUERY)))
+            result['rows'] = len(parent_lookup)
+
+        with timer.phase('rewind') as result:
+            rows = 0
+            unknown_paths = 0
+            for row in rewind_journal(parent_lookup, db.execute(USN_QUERY)):
+                rows += 1
+                if row[6].startswith(UNKNOWN_PATH):
+                    unknown_paths += 1
+            result['rows'] = rows
+            result['unknown_paths'] = unknown_paths
+    finally:
+        db.close()
+    del parent_lookup
+
+    with timer.phase('write_output') as result:
+        out_csv_path = os.path.join(temp_folder, 'USNJRNL.fullPaths.csv')
+        if not create_journal_rewind_csv(db_path, out_csv_path, 'MFT', 'USNJRNL', 'USNJRNL_FullPaths', num_workers,
+                                         'PathHistory'):
+            raise RuntimeError('Rewind failed')
+        result['rows'] = count_rows(db_path, 'USNJRNL_FullPaths')
+    return timer.phases
+
+def compare(phases, baseline):
+    '''Prints the change of each phase against the phases in baseline (a results dict)'''
+    old_phases = { phase['name'] : phase for phase in baseline.get('phases', []) }
+    print(f'[.] Compared to v{baseline.get("version", "?")} ({baseline.get("date", "?")}):')
+    for phase in phases:
+        old = old_phases.get(phase['name'])
+        if not old or not old.get('seconds'):
+            print(f'[.]   {phase["name"]:<22}: no baseline')
+            continue
+        change = (phase['seconds'] - old['seconds']) / old['seconds'] * 100
+        text = f'[.]   {phase["name"]:<22}: {old["seconds"]:9.2f} s -> {phase["seconds"]:9.2f} s  ({change:+.1f} %)'
+        if phase.get('peak_rss_mb') is not None and old.get('peak_rss_mb') is not None:
+            text += f'  peak RSS {old["peak_rss_mb"]} -> {phase["peak_rss_mb"]} MB'
+        print(text)
+
+def main():
+    parser = argparse.ArgumentParser(description=f'USN full path builder v{version} - phase benchmarks')
+    parser.add_argument('-m', '--mft_csv', help='MFTECmd $MFT csv to use, instead of generated data')
+    parser.add_argument('-u', '--usn_csv', help='MFTECmd $J csv to use, instead of generated data')
+    parser.add_argument('--mft_rows', type=int, default=1000000, help='MFT entries to generate (default 1000000)')
+    parser.add_argument('--usn_rows', type=int, default=1000000, help='Journal rows to generate (default 1000000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for generated data (default 1)')
+    parser.add_argument('--workers', type=int, default=1, help='Processes to use, as --workers of the tool (default 1)')
+    parser.add_argument('--json', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='Compare with the results in this JSON file (from an earlier --json)')
+    parser.add_argument('--temp_folder', help='Folder for the generated data and database (default is a temp folder)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of each phase')
+    args = parser.parse_args()
+
+    if bool(args.mft_csv) != bool(args.usn_csv):
+        print('[!] Error: Give both -m and -u, or neither to use generated data')
+        return
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory(dir=args.temp_folder) as temp_folder:
+        generated = None
+        mft_csv_path, usn_csv_path = args.mft_csv, args.usn_csv
+        if not mft_csv_path:
+            mft_csv_path = os.path.join(temp_folder, 'mft.csv')
+            usn_csv_path = os.path.join(temp_folder, 'usn.csv')
+            print(f'[.] Generating {args.mft_rows} MFT entries and {args.usn_rows} journal rows')
+            start_time = time.perf_counter()
+            mft_count, usn_count = generate_workload(mft_csv_path, usn_csv_path, args.mft_rows, args.usn_rows,
+                                                     seed=args.seed)
+            generated = { 'mft_rows' : mft_count, 'usn_rows' : usn_count, 'seed' : args.seed,
+                          'seconds' : round(time.perf_counter() - start_time, 3) }
+        phases = run_phases(mft_csv_path, usn_csv_path, temp_folder, args.workers, not args.verbose)
+
+        results = {
+            'version' : version,
+            'date' : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'cpu_count' : os.cpu_count(),
+            'workers' : args.workers,
+            'inputs' : { 'mft_csv' : args.mft_csv or 'generated', 'usn_csv' : args.usn_csv or 'generated',
+                         'mft_csv_bytes' : os.path.getsize(mft_csv_path),
+                         'usn_csv_bytes' : os.path.getsize(usn_csv_path), 'generated' : generated },
+            'phases' : phases,
+            'total_seconds' : round(sum(phase['seconds'] for phase in phases), 3)
+        }
+    print(f'[.] Total: {results["total_seconds"]:.2f} s')
+    if baseline:
+        compare(phases, baseline)
+    if args.json:
+        with open(args.json, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print(f'[.] Results saved to {args.json}')
+
+if __name__ == "__main__":
+    main()
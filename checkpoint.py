@@ -0,0 +1,153 @@
+"""
+(c) 2024 CyberCX
+
+Checkpoints of the rewind, so that a long run that crashed or was killed
+can carry on from where it got to (--resume) instead of starting again.
+
+Every interval, at a batch boundary of the rewind pipeline, the state of
+the Rewinder (the parent lookup, the path history recorded so far and
+the unknown path counts) is pickled along with the number of journal
+rows done and the (UpdateTimestamp, UpdateSequenceNumber) of the last
+of them. Once the write stage has written the rows resolved up to then,
+the sinks are flushed and their positions (the size of the csv and the
+rows in the table) are added, and the checkpoint is saved next to the
+database, replacing the previous one. The file is removed when the run
+finishes.
+
+A checkpoint is only used if it was taken with the same settings and
+the same imported csv files, see checkpoint_settings().
+
+License : MIT
+
+"""
+import os
+import pickle
+import sqlite3
+import time
+
+from csv_stream import USN_FIELDS
+from import_cache import load_fingerprints
+from rewind_engine import Rewinder
+
+CHECKPOINT_VERSION = 3
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+TIMESTAMP_INDEX = USN_FIELDS.index('UpdateTimestamp')
+USN_INDEX = USN_FIELDS.index('UpdateSequenceNumber')
+
+def checkpoint_path(sqlite_db_path):
+    '''The checkpoint file of the rewind into the db at sqlite_db_path'''
+    return sqlite_db_path + CHECKPOINT_SUFFIX
+
+def checkpoint_settings(db, usn_table_name, row_count, out_csv_path, out_table_name, history_table_name,
+                        row_filter, normalize_paths):
+    '''The settings of a rewind that a checkpoint must match to be resumed'''
+    # Fingerprints of the imported csv files, as for fingerprints_match()
+    fingerprints = load_fingerprints(db) or {}
+    return { 'usn_table' : usn_table_name, 'usn_rows' : row_count, 'fingerprints' : fingerprints,
+             'out_csv' : os.path.abspath(out_csv_path) if out_csv_path else '', 'out_table' : out_table_name,
+             'history_table' : history_table_name, 'filter' : str(row_filter) if row_filter else '',
+             'normalize_paths' : normalize_paths }
+
+def load_checkpoint(path, settings):
+    '''
+        Returns the checkpoint saved at path, or None if there is none or
+        it can not be used with these settings (the reason is printed).
+    '''
+    if not os.path.exists(path):
+        print('[.] No checkpoint to resume from, starting the rewind from the beginning')
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError) as ex:
+        print(f'[!] Failed to read the checkpoint at {path}, starting the rewind from the beginning. Error was', str(ex))
+        return None
+    if state.get('version') != CHECKPOINT_VERSION:
+        print('[!] The checkpoint is from another version, starting the rewind from the beginning')
+        return None
+    changed = [ name for name, value in settings.items() if state['settings'].get(name) != value ]
+    if changed:
+        print(f'[!] The checkpoint was taken with different {", ".join(changed)}, '
+               'starting the rewind from the beginning')
+        return None
+    return state
+
+def outputs_cover(state, db, out_csv_path, data_table_name):
+    '''
+        True if the csv at out_csv_path and the table data_table_name (if
+        set) still have all that was written up to the checkpoint state
+    '''
+    sink_positions = state['sinks']
+    try:
+        if out_csv_path and os.path.getsize(out_csv_path) < sink_positions['CsvSink']:
+            return False
+    except OSError:
+        return False
+    if data_table_name:
+        try:
+            last_rowid = db.execute(f'SELECT IFNULL(MAX(rowid), 0) FROM "{data_table_name}"').fetchone()[0]
+        except sqlite3.Error:
+            return False
+        if last_rowid < sink_positions['SqliteSink']:
+            return False
+    return True
+
+def remove_checkpoint(path):
+    if os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as ex:
+            print(f'[!] Failed to remove checkpoint file : {path} Error was:', str(ex))
+
+def restore_rewinder(state, row_filter=None, unknown_paths=None):
+    '''
+        Returns a Rewinder as it was at the checkpoint state. The unknown
+        path counts of the checkpoint are added to unknown_paths if given.
+    '''
+    parent_lookup, history, checkpoint_unknown_paths = pickle.loads(state['rewinder'])
+    rewinder = Rewinder(parent_lookup, row_filter=row_filter, unknown_paths=unknown_paths)
+    rewinder.history = history
+    rewinder.unknown_paths.merge(checkpoint_unknown_paths)
+    return rewinder
+
+class RewindCheckpointer:
+    '''
+        The checkpoint function for run_pipeline(), saves a checkpoint of
+        rewinder at path every interval seconds. settings are those of
+        checkpoint_settings(). If the run was resumed, resumed_state is the
+        checkpoint it started from, its rows are added to those done.
+    '''
+    def __init__(self, path, rewinder, settings, interval, resumed_state=None):
+        self.path = path
+        self.rewinder = rewinder
+        self.settings = settings
+        self.interval = interval
+        self.input_rows_before = resumed_state['input_rows'] if resumed_state else 0
+        self.output_rows_before = resumed_state['output_rows'] if resumed_state else 0
+        self._next_time = time.perf_counter() + interval
+
+    def __call__(self, input_rows, last_row, output_rows):
+        '''Called on the resolve thread after each batch, returns a save function if a checkpoint is due'''
+        now = time.perf_counter()
+        if now < self._next_time or last_row is None:
+            return None
+        self._next_time = now + self.interval
+        rewinder = self.rewinder
+        state = { 'version' : CHECKPOINT_VERSION, 'settings' : self.settings,
+                  'input_rows' : self.input_rows_before + input_rows, 'position' : (last_row[TIMESTAMP_INDEX], last_row[USN_INDEX]),
+                  'output_rows' : self.output_rows_before + output_rows,
+                  'rewinder' : pickle.dumps((rewinder.parent_lookup, rewinder.history, rewinder.unknown_paths),
+                                            pickle.HIGHEST_PROTOCOL) }
+        return lambda sinks: self.save(state, sinks)
+
+    def save(self, state, sinks):
+        '''Called on the write thread, once the rows before the checkpoint are with the sinks'''
+        state['sinks'] = { type(sink).__name__ : sink.flush() for sink in sinks }
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path) # the previous checkpoint stays good until this one is complete
+        print(f'[.] Checkpoint saved, {state["input_rows"]} journal rows done', flush=True)
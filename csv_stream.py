@@ -0,0 +1,164 @@
+"""
+(c) 2024 CyberCX
+
+Helpers to read MFTECmd csv output directly, without first importing
+it into an SQLite database. Used by the --no_db streaming mode of
+usnjrnl_rewind.
+
+License : MIT
+
+"""
+import csv
+import heapq
+import os
+import tempfile
+
+from csv_to_sqlite import open_csv_file
+from mft_parser import is_raw_mft, iter_mft_records
+from mftecmd_schema import ticks_to_timestamp
+from parallel_csv import ParallelCsvReader
+from path_resolver import mft_records
+from usn_parser import is_raw_usn_journal, iter_usn_records, UsnJournalStats
+
+MFT_FIELDS = ('EntryNumber', 'SequenceNumber', 'InUse', 'ParentEntryNumber',
+              'ParentSequenceNumber', 'FileName')
+
+USN_FIELDS = ('Name', 'Extension', 'EntryNumber', 'SequenceNumber', 'ParentEntryNumber',
+              'ParentSequenceNumber', 'UpdateSequenceNumber', 'UpdateTimestamp',
+              'UpdateReasons', 'FileAttributes', 'OffsetToData', 'SourceFile')
+
+# Rough per row overhead of a python tuple of strings, used to
+# estimate memory use when sorting
+ROW_OVERHEAD = 56 + 57 * len(USN_FIELDS)
+
+# Max number of sorted runs to merge at once, keeps open files in check
+MAX_MERGE_RUNS = 128
+
+def read_csv_fields(path, field_names, perform_cleaning=True, num_workers=1):
+    '''
+        Generator, yields a tuple of the requested fields for each row
+        of the csv file at path. Nulls are removed while reading if 
+        perform_cleaning is set. Raises ValueError if any of the fields
+        are missing. If num_workers is more than 1, the file is parsed
+        in parallel (see ParallelCsvReader).
+    '''
+    if num_workers > 1:
+        with ParallelCsvReader(path, strip_nulls=perform_cleaning, num_workers=num_workers, 
+                               fields=field_names) as reader:
+            for batch in reader.batches():
+                yield from batch
+        return
+    with open_csv_file(path, strip_nulls=perform_cleaning) as f:
+        csv.field_size_limit(5 * 1024 * 1024)
+        reader = csv.reader(f)
+        headers = next(reader, [])
+        missing = [name for name in field_names if name not in headers]
+        if missing:
+            raise ValueError(f'Columns {", ".join(missing)} not found in {path}')
+        indexes = [headers.index(name) for name in field_names]
+        num_cols = max(indexes) + 1
+        for row in reader:
+            if len(row) < num_cols: # truncated row
+                continue
+            yield tuple([row[i] for i in indexes])
+
+def read_mft_csv(path, num_workers=1):
+    '''
+        Generator, yields (EntryNumber, SequenceNumber, InUse, ParentEntryNumber,
+        ParentSequenceNumber, FileName) for every row of an MFTECmd $MFT csv,
+        or every record of a raw $MFT file, converted as build_parent_lookup
+        expects.
+    '''
+    if is_raw_mft(path):
+        yield from iter_mft_records(path, num_workers)
+        return
+    yield from mft_records(read_csv_fields(path, MFT_FIELDS, num_workers=num_workers))
+
+def read_usn_fields(path, num_workers=1):
+    '''
+        Generator, yields a tuple of USN_FIELDS for each row of an MFTECmd
+        $J csv, or each record of a raw $J file. Values are strings, as
+        they would be read from the csv.
+    '''
+    if not is_raw_usn_journal(path):
+        yield from read_csv_fields(path, USN_FIELDS, num_workers=num_workers)
+        return
+    stats = UsnJournalStats()
+    for name, extension, entry_num, seq_num, parent_entry_num, parent_seq_num, _, \
+            update_seq_number, ts, reasons, attributes, offset, source_file in iter_usn_records(path, stats):
+        yield (name, extension, str(entry_num), str(seq_num), str(parent_entry_num), str(parent_seq_num), 
+               str(update_seq_number), ticks_to_timestamp(ts), reasons, attributes, str(offset), source_file)
+    if not stats.records:
+        raise ValueError(f'No USN records found in {path}, which looked like a raw $J file '
+                         f'({stats.bad_offsets} bad offsets)')
+
+def usn_sort_key(row):
+    '''
+        Sort key for rows in USN_FIELDS order, matching the rewind query's
+        ORDER BY UpdateTimestamp, UpdateSequenceNumber. Like sqlite, numbers
+        sort before any non numeric text.
+    '''
+    usn = row[6]
+    try:
+        return row[7], 0, int(usn), ''
+    except ValueError:
+        return row[7], 1, 0, usn
+
+def _write_run(rows, temp_folder):
+    '''Write a sorted run of rows to a temp csv file and return its path'''
+    fd, run_path = tempfile.mkstemp(prefix='usn_sort_', suffix='.csv', dir=temp_folder)
+    with os.fdopen(fd, 'w', encoding='utf8', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return run_path
+
+def _read_run(run_path):
+    with open(run_path, 'r', encoding='utf8', newline='') as f:
+        for row in csv.reader(f):
+            yield tuple(row)
+
+def _merge_runs(run_paths, temp_folder):
+    '''Merge groups of sorted runs until at most MAX_MERGE_RUNS are left'''
+    while len(run_paths) > MAX_MERGE_RUNS:
+        group, run_paths = run_paths[:MAX_MERGE_RUNS], run_paths[MAX_MERGE_RUNS:]
+        runs = [_read_run(run_path) for run_path in group]
+        run_paths.append(_write_run(heapq.merge(*runs, key=usn_sort_key, reverse=True), temp_folder))
+        for run_path in group:
+            os.remove(run_path)
+    return run_paths
+
+def sort_usn_csv(path, temp_folder, memory_budget_mb=512, num_workers=1):
+    '''
+        Generator, yields the rows (USN_FIELDS order) of an MFTECmd $J csv
+        (or a raw $J) sorted by UpdateTimestamp, UpdateSequenceNumber 
+        descending, which is the order the rewind needs. If the rows need more than
+        memory_budget_mb, sorted runs are spilled to temp files in
+        temp_folder and merged (external merge sort).
+    '''
+    budget = memory_budget_mb * 1024 * 1024
+    run_paths = []
+    rows = []
+    size = 0
+    try:
+        for row in read_usn_fields(path, num_workers):
+            rows.append(row)
+            size += ROW_OVERHEAD + sum(map(len, row))
+            if size >= budget:
+                rows.sort(key=usn_sort_key, reverse=True)
+                run_paths.append(_write_run(rows, temp_folder))
+                rows = []
+                size = 0
+        rows.sort(key=usn_sort_key, reverse=True)
+        if not run_paths:
+            yield from rows
+            return
+        print(f'[.] Merging {len(run_paths) + 1} sorted runs of USN data')
+        run_paths[:] = _merge_runs(run_paths, temp_folder)
+        runs = [_read_run(run_path) for run_path in run_paths]
+        runs.append(rows)
+        yield from heapq.merge(*runs, key=usn_sort_key, reverse=True)
+    finally:
+        for run_path in run_paths:
+            try:
+                os.remove(run_path)
+            except OSError as ex:
+                print(f'[!] Failed to remove temp file : {run_path} Error was:', str(ex))
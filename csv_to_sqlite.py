@@ -17,10 +17,21 @@ TODO:
 """
 import argparse
 import csv
+import io
 import mmap
 import os
 import re
 import sqlite3
+import time
+
+from parallel_csv import ParallelCsvReader
+
+READ_CHUNK_SIZE = 8 * 1024 * 1024 # 8 MB
+DEFAULT_BATCH_SIZE = 200000
+
+# Settings used for bulk loading into a fresh database
+BULK_PAGE_SIZE = 65536
+BULK_CACHE_SIZE_KB = 512 * 1024 # 512 MB
 
 def table_exists(db_conn, table_name):
     ''' Checks if a table with specified name exists in an sqlite db.
@@ -58,6 +69,60 @@ def create_table(db, table_name, columns_info, drop_existing=True):
         print(ex)
     return False
 
+def set_bulk_load_pragmas(db, page_size=BULK_PAGE_SIZE, cache_size_kb=BULK_CACHE_SIZE_KB):
+    '''
+        Trades durability for speed; there is no rollback journal and no
+        fsync, so a crash during the load can leave a corrupt database.
+        Only use this when writing to a fresh database that can simply be
+        recreated. page_size only takes effect if no tables exist yet.
+    '''
+    db.execute(f'PRAGMA page_size={int(page_size)}')
+    db.execute('PRAGMA journal_mode=OFF')
+    db.execute('PRAGMA synchronous=OFF')
+    db.execute(f'PRAGMA cache_size=-{int(cache_size_kb)}')
+    db.execute('PRAGMA locking_mode=EXCLUSIVE')
+    db.execute('PRAGMA temp_store=MEMORY')
+
+def create_indexes(db, table_name, index_columns):
+    '''
+        Creates an index for each item in index_columns, a list of 
+        column names lists, eg. [ ['EntryNumber', 'SequenceNumber'], .. ]
+    '''
+    for columns in index_columns:
+        index_name = f'idx_{table_name}_' + '_'.join(columns)
+        query = f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table_name}" (' + \
+                ', '.join([f'"{c}"' for c in columns]) + ')'
+        try:
+            db.execute(query)
+        except sqlite3.Error as ex:
+            print(f'Failed to create index {index_name}', str(ex))
+            return False
+    return True
+
+def copy_table(db, source_db_path, table_name):
+    '''
+        Copies table_name, with its indexes, from the sqlite db at 
+        source_db_path into db using ATTACH and INSERT INTO .. SELECT.
+        The indexes are created after the rows are copied, which is faster.
+    '''
+    db.execute('ATTACH DATABASE ? AS source_db', (source_db_path,))
+    try:
+        row = db.execute("SELECT sql FROM source_db.sqlite_master WHERE type='table' AND name=?", 
+                         (table_name,)).fetchone()
+        if not row:
+            raise sqlite3.OperationalError(f'Table {table_name} not found in {source_db_path}')
+        db.execute(f'DROP TABLE IF EXISTS main."{table_name}"')
+        db.execute(row[0]) # the CREATE TABLE statement, unqualified so it goes in main
+        db.execute(f'INSERT INTO main."{table_name}" SELECT * FROM source_db."{table_name}"')
+        index_sqls = db.execute("SELECT sql FROM source_db.sqlite_master WHERE type='index' AND "
+                                "tbl_name=? AND sql IS NOT NULL", (table_name,)).fetchall()
+        for (index_sql,) in index_sqls:
+            db.execute(index_sql)
+        db.commit()
+    finally:
+        db.rollback() # nothing to roll back unless the copy failed, DETACH needs no open transaction
+        db.execute('DETACH DATABASE source_db')
+
 def write_data(db, data, query):
     try:
         db.executemany(query, data)
@@ -66,6 +131,45 @@ def write_data(db, data, query):
         print(ex)
     return False
 
+class TableSchema:
+    '''
+        Explicit column types for a table, used instead of guessing them.
+            column_types    : { column_name : (sqlite_type, converter or None), .. }
+                              csv columns not listed here are TEXT
+            derived_columns : [ (column_name, sqlite_type, func, [source_column, ..]), .. ]
+                              Extra columns appended to each row, the value is
+                              func(*source_values) using the converted values.
+            indexes         : [ [column_name, ..], .. ] indexes to create after loading
+        Converters and funcs should return the value unchanged (or None) if
+        they cannot convert it, rather than raise.
+    '''
+    def __init__(self, column_types, derived_columns=None, indexes=None):
+        self.column_types = column_types
+        self.derived_columns = derived_columns or []
+        self.indexes = indexes or []
+
+    def prepare(self, headers):
+        '''Returns columns_info and a function to convert each csv row'''
+        columns_info = [ [h, self.column_types.get(h, ('TEXT', None))[0]] for h in headers]
+        converters = [(i, self.column_types[h][1]) for i, h in enumerate(headers) 
+                        if h in self.column_types and self.column_types[h][1]]
+        derived = []
+        for name, col_type, func, source_columns in self.derived_columns:
+            if all(c in headers for c in source_columns):
+                columns_info.append([name, col_type])
+                derived.append((func, [headers.index(c) for c in source_columns]))
+        num_columns = len(headers)
+
+        def convert_row(row):
+            if len(row) != num_columns: # malformed, let the insert report it
+                return row
+            for i, converter in converters:
+                row[i] = converter(row[i])
+            for func, indexes in derived:
+                row.append(func(*[row[i] for i in indexes]))
+            return row
+        return columns_info, convert_row
+
 def set_column_names(columns_info, reader, data):
     '''Read 1 row and guess the INTEGER and FLOAT values, else all is TEXT'''
     for row in reader:
@@ -136,13 +240,84 @@ def sanitize_remove_nulls(path, temp_folder):
             return path
         return cleaned_file_path
 
-def import_csv(csv_file_path, db_path, table_name='', delimiter=',', append_existing_table=False, guess_column_types=False):
+class NullStrippingReader(io.RawIOBase):
+    '''
+        Read only raw stream over a binary file that drops all null bytes
+        as it reads, in chunks of chunk_size. This fixes an issue with 
+        MftECmd where sometimes nulls appear in the output csv file, 
+        without having to write out a cleaned copy of the file first.
+    '''
+    def __init__(self, f, chunk_size=READ_CHUNK_SIZE):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._pending = b''
+        self._pos = 0
+        self.nulls_removed = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._pos >= len(self._pending):
+            data = self._f.read(max(self._chunk_size, len(buffer)))
+            if not data:
+                return 0
+            if b'\x00' in data:
+                cleaned = data.translate(None, b'\x00')
+                self.nulls_removed += len(data) - len(cleaned)
+                data = cleaned
+            self._pending = data
+            self._pos = 0
+        size = min(len(buffer), len(self._pending) - self._pos)
+        buffer[:size] = self._pending[self._pos:self._pos + size]
+        self._pos += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+def open_csv_file(path, strip_nulls=True, encoding='utf-8-sig'):
+    '''
+        Opens a csv file for reading as text. If strip_nulls is set, null
+        bytes are removed on the fly (see NullStrippingReader), in a single
+        pass with no intermediate file.
+    '''
+    if not strip_nulls:
+        return open(path, 'r', encoding=encoding)
+    raw = NullStrippingReader(open(path, 'rb', buffering=0))
+    return io.TextIOWrapper(io.BufferedReader(raw, READ_CHUNK_SIZE), encoding=encoding)
+
+def import_csv(csv_file_path, db_path, table_name='', delimiter=',', append_existing_table=False, guess_column_types=False, 
+               strip_nulls=False, bulk_load=False, batch_size=DEFAULT_BATCH_SIZE, index_columns=None, schema=None,
+               num_workers=1):
+    '''
+        Imports a csv file into table_name of the sqlite db at db_path.
+        schema      : A TableSchema with explicit column types, converters and
+                      indexes. If set, guess_column_types is ignored.
+        bulk_load   : Use fast, non-durable pragmas (see set_bulk_load_pragmas), 
+                      meant for fresh databases. Also reports rows/sec.
+        batch_size  : Number of rows inserted per executemany call.
+        index_columns : Indexes to create after the data is loaded, 
+                      eg. [ ['EntryNumber', 'SequenceNumber'], .. ]
+        num_workers : If more than 1, the csv is parsed in parallel by this many
+                      processes (see ParallelCsvReader).
+    '''
     try:
         db = sqlite3.connect(db_path)
+        if bulk_load:
+            set_bulk_load_pragmas(db)
+        start_time = time.time()
         try:
-            with open(csv_file_path, 'r', encoding='utf-8-sig') as f:
+            if num_workers > 1:
+                # Rows are parsed (and converted as per schema) in a process pool
+                csv_file = ParallelCsvReader(csv_file_path, delimiter, strip_nulls, num_workers, schema=schema)
+            else:
+                csv_file = open_csv_file(csv_file_path, strip_nulls)
+            with csv_file as f:
                 csv.field_size_limit(5 * 1024 * 1024) #5MB, else err beyond field > 131072 bytes
-                reader = csv.reader(f, delimiter=delimiter)
+                reader = iter(f) if num_workers > 1 else csv.reader(f, delimiter=delimiter)
                 i = 0
                 for row in reader: # read header row
                     headers = row
@@ -152,8 +327,14 @@ def import_csv(csv_file_path, db_path, table_name='', delimiter=',', append_exis
                     table_name = os.path.splitext(os.path.basename(csv_file_path))[0]
 
                 columns_info = [ [h, 'TEXT'] for h in headers]
+                convert_row = None
                 data = []
-                if guess_column_types:
+                if schema:
+                    columns_info, convert_row = schema.prepare(headers)
+                    if num_workers > 1:
+                        convert_row = None # already done by the parser processes
+                    index_columns = (index_columns or []) + schema.indexes
+                elif guess_column_types:
                     set_column_names(columns_info, reader, data)
                     i += len(data)
                 try:
@@ -172,16 +353,23 @@ def import_csv(csv_file_path, db_path, table_name='', delimiter=',', append_exis
                     return False
                 
                 query = f'INSERT INTO "{table_name}" VALUES (?' + ',?'*(len(columns_info) - 1) + ')'
+                # All batches go in a single transaction, committed at the end
                 for row in reader: # continue reading to get data rows
-                    data.append(row)
+                    data.append(convert_row(row) if convert_row else row)
                     i += 1
-                    if i % 200000 == 0:
+                    if i % batch_size == 0:
                         if not write_data(db, data, query):
                             break
                         data.clear()
                 if data:
                     write_data(db, data, query)
                 db.commit()
+                if bulk_load:
+                    time_taken = max(time.time() - start_time, 0.001)
+                    print(f'Loaded {i} rows into {table_name} in {time_taken:.1f} s ({int(i / time_taken)} rows/sec)')
+                if index_columns:
+                    create_indexes(db, table_name, index_columns)
+                    db.commit()
                 db.close()
                 return True
         except csv.Error as ex:
@@ -192,6 +380,53 @@ def import_csv(csv_file_path, db_path, table_name='', delimiter=',', append_exis
         print(str(ex))
     return False
 
+def import_rows(rows, headers, db_path, table_name, bulk_load=False, batch_size=DEFAULT_BATCH_SIZE, 
+                index_columns=None, schema=None):
+    '''
+        Same as import_csv, for rows (lists or tuples in headers order) that
+        come from somewhere other than a csv file, eg. a binary parser. Any
+        existing table_name is replaced.
+    '''
+    try:
+        db = sqlite3.connect(db_path)
+        if bulk_load:
+            set_bulk_load_pragmas(db)
+        start_time = time.time()
+        columns_info = [ [h, 'TEXT'] for h in headers]
+        convert_row = None
+        if schema:
+            columns_info, convert_row = schema.prepare(list(headers))
+            index_columns = (index_columns or []) + schema.indexes
+        if table_exists(db, table_name):
+            print(f'Existing table {table_name} found, will DROP it and recreate')
+        create_table(db, table_name, columns_info, True)
+
+        query = f'INSERT INTO "{table_name}" VALUES (?' + ',?'*(len(columns_info) - 1) + ')'
+        i = 0
+        data = []
+        for row in rows:
+            data.append(convert_row(list(row)) if convert_row else row)
+            i += 1
+            if i % batch_size == 0:
+                if not write_data(db, data, query):
+                    break
+                data.clear()
+        if data:
+            write_data(db, data, query)
+        db.commit()
+        if bulk_load:
+            time_taken = max(time.time() - start_time, 0.001)
+            print(f'Loaded {i} rows into {table_name} in {time_taken:.1f} s ({int(i / time_taken)} rows/sec)')
+        if index_columns:
+            create_indexes(db, table_name, index_columns)
+            db.commit()
+        db.close()
+        return True
+    except (sqlite3.Error, OSError) as ex:
+        print(f"Failed to import into table {table_name} of db at {db_path}")
+        print(str(ex))
+    return False
+
 def main():
     usage = \
     """
@@ -208,10 +443,15 @@ set to TEXT.
     parser.add_argument('-t', '--table_name', default='', help='Table name')
     parser.add_argument('-g', '--guess_column_types', action='store_true', help='guess column from first row (default False)')
     parser.add_argument('-o', '--output_path', help='Output file name and path')
-    parser.add_argument('-s', '--skip_checks', action='store_true', help='Skips checking & creation of null free csv')
+    parser.add_argument('-s', '--skip_checks', action='store_true', help='Skips removing nulls from the csv while reading it')
     parser.add_argument('-d', '--delete_existing', action='store_true', help='Delete existing db and create new one (default is write to existing)')
     parser.add_argument('-r', '--tsv_file', action='store_true', help='Input is TSV file instead of csv')
     parser.add_argument('-a', '--append_existing_table', action='store_true', help='Do not delete existing table with same name (default is to drop existing same name table)')
+    parser.add_argument('-b', '--bulk_load', action='store_true', help='Fast bulk load into a fresh db (no journal, no sync, large cache)')
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE, help=f'Rows per insert batch (default {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Parse the csv with this many processes (default 1)')
+    parser.add_argument('-x', '--index', action='append', default=[], metavar='COLUMNS', 
+                        help='Create an index after loading, on comma separated COLUMNS (can repeat)')
     args = parser.parse_args()
 
     csv_file_path = args.csv_file_path
@@ -219,10 +459,8 @@ set to TEXT.
 
     if args.output_path:
         db_file_path = args.output_path
-        temp_folder = os.path.split(os.path.realpath(args.output_path))[0]
     else:
         db_file_path = csv_file_path + ".sqlite"
-        temp_folder = os.path.split(os.path.realpath(csv_file_path))[0]
 
     if not os.path.exists(csv_file_path):
         print(f"Error, input file does not exist: {csv_file_path}")
@@ -235,22 +473,15 @@ set to TEXT.
     if args.tsv_file:
         delimiter = '\t'
 
-    if args.skip_checks:
-        cleaned_csv_path = csv_file_path
-    else:
-        # Check for nulls
-        print('Checking and removing any nulls from file...')
-        cleaned_csv_path = sanitize_remove_nulls(csv_file_path, temp_folder)
-
-    print(f'Importing "{cleaned_csv_path}" to Sqlite now...')
+    # Unless skipped, any nulls are removed while reading the file
+    print(f'Importing "{csv_file_path}" to Sqlite now...')
     if not table_name:
         table_name = os.path.splitext(os.path.basename(csv_file_path))[0]
-    result = import_csv(cleaned_csv_path, db_file_path, table_name, delimiter, args.append_existing_table, args.guess_column_types)
-    if (not args.skip_checks) and cleaned_csv_path != csv_file_path:
-        try:
-            os.remove(cleaned_csv_path)
-        except OSError as ex:
-            print(f'Failed to remove temp file : {cleaned_csv_path} Error was:', str(ex))
+    index_columns = [[c.strip() for c in index.split(',') if c.strip()] for index in args.index]
+    result = import_csv(csv_file_path, db_file_path, table_name, delimiter, args.append_existing_table, 
+                        args.guess_column_types, strip_nulls=not args.skip_checks, 
+                        bulk_load=args.bulk_load, batch_size=args.batch_size, index_columns=index_columns, 
+                        num_workers=args.workers)
     
     print("Converted successfully!" if result else "Failed! See errors above.")
 
@@ -0,0 +1,91 @@
+"""
+(c) 2024 CyberCX
+
+Fingerprints of the csv files imported into NTFS.sqlite, kept in the
+ImportedFiles table, so that a rerun on the same evidence can reuse the
+existing tables instead of importing the csv files again.
+
+A fingerprint is the file size, modification time and a hash of samples
+taken across the file (the start, the end and SAMPLE_COUNT blocks in
+between). Reading the samples takes a few milliseconds even for very
+large files. Files match only if all three are the same: an edit that
+keeps the size and misses the sampled blocks still changes the
+modification time. Copying the evidence around may change it too, which
+only costs an import that was not needed.
+
+License : MIT
+
+"""
+import datetime
+import hashlib
+import os
+import sqlite3
+
+IMPORTED_FILES_TABLE = 'ImportedFiles'
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_COUNT = 16
+EDGE_SIZE = 1024 * 1024 # bytes hashed at the start and end of the file
+
+def file_fingerprint(path):
+    '''Returns (size, mtime_ns, sample_hash) for the file at path'''
+    stat = os.stat(path)
+    size = stat.st_size
+    sample_hash = hashlib.blake2b(str(size).encode('ascii'), digest_size=20)
+    with open(path, 'rb') as f:
+        if size <= 2 * EDGE_SIZE + SAMPLE_COUNT * SAMPLE_SIZE:
+            sample_hash.update(f.read())
+        else:
+            sample_hash.update(f.read(EDGE_SIZE))
+            step = (size - 2 * EDGE_SIZE) // (SAMPLE_COUNT + 1)
+            for i in range(1, SAMPLE_COUNT + 1):
+                f.seek(EDGE_SIZE + i * step)
+                sample_hash.update(f.read(SAMPLE_SIZE))
+            f.seek(size - EDGE_SIZE)
+            sample_hash.update(f.read(EDGE_SIZE))
+    return size, stat.st_mtime_ns, sample_hash.hexdigest()
+
+def fingerprints_match(fingerprint, other):
+    '''Compares size, modification time and sample hash'''
+    return other is not None and tuple(fingerprint) == tuple(other)
+
+def only_modified_time_differs(fingerprint, other):
+    '''True if size and sample hash match but not the modification time'''
+    return other is not None and fingerprint[0] == other[0] and fingerprint[2] == other[2] and \
+           fingerprint[1] != other[1]
+
+def load_fingerprints(db):
+    '''
+        Returns { TableName : (size, mtime_ns, sample_hash) } for the tables
+        recorded in the db, or None if the db has no ImportedFiles table.
+    '''
+    try:
+        rows = db.execute(f'SELECT TableName, FileSize, FileModifiedNs, SampleHash FROM "{IMPORTED_FILES_TABLE}"').fetchall()
+    except sqlite3.OperationalError: # no such table
+        return None
+    return { table_name : (size, mtime_ns, sample_hash) for table_name, size, mtime_ns, sample_hash in rows }
+
+def create_fingerprints_table(db):
+    '''
+        Creates the (empty) ImportedFiles table. Done first in a new db, so
+        that if its import is interrupted, the db is still known to be one
+        of ours, with nothing in it to reuse.
+    '''
+    db.execute(f'CREATE TABLE IF NOT EXISTS "{IMPORTED_FILES_TABLE}" (TableName TEXT PRIMARY KEY, '
+                'SourcePath TEXT, FileSize INTEGER, FileModifiedNs INTEGER, SampleHash TEXT, ImportedAt TEXT)')
+    db.commit()
+
+def save_fingerprint(db, table_name, path, fingerprint):
+    '''Records that table_name was imported from the file at path, with its fingerprint'''
+    create_fingerprints_table(db)
+    imported_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    db.execute(f'INSERT OR REPLACE INTO "{IMPORTED_FILES_TABLE}" VALUES (?,?,?,?,?,?)',
+               (table_name, os.path.abspath(path), *fingerprint, imported_at))
+    db.commit()
+
+def forget_fingerprint(db, table_name):
+    '''Call before re-importing table_name, so an interrupted import is not reused'''
+    try:
+        db.execute(f'DELETE FROM "{IMPORTED_FILES_TABLE}" WHERE TableName=?', (table_name,))
+        db.commit()
+    except sqlite3.OperationalError: # no such table
+        pass
@@ -0,0 +1,177 @@
+"""
+(c) 2024 CyberCX
+
+Disk backed parent lookup, for volumes whose MFT is too large for the
+in memory ParentLookup (--lookup_memory).
+
+SpillingParentLookup keeps the { Entry : (EntryName, ParentEntry, ParentName) }
+records in an SQLite file, with a bounded LRU of recently used records
+in front of it, and the resolved path cache of ParentLookup limited to
+fit the same memory budget. Writes (renames and deletes during the
+rewind) go to both, so the file is always up to date. Building it from
+the MFT is done in SQL, without holding the MFT in memory.
+
+The file is a scratch file, removed by close(). The lookup can not be
+pickled, so the rewind runs without shards when it is used.
+
+License : MIT
+
+"""
+import collections
+import itertools
+import os
+import sqlite3
+import tempfile
+
+from path_resolver import make_key, ParentLookup
+
+BATCH_SIZE = 50000
+
+# Rough memory per item (bytes) of the LRU records, the budget is split
+# between them, the path cache and the SQLite page cache.
+RECORD_BYTES = 250
+RECORDS_SHARE = 0.4
+PATHS_SHARE = 0.4
+SQLITE_CACHE_SHARE = 0.2
+
+class SpillingParentLookup(ParentLookup):
+    '''
+        A ParentLookup (same interface) whose records are kept in an SQLite
+        file in temp_folder, using about memory_mb of memory for the LRU of
+        records, the path cache and the SQLite page cache. Names are kept
+        as strings rather than as ids into a name table.
+    '''
+    def __init__(self, temp_folder, memory_mb=256):
+        max_records = int(memory_mb * 1024 * 1024 * RECORDS_SHARE / RECORD_BYTES)
+        super().__init__(int(memory_mb * 1024 * 1024 * PATHS_SHARE))
+        self.max_records = max(1000, max_records)
+        self._records = collections.OrderedDict() # { Entry : (EntryName, ParentEntry, ParentName) }, LRU
+        fd, self.db_path = tempfile.mkstemp(suffix='.lookup.sqlite', dir=temp_folder)
+        os.close(fd)
+        self._db = sqlite3.connect(self.db_path)
+        self._db.execute('PRAGMA journal_mode=OFF')
+        self._db.execute('PRAGMA synchronous=OFF')
+        self._db.execute(f'PRAGMA cache_size=-{max(2048, int(memory_mb * 1024 * SQLITE_CACHE_SHARE))}')
+        self._db.execute('CREATE TABLE Lookup (EntryKey INTEGER PRIMARY KEY, Name TEXT, ParentKey INTEGER, ParentName TEXT)')
+
+    def __getstate__(self):
+        raise TypeError('SpillingParentLookup can not be pickled')
+
+    def close(self):
+        '''Closes and removes the lookup file'''
+        if self._db is None:
+            return
+        self._db.close()
+        self._db = None
+        self._records.clear()
+        self.clear_cache()
+        try:
+            os.remove(self.db_path)
+        except OSError as ex:
+            print(f'[!] Failed to remove temp file : {self.db_path} Error was:', str(ex))
+
+    def _add_name(self, name):
+        return '' if name is None else str(name)
+
+    def _name(self, name):
+        return name
+
+    def _record(self, key):
+        '''Returns (EntryName, ParentEntry, ParentName) for key or None'''
+        records = self._records
+        record = records.get(key)
+        if record is not None:
+            records.move_to_end(key)
+            return record
+        record = self._db.execute('SELECT Name, ParentKey, ParentName FROM Lookup WHERE EntryKey=?', (key,)).fetchone()
+        if record is not None:
+            self._remember(key, record)
+        return record
+
+    def _remember(self, key, record):
+        '''Puts record in the LRU as the most recently used, evicting the oldest if it is full'''
+        records = self._records
+        records[key] = record
+        records.move_to_end(key)
+        while len(records) > self.max_records:
+            records.popitem(last=False) # it is in the file too
+
+    def __setitem__(self, key, value):
+        file_name, parent_key, parent_name = value
+        record = (self._add_name(file_name), parent_key, self._add_name(parent_name))
+        if self._record(key) is None:
+            self._count += 1
+        self._db.execute('INSERT OR REPLACE INTO Lookup VALUES (?,?,?,?)', (key, *record))
+        self._remember(key, record)
+        self.invalidate(key)
+
+    def __iter__(self):
+        for (key,) in self._db.execute('SELECT EntryKey FROM Lookup'):
+            yield key
+
+    def items(self):
+        for key, name, parent_key, parent_name in self._db.execute('SELECT * FROM Lookup'):
+            yield key, (name, parent_key, parent_name)
+
+    def load_mft_records(self, mft_records):
+        '''
+            Adds the entries of mft_records by the same rules as
+            ParentLookup.load_mft_records() (see build_parent_lookup), with
+            the MFT staged in the lookup file instead of in memory.
+        '''
+        db = self._db
+        # { EntryNumber : (SequenceNumber, InUse, FileName) } of all rows, and the rows to add
+        db.execute('CREATE TABLE Entries (EntryNumber INTEGER PRIMARY KEY, SequenceNumber INTEGER, '
+                   'InUse INTEGER, FileName TEXT)')
+        db.execute('CREATE TABLE Records (EntryNumber INTEGER, SequenceNumber INTEGER, InUse INTEGER, '
+                   'ParentEntryNumber INTEGER, ParentSequenceNumber INTEGER, FileName TEXT)')
+        mft_records = iter(mft_records)
+        while True:
+            names, ads_names, records = [], [], []
+            for entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, file_name in \
+                    itertools.islice(mft_records, BATCH_SIZE):
+                # prefer the real file name over ADS names for the same entry
+                is_ads = ':' in file_name
+                (ads_names if is_ads else names).append((entry_num, seq_num, in_use, file_name))
+                if is_ads or in_use is None:
+                    continue
+                if parent_seq_num < 0:
+                    # Older MFTECmd (fixed on 9 Mar 2024) wrote these as signed values
+                    parent_seq_num &= 65535
+                records.append((entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, file_name))
+            if not names and not ads_names:
+                break
+            # A real name replaces any earlier name, an ADS name is only kept if there is none
+            db.executemany('INSERT OR REPLACE INTO Entries VALUES (?,?,?,?)', names)
+            db.executemany('INSERT OR IGNORE INTO Entries VALUES (?,?,?,?)', ads_names)
+            db.executemany('INSERT INTO Records VALUES (?,?,?,?,?,?)', records)
+
+        cursor = db.execute('''
+            SELECT r.EntryNumber, r.SequenceNumber, r.InUse, r.ParentEntryNumber, r.ParentSequenceNumber,
+                r.FileName, e.SequenceNumber, e.InUse, IFNULL(e.FileName, '')
+            FROM Records r LEFT JOIN Entries e ON e.EntryNumber = r.ParentEntryNumber
+            ORDER BY r.rowid
+        ''')
+        insert_cursor = db.cursor()
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            lookup_rows = []
+            for entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, file_name, \
+                    parent_seq, parent_in_use, parent_name in rows:
+                parent_key = make_key(parent_entry_num, parent_seq_num)
+                if in_use:
+                    if parent_seq != parent_seq_num:
+                        parent_name = ''
+                    lookup_rows.append((make_key(entry_num, seq_num), file_name, parent_key, parent_name))
+                elif (parent_in_use == 1 and parent_seq == parent_seq_num) or \
+                     (parent_in_use == 0 and parent_seq == parent_seq_num + 1):
+                    lookup_rows.append((make_key(entry_num, seq_num - 1), file_name, parent_key, parent_name))
+            # Later rows for the same key replace earlier ones, as in ParentLookup
+            insert_cursor.executemany('INSERT OR REPLACE INTO Lookup VALUES (?,?,?,?)', lookup_rows)
+        db.execute('DROP TABLE Entries')
+        db.execute('DROP TABLE Records')
+        self._count = db.execute('SELECT COUNT(*) FROM Lookup').fetchone()[0]
+        self._records.clear()
+        self.clear_cache()
@@ -0,0 +1,182 @@
+"""
+(c) 2024 CyberCX
+
+Run metrics for usnjrnl_rewind: phase timers with rows/sec, periodic
+progress with an ETA, aggregated statistics of rows whose path could not
+be resolved, and peak memory. Collected in a RunMetrics object, which
+can be saved as JSON (--metrics_json) for monitoring long runs.
+
+License : MIT
+
+"""
+import contextlib
+import cProfile
+import json
+import pstats
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+PROGRESS_INTERVAL = 10 # seconds between progress lines
+MAX_UNKNOWN_SAMPLES = 10
+
+def peak_rss_mb():
+    '''Peak resident memory (MB) of this process and its (finished) children, None if unknown'''
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def format_duration(seconds):
+    '''Returns seconds as H:MM:SS'''
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}'
+
+class UnknownPathStats:
+    '''
+        Counts the journal rows whose parent could not be found in the
+        lookup, keeping the first few USNs and the parent entries that
+        were missing most often.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.samples = []       # UpdateSequenceNumber of the first rows
+        self.parents = {}       # { ParentEntry key : rows }
+
+    def add(self, update_seq_number, parent_entry):
+        self.count += 1
+        if len(self.samples) < MAX_UNKNOWN_SAMPLES:
+            self.samples.append(update_seq_number)
+        self.parents[parent_entry] = self.parents.get(parent_entry, 0) + 1
+
+    def merge(self, other):
+        '''Adds the counts of other (eg. from a worker process)'''
+        self.count += other.count
+        self.samples.extend(other.samples[:MAX_UNKNOWN_SAMPLES - len(self.samples)])
+        for parent_entry, count in other.parents.items():
+            self.parents[parent_entry] = self.parents.get(parent_entry, 0) + count
+
+    def top_parents(self, num=MAX_UNKNOWN_SAMPLES):
+        '''Returns [ ('Entry-Seq', rows), .. ] for the most often missing parents'''
+        top = sorted(self.parents.items(), key=lambda item: item[1], reverse=True)[:num]
+        return [ (f'{key >> 16}-{key & 0xFFFF}', count) for key, count in top ]
+
+    def to_dict(self):
+        return { 'rows' : self.count, 'distinct_parents' : len(self.parents), 'first_usns' : self.samples,
+                 'top_parents' : self.top_parents() }
+
+    def print_summary(self):
+        if not self.count:
+            return
+        print(f'[!] {self.count} rows had an UNKNOWN parent path (from {len(self.parents)} missing parents), '
+               'report this to the developer!')
+        print(f'[!]   First rows, update_seq_number={", ".join(str(usn) for usn in self.samples)}')
+        print(f'[!]   Most missed parents: {", ".join(f"{entry} ({count})" for entry, count in self.top_parents(5))}')
+
+class Progress:
+    '''
+        Prints a progress line (with an ETA if total is known) at most
+        every interval seconds. Call update() with the number of rows done.
+    '''
+    def __init__(self, name, total=None, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.rows = 0
+        self.start_time = time.perf_counter()
+        self._next_time = self.start_time + interval
+
+    def update(self, rows):
+        self.rows += rows
+        now = time.perf_counter()
+        if now < self._next_time:
+            return
+        self._next_time = now + self.interval
+        elapsed = now - self.start_time
+        rate = self.rows / elapsed if elapsed > 0 else 0
+        text = f'[.] {self.name}: {self.rows} rows'
+        if self.total:
+            text += f' of {self.total} ({min(100, self.rows * 100 // self.total)}%)'
+        text += f', {int(rate)} rows/sec'
+        if self.total and rate > 0 and self.rows < self.total:
+            text += f', ETA {format_duration((self.total - self.rows) / rate)}'
+        print(text, flush=True)
+
+class RunMetrics:
+    '''Phase timings, counters and memory use of a run'''
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phases = []
+        self.stage_stats = []
+        self.unknown_paths = UnknownPathStats()
+        self.info = {} # anything else to report, eg. input file names
+        self.profile_path = None # if set, profile() saves cProfile stats here
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Times the with block as phase name. Set 'rows' on the yielded dict for a rows/sec.'''
+        result = { 'name' : name, 'rows' : None }
+        start_time = time.perf_counter()
+        try:
+            yield result
+        finally:
+            seconds = time.perf_counter() - start_time
+            result['seconds'] = round(seconds, 3)
+            result['rows_per_sec'] = int(result['rows'] / seconds) if result['rows'] and seconds > 0 else None
+            result['peak_rss_mb'] = peak_rss_mb()
+            self.phases.append(result)
+
+    @contextlib.contextmanager
+    def profile(self):
+        '''
+            Runs the with block under cProfile if profile_path is set, saving
+            the stats there (for pstats, snakeviz etc.) and printing the top
+            functions. Only the calling thread is profiled.
+        '''
+        if not self.profile_path:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(self.profile_path)
+            print(f'[.] Profile saved to {self.profile_path}, top functions by cumulative time:')
+            pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(15)
+
+    def to_dict(self):
+        return {
+            'info' : self.info,
+            'total_seconds' : round(time.perf_counter() - self.start_time, 3),
+            'peak_rss_mb' : peak_rss_mb(),
+            'phases' : self.phases,
+            'pipeline_stages' : [ { 'name' : stats.name, 'rows' : stats.rows, 'batches' : stats.batches,
+                                    'busy_seconds' : round(stats.busy_time, 3),
+                                    'wait_seconds' : round(stats.wait_time, 3),
+                                    'rows_per_sec' : stats.rows_per_sec() } for stats in self.stage_stats ],
+            'unknown_paths' : self.unknown_paths.to_dict()
+        }
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def print_summary(self):
+        print('[.] Phases:')
+        for phase in self.phases:
+            text = f'[.]   {phase["name"]:<12}: {format_duration(phase["seconds"])} ({phase["seconds"]:.1f} s)'
+            if phase['rows_per_sec']:
+                text += f', {phase["rows"]} rows at {phase["rows_per_sec"]} rows/sec'
+            print(text)
+        peak = peak_rss_mb()
+        if peak is not None:
+            print(f'[.] Peak memory use: {peak} MB')
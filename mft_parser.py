@@ -0,0 +1,211 @@
+"""
+(c) 2024 CyberCX
+
+Parser for a raw $MFT file, so that the parent lookup can be built
+straight from the MFT instead of needing the MFTECmd csv of it.
+
+Only what the rewind needs is read from each FILE record; the entry and
+sequence numbers, the in use flag and the $FILE_NAME attributes, of which
+the Win32 name is preferred over the POSIX and DOS (8.3) names. The update
+sequence (fixup) array is applied to each record before it is read.
+
+The file is mmap'ed and split into ranges of RECORDS_PER_CHUNK records,
+which are parsed by a process pool. Extension records (those with a base
+record reference) are skipped, the names in them are of the base record,
+which almost always holds a $FILE_NAME itself.
+
+License : MIT
+
+"""
+import collections
+import mmap
+import os
+import struct
+
+from concurrent.futures import ProcessPoolExecutor
+
+# Same columns (and order) as read_mft_csv() and mft_records() return,
+# and as build_parent_lookup() expects
+MFT_RECORD_FIELDS = ('EntryNumber', 'SequenceNumber', 'InUse', 'ParentEntryNumber',
+                     'ParentSequenceNumber', 'FileName')
+
+# Signature, UsaOffset, UsaCount, LogFileSequenceNumber, SequenceNumber, LinkCount,
+# FirstAttributeOffset, Flags, UsedSize, AllocatedSize, BaseRecordReference
+FILE_RECORD_HEADER = struct.Struct('<4sHHQHHHHIIQ')
+# Type, Length, NonResident, NameLength, NameOffset, Flags, AttributeId, ContentLength, ContentOffset
+RESIDENT_ATTRIBUTE_HEADER = struct.Struct('<IIBBHHHIH')
+# ParentReference (the rest of $FILE_NAME is read by offset below)
+FILE_NAME_PARENT = struct.Struct('<Q')
+FILE_NAME_NAME_OFFSET = 0x42 # name length (chars) and namespace are the 2 bytes before it
+
+ATTRIBUTE_FILE_NAME = 0x30
+ATTRIBUTE_END = 0xFFFFFFFF
+FLAG_IN_USE = 0x0001
+SECTOR_SIZE = 512 # fixups are applied to every 512 bytes, whatever the disk's sector size
+DEFAULT_RECORD_SIZE = 1024
+ENTRY_MASK = 0xFFFFFFFFFFFF
+RECORDS_PER_CHUNK = 65536
+
+# Namespace of a $FILE_NAME -> preference, higher is better
+NAMESPACE_RANK = { 1 : 3,   # Win32
+                   3 : 3,   # Win32 & DOS (name is both)
+                   0 : 2,   # POSIX
+                   2 : 1 }  # DOS
+
+class MftStats:
+    def __init__(self):
+        self.records = 0     # FILE records read (not counting extension records)
+        self.bad_records = 0 # BAAD records, failed fixups or broken attributes
+
+def is_raw_mft(path):
+    '''True if the file at path looks like a raw $MFT, rather than a csv'''
+    with open(path, 'rb') as f:
+        return f.read(4) == b'FILE'
+
+def get_record_size(path):
+    '''Record size from the header of the first record ($MFT itself)'''
+    with open(path, 'rb') as f:
+        data = f.read(FILE_RECORD_HEADER.size)
+    if len(data) == FILE_RECORD_HEADER.size:
+        allocated_size = FILE_RECORD_HEADER.unpack(data)[9]
+        # a power of 2, usually 1024 or 4096
+        if allocated_size >= SECTOR_SIZE and allocated_size & (allocated_size - 1) == 0:
+            return allocated_size
+    return DEFAULT_RECORD_SIZE
+
+def apply_fixups(record, usa_offset, usa_count):
+    '''
+        Puts back the original last 2 bytes of each sector of record (a
+        bytearray) from the update sequence array. Returns False if the
+        record is torn (a sector does not end with the update sequence number).
+    '''
+    num_sectors = usa_count - 1
+    if num_sectors <= 0 or num_sectors * SECTOR_SIZE > len(record) or usa_offset + 2 * usa_count > SECTOR_SIZE:
+        return False
+    usn = record[usa_offset:usa_offset + 2]
+    for i in range(num_sectors):
+        end = (i + 1) * SECTOR_SIZE
+        if record[end - 2:end] != usn:
+            return False
+        fixup = usa_offset + 2 * (i + 1)
+        record[end - 2:end] = record[fixup:fixup + 2]
+    return True
+
+def parse_file_record(record):
+    '''
+        Returns (SequenceNumber, InUse, ParentEntryNumber, ParentSequenceNumber,
+        FileName) for record (a bytearray with fixups applied), using the
+        preferred $FILE_NAME. Returns None if the record has no $FILE_NAME,
+        and raises ValueError (or struct.error) if it is broken.
+    '''
+    _, _, _, _, seq_num, _, attribute_offset, flags, used_size, _, _ = FILE_RECORD_HEADER.unpack_from(record)
+    end = min(used_size, len(record))
+    best = None
+    best_rank = 0
+    pos = attribute_offset
+    while pos + 8 <= end:
+        attribute_type, length, non_resident, _, _, _, _, content_length, content_offset = \
+            RESIDENT_ATTRIBUTE_HEADER.unpack_from(record, pos)
+        if attribute_type == ATTRIBUTE_END:
+            break
+        if length < RESIDENT_ATTRIBUTE_HEADER.size or pos + length > end:
+            raise ValueError('Bad attribute length')
+        if attribute_type == ATTRIBUTE_FILE_NAME and not non_resident:
+            if content_offset + content_length > length:
+                raise ValueError('Bad attribute content')
+            content = pos + content_offset
+            name_length = record[content + FILE_NAME_NAME_OFFSET - 2]
+            rank = NAMESPACE_RANK.get(record[content + FILE_NAME_NAME_OFFSET - 1], 0)
+            if rank > best_rank and FILE_NAME_NAME_OFFSET + 2 * name_length <= content_length:
+                best = content, name_length
+                best_rank = rank
+                if rank == 3:
+                    break
+        elif attribute_type > ATTRIBUTE_FILE_NAME:
+            break # attributes are sorted by type
+        pos += length
+    if best is None:
+        return None
+    content, name_length = best
+    parent_ref = FILE_NAME_PARENT.unpack_from(record, content)[0]
+    name_start = content + FILE_NAME_NAME_OFFSET
+    name = record[name_start:name_start + 2 * name_length].decode('utf-16-le', 'replace')
+    return seq_num, bool(flags & FLAG_IN_USE), parent_ref & ENTRY_MASK, parent_ref >> 48, name
+
+def parse_record_range(path, first_entry, last_entry, record_size):
+    '''
+        Parses the records first_entry up to (not including) last_entry of
+        the $MFT at path. Returns (rows, records, bad_records), where rows
+        is a list of tuples in MFT_RECORD_FIELDS order.
+    '''
+    rows = []
+    records = 0
+    bad_records = 0
+    unpack_header = FILE_RECORD_HEADER.unpack_from
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for entry_num in range(first_entry, last_entry):
+                pos = entry_num * record_size
+                signature, usa_offset, usa_count, _, _, _, _, _, _, _, base_ref = unpack_header(mm, pos)
+                if signature != b'FILE':
+                    if signature != b'\x00\x00\x00\x00': # never used records are all zeros
+                        bad_records += 1
+                    continue
+                if base_ref & ENTRY_MASK:
+                    continue # extension record
+                record = bytearray(mm[pos:pos + record_size])
+                if not apply_fixups(record, usa_offset, usa_count):
+                    bad_records += 1
+                    continue
+                try:
+                    parsed = parse_file_record(record)
+                except (ValueError, IndexError, struct.error):
+                    bad_records += 1
+                    continue
+                records += 1
+                if parsed:
+                    seq_num, in_use, parent_entry_num, parent_seq_num, name = parsed
+                    rows.append((entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, name))
+        finally:
+            mm.close()
+    return rows, records, bad_records
+
+def iter_mft_records(path, num_workers=1, stats=None):
+    '''
+        Generator, yields a tuple (MFT_RECORD_FIELDS order) for each FILE
+        record with a $FILE_NAME in the raw $MFT at path, in entry order,
+        with numbers as int and InUse as bool. Ranges of records are parsed
+        by a process pool of num_workers. Counts go in stats (an MftStats)
+        if given.
+    '''
+    if stats is None:
+        stats = MftStats()
+    record_size = get_record_size(path)
+    num_records = os.path.getsize(path) // record_size
+    ranges = [(start, min(start + RECORDS_PER_CHUNK, num_records))
+                for start in range(0, num_records, RECORDS_PER_CHUNK)]
+
+    def add_stats(result):
+        rows, records, bad_records = result
+        stats.records += records
+        stats.bad_records += bad_records
+        return rows
+
+    if num_workers <= 1 or len(ranges) <= 1:
+        for first_entry, last_entry in ranges:
+            yield from add_stats(parse_record_range(path, first_entry, last_entry, record_size))
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = collections.deque()
+        try:
+            for first_entry, last_entry in ranges:
+                pending.append(executor.submit(parse_record_range, path, first_entry, last_entry, record_size))
+                if len(pending) >= 2 * num_workers:
+                    yield from add_stats(pending.popleft().result())
+            while pending:
+                yield from add_stats(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
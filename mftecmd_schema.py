@@ -0,0 +1,161 @@
+"""
+(c) 2024 CyberCX
+
+Known column layout of the MFTECmd $MFT and $J csv output, used to
+create typed MFT and USNJRNL tables instead of guessing column types
+from the first row of data.
+
+  - Booleans (True/False) are stored as INTEGER 1/0
+  - Timestamps are stored as INTEGER ticks (100ns intervals since 1601,
+    ie. a FILETIME), which sort correctly and are half the size. Values
+    not in the MFTECmd format are kept as they are.
+  - EntryKey and ParentEntryKey hold the packed (Entry << 16 | Seq)
+    key also used by path_resolver.
+
+The USNJRNL_FullPaths output keeps UpdateTimestamp as the MFTECmd text,
+as in the csv, so that queries written against earlier versions (which
+compare it with strings) still work.
+
+License : MIT
+
+"""
+from datetime import date, datetime, timedelta
+
+from csv_to_sqlite import TableSchema
+from path_resolver import make_key
+
+EPOCH_1601 = datetime(1601, 1, 1)
+EPOCH_1601_ORDINAL = EPOCH_1601.toordinal()
+TICKS_PER_SECOND = 10000000
+
+# MFTECmd writes timestamps as 'yyyy-MM-dd HH:mm:ss.fffffff'
+TIMESTAMP_LEN = 27
+
+_seconds_to_ticks = {} # { 'yyyy-MM-dd HH:mm:ss' : ticks }
+_ticks_to_seconds = {} # { seconds : 'yyyy-MM-dd HH:mm:ss' }
+MAX_CACHED_SECONDS = 200000
+
+def timestamp_to_ticks(value):
+    '''
+        Converts an MFTECmd timestamp string to FILETIME ticks.
+        Returns value as is if it is not in the expected format.
+    '''
+    if not isinstance(value, str) or len(value) != TIMESTAMP_LEN or value[19] != '.':
+        return value
+    fraction = value[20:]
+    if not fraction.isdigit():
+        return value
+    seconds = value[:19]
+    ticks = _seconds_to_ticks.get(seconds)
+    if ticks is None:
+        if value[4] != '-' or value[7] != '-' or value[10] != ' ' or value[13] != ':' or value[16] != ':':
+            return value
+        try:
+            day = date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal()
+            hour, minute, second = int(value[11:13]), int(value[14:16]), int(value[17:19])
+        except ValueError:
+            return value
+        if hour > 23 or minute > 59 or second > 59:
+            return value
+        ticks = ((day - EPOCH_1601_ORDINAL) * 86400 + hour * 3600 + minute * 60 + second) * TICKS_PER_SECOND
+        if len(_seconds_to_ticks) >= MAX_CACHED_SECONDS:
+            _seconds_to_ticks.clear()
+        _seconds_to_ticks[seconds] = ticks
+    return ticks + int(fraction)
+
+def ticks_to_timestamp(value):
+    '''
+        Converts FILETIME ticks back to the MFTECmd timestamp string.
+        Anything that is not an int is returned as is.
+    '''
+    if not isinstance(value, int):
+        return value
+    seconds, fraction = divmod(value, TICKS_PER_SECOND)
+    text = _ticks_to_seconds.get(seconds)
+    if text is None:
+        try:
+            dt = EPOCH_1601 + timedelta(seconds=seconds)
+        except OverflowError:
+            return value
+        text = f'{dt.year:04}-{dt.month:02}-{dt.day:02} {dt.hour:02}:{dt.minute:02}:{dt.second:02}'
+        if len(_ticks_to_seconds) >= MAX_CACHED_SECONDS:
+            _ticks_to_seconds.clear()
+        _ticks_to_seconds[seconds] = text
+    return f'{text}.{fraction:07}'
+
+def bool_to_int(value):
+    if value == 'True':
+        return 1
+    if value == 'False':
+        return 0
+    return value
+
+def entry_key(entry_num, seq_num):
+    '''Packed key, or None if the numbers are not valid'''
+    try:
+        entry_num = int(entry_num)
+        if entry_num < 0:
+            return None
+        return make_key(entry_num, int(seq_num))
+    except (TypeError, ValueError):
+        return None
+
+INTEGER = ('INTEGER', None)
+BOOLEAN = ('INTEGER', bool_to_int)
+TIMESTAMP = ('INTEGER', timestamp_to_ticks)
+TIMESTAMP_TEXT = ('TEXT', ticks_to_timestamp)
+
+ENTRY_KEY_COLUMNS = [
+    ('EntryKey', 'INTEGER', entry_key, ['EntryNumber', 'SequenceNumber']),
+    ('ParentEntryKey', 'INTEGER', entry_key, ['ParentEntryNumber', 'ParentSequenceNumber'])
+]
+
+MFT_SCHEMA = TableSchema({
+        'EntryNumber'           : INTEGER,
+        'SequenceNumber'        : INTEGER,
+        'InUse'                 : BOOLEAN,
+        'ParentEntryNumber'     : INTEGER,
+        'ParentSequenceNumber'  : INTEGER,
+        'FileSize'              : INTEGER,
+        'ReferenceCount'        : INTEGER,
+        'IsDirectory'           : BOOLEAN,
+        'HasAds'                : BOOLEAN,
+        'IsAds'                 : BOOLEAN,
+        'SI<FN'                 : BOOLEAN,
+        'uSecZeros'             : BOOLEAN,
+        'Copied'                : BOOLEAN,
+        'FnAttributeId'         : INTEGER,
+        'OtherAttributeId'      : INTEGER,
+        'Created0x10'           : TIMESTAMP,
+        'Created0x30'           : TIMESTAMP,
+        'LastModified0x10'      : TIMESTAMP,
+        'LastModified0x30'      : TIMESTAMP,
+        'LastRecordChange0x10'  : TIMESTAMP,
+        'LastRecordChange0x30'  : TIMESTAMP,
+        'LastAccess0x10'        : TIMESTAMP,
+        'LastAccess0x30'        : TIMESTAMP,
+        'UpdateSequenceNumber'  : INTEGER,
+        'LogfileSequenceNumber' : INTEGER,
+        'SecurityId'            : INTEGER
+    },
+    ENTRY_KEY_COLUMNS,
+    [ ['EntryNumber', 'SequenceNumber'] ])
+
+USN_SCHEMA = TableSchema({
+        'EntryNumber'           : INTEGER,
+        'SequenceNumber'        : INTEGER,
+        'ParentEntryNumber'     : INTEGER,
+        'ParentSequenceNumber'  : INTEGER,
+        'UpdateSequenceNumber'  : INTEGER,
+        'UpdateTimestamp'       : TIMESTAMP,
+        'OffsetToData'          : INTEGER
+    },
+    ENTRY_KEY_COLUMNS,
+    [ ['UpdateTimestamp', 'UpdateSequenceNumber'] ])
+
+# Same columns as USNJRNL (plus ParentPath), but with the timestamp as text, no indexes needed
+USN_FULLPATHS_COLUMN_TYPES = dict(USN_SCHEMA.column_types, UpdateTimestamp=TIMESTAMP_TEXT)
+USN_FULLPATHS_SCHEMA = TableSchema(USN_FULLPATHS_COLUMN_TYPES, ENTRY_KEY_COLUMNS)
+
+# Normalized output, ParentPath is replaced by ParentPathId (see output_sinks.SqliteSink)
+USN_FULLPATHS_NORMALIZED_SCHEMA = TableSchema(dict(USN_FULLPATHS_COLUMN_TYPES, ParentPathId=INTEGER), ENTRY_KEY_COLUMNS)
@@ -0,0 +1,230 @@
+"""
+(c) 2024 CyberCX
+
+Output sinks for the rows produced by the journal rewind. The rewind
+loop hands each batch of rows to every sink, so the same pass can write
+the full path csv, the USNJRNL_FullPaths table, or both.
+
+License : MIT
+
+"""
+import csv
+import queue
+import sqlite3
+import threading
+
+from csv_to_sqlite import create_table, table_exists
+from mftecmd_schema import ticks_to_timestamp, USN_FULLPATHS_NORMALIZED_SCHEMA, USN_FULLPATHS_SCHEMA
+
+OUTPUT_FIELDS = ('Name', 'Extension', 'EntryNumber', 'SequenceNumber', 'ParentEntryNumber',
+                 'ParentSequenceNumber', 'ParentPath', 'UpdateSequenceNumber', 'UpdateTimestamp',
+                 'UpdateReasons', 'FileAttributes', 'OffsetToData', 'SourceFile')
+TIMESTAMP_INDEX = OUTPUT_FIELDS.index('UpdateTimestamp')
+PARENT_PATH_INDEX = OUTPUT_FIELDS.index('ParentPath')
+
+PARENT_PATHS_TABLE = 'ParentPaths'
+NORMALIZED_SUFFIX = '_Normalized'
+
+WRITE_BATCH_SIZE = 50000
+
+class CsvSink:
+    '''
+        Writes rows (tuples in OUTPUT_FIELDS order) to a csv file.
+        UpdateTimestamp is written in the MFTECmd format if the row has it
+        as ticks (as read from the typed USNJRNL table). If resume_offset
+        is given (a flush() position of an earlier run), the existing file
+        is cut back to it and the rows are appended.
+    '''
+    def __init__(self, out_csv_path, resume_offset=None):
+        self.path = out_csv_path
+        self.rows_written = 0
+        if resume_offset is None:
+            self._file = open(out_csv_path, 'w', encoding='utf8', newline='', buffering=50000)
+        else:
+            with open(out_csv_path, 'r+b') as f:
+                f.truncate(resume_offset)
+            self._file = open(out_csv_path, 'a', encoding='utf8', newline='', buffering=50000)
+        self._writer = csv.writer(self._file)
+        if resume_offset is None:
+            self._writer.writerow(OUTPUT_FIELDS)
+
+    def write(self, rows):
+        ts_index = TIMESTAMP_INDEX
+        self._writer.writerows(
+            [row[:ts_index] + (ticks_to_timestamp(row[ts_index]),) + row[ts_index + 1:]
+                if isinstance(row[ts_index], int) else row
+             for row in rows])
+        self.rows_written += len(rows)
+
+    def flush(self):
+        '''Writes out the rows so far, returns the file size, to resume from'''
+        self._file.flush()
+        return self._file.buffer.tell()
+
+    def close(self):
+        self._file.close()
+
+def drop_table_or_view(db, name):
+    '''Drops the table or view called name, if there is one'''
+    row = db.execute('SELECT type FROM sqlite_master WHERE name=? AND type IN ("table", "view")', (name,)).fetchone()
+    if row:
+        db.execute(f'DROP {row[0].upper()} "{name}"')
+
+class SqliteSink:
+    '''
+        Inserts rows (tuples in OUTPUT_FIELDS order) into a new table,
+        typed as per schema, replacing any existing table of that name.
+        Inserts are batched with executemany on a writer thread, with its
+        own connection, so they overlap with the rewind. If the database is
+        also being read while writing, it should be in WAL mode.
+
+        If normalize_paths is set, each distinct ParentPath is stored once,
+        in the ParentPaths (PathId, Path) table, and the rows go in the
+        table_name + '_Normalized' table with a ParentPathId column instead.
+        table_name is then a view joining the two, with the same columns
+        as the flat table. Path ids are assigned from an in memory dict
+        of the paths seen so far.
+
+        If resume_rows is given (a flush() position of an earlier run with
+        the same settings), the existing table is kept, cut back to its
+        first resume_rows rows, and the rows are appended.
+    '''
+    def __init__(self, db_path, table_name, schema=None, max_queued_batches=4, normalize_paths=False,
+                 resume_rows=None):
+        self.db_path = db_path
+        self.table_name = table_name
+        self.normalize_paths = normalize_paths
+        if schema is None:
+            schema = USN_FULLPATHS_NORMALIZED_SCHEMA if normalize_paths else USN_FULLPATHS_SCHEMA
+        self.schema = schema
+        self.resume_rows = resume_rows
+        self._path_ids = {} # { ParentPath : PathId }
+        self.rows_written = 0 if resume_rows is None else resume_rows
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_queued_batches)
+        self._thread = threading.Thread(target=self._run, name=f'SqliteSink-{table_name}', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        db = None
+        try:
+            db = sqlite3.connect(self.db_path)
+            db.execute('PRAGMA synchronous=OFF')
+            headers = list(OUTPUT_FIELDS)
+            data_table_name = self.table_name
+            if self.normalize_paths:
+                headers[PARENT_PATH_INDEX] = 'ParentPathId'
+                data_table_name = self.table_name + NORMALIZED_SUFFIX
+            columns_info, convert_row = self.schema.prepare(headers)
+            if self.resume_rows is None:
+                # Remove the output of an earlier run, in either layout
+                for name in (self.table_name, self.table_name + NORMALIZED_SUFFIX, PARENT_PATHS_TABLE):
+                    drop_table_or_view(db, name)
+                if self.normalize_paths:
+                    db.execute(f'CREATE TABLE "{PARENT_PATHS_TABLE}" (PathId INTEGER PRIMARY KEY, Path TEXT)')
+                if not create_table(db, data_table_name, columns_info, True):
+                    raise sqlite3.OperationalError(f'Could not create table {data_table_name}')
+            else:
+                self._resume(db, data_table_name)
+            query = f'INSERT INTO "{data_table_name}" VALUES (?' + ',?'*(len(columns_info) - 1) + ')'
+            paths_query = f'INSERT INTO "{PARENT_PATHS_TABLE}" VALUES (?,?)'
+            while True:
+                rows = self._queue.get()
+                if rows is None:
+                    break
+                if isinstance(rows, threading.Event): # flush()
+                    db.commit()
+                    rows.set()
+                    continue
+                if self.normalize_paths:
+                    rows, new_paths = self._replace_paths(rows)
+                    db.executemany(paths_query, new_paths)
+                db.executemany(query, [convert_row(list(row)) for row in rows])
+                self.rows_written += len(rows)
+            if self.normalize_paths:
+                self._create_view(db, columns_info, data_table_name)
+            db.commit()
+        except (sqlite3.Error, OverflowError) as ex:
+            self.error = ex
+            # Keep consuming so that write() never blocks on a full queue
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+        finally:
+            if db:
+                db.close()
+
+    def _resume(self, db, data_table_name):
+        '''Cuts the tables of an earlier run back to resume_rows rows, and reloads the path ids'''
+        if not table_exists(db, data_table_name):
+            raise sqlite3.OperationalError(f'No table {data_table_name} to resume')
+        db.execute(f'DELETE FROM "{data_table_name}" WHERE rowid > ?', (self.resume_rows,))
+        if self.normalize_paths:
+            drop_table_or_view(db, self.table_name) # the view is created again at the end
+            # Path ids are given out in row order, so those of the rows cut off are the highest
+            db.execute(f'DELETE FROM "{PARENT_PATHS_TABLE}" WHERE PathId > '
+                       f'(SELECT IFNULL(MAX(ParentPathId), 0) FROM "{data_table_name}")')
+            self._path_ids = { path : path_id for path_id, path in 
+                               db.execute(f'SELECT PathId, Path FROM "{PARENT_PATHS_TABLE}"') }
+
+    def _replace_paths(self, rows):
+        '''Returns rows with ParentPath replaced by its id, and [ (PathId, Path), .. ] for new paths'''
+        path_ids = self._path_ids
+        new_paths = []
+        out_rows = []
+        for row in rows:
+            path = row[PARENT_PATH_INDEX]
+            path_id = path_ids.get(path)
+            if path_id is None:
+                path_id = len(path_ids) + 1
+                path_ids[path] = path_id
+                new_paths.append((path_id, path))
+            out_rows.append(row[:PARENT_PATH_INDEX] + (path_id,) + row[PARENT_PATH_INDEX + 1:])
+        return out_rows, new_paths
+
+    def _create_view(self, db, columns_info, data_table_name):
+        '''Creates the table_name view, with the columns of the flat (not normalized) table'''
+        columns = [ f'd."{name}"' for name, _ in columns_info ]
+        columns[PARENT_PATH_INDEX] = 'p.Path AS ParentPath'
+        db.execute(f'CREATE VIEW "{self.table_name}" AS SELECT {", ".join(columns)} '
+                   f'FROM "{data_table_name}" d LEFT JOIN "{PARENT_PATHS_TABLE}" p ON p.PathId = d.ParentPathId')
+
+    def write(self, rows):
+        if self.error:
+            raise sqlite3.OperationalError(f'Writing to table {self.table_name} failed: {self.error}')
+        self._queue.put(rows)
+
+    def flush(self):
+        '''Waits for the rows so far to be committed, returns the number of rows, to resume from'''
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        if self.error:
+            raise sqlite3.OperationalError(f'Writing to table {self.table_name} failed: {self.error}')
+        return self.rows_written
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self.error:
+            print(f'[!] Failed to write to table {self.table_name}, error was {self.error}')
+
+def write_to_sinks(rows, sinks, batch_size=WRITE_BATCH_SIZE):
+    '''Writes rows to every sink in batches of batch_size, then closes the sinks'''
+    try:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                for sink in sinks:
+                    sink.write(batch)
+                batch = []
+        if batch:
+            for sink in sinks:
+                sink.write(batch)
+    finally:
+        for sink in sinks:
+            sink.close()
@@ -0,0 +1,175 @@
+"""
+(c) 2024 CyberCX
+
+Parallel csv parser for very large MFTECmd csv files.
+
+The file is split into chunks of about chunk_size bytes that end on a
+record boundary, ie. a newline that is not inside a quoted field. As
+quotes inside a quoted field are escaped by doubling them, a newline is
+a record boundary if the number of quote characters before it is even,
+so boundaries are found with a single bytes.count() pass over the file
+and without parsing it. File names with embedded newlines (which are
+quoted) are handled correctly.
+
+Chunks are parsed by a process pool (each worker reads its own byte
+range of the file) and the rows are returned in file order.
+
+License : MIT
+
+"""
+import collections
+import csv
+import io
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+CHUNK_SIZE = 16 * 1024 * 1024 # 16 MB
+SCAN_BLOCK_SIZE = 8 * 1024 * 1024
+FIELD_SIZE_LIMIT = 5 * 1024 * 1024
+
+def iter_chunk_ranges(path, start=0, chunk_size=CHUNK_SIZE):
+    '''
+        Generator, yields (start, end) byte ranges of at least chunk_size
+        bytes (except the last one) covering the file from start to its
+        end, where each range ends on a record boundary. start must be at
+        a record boundary.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        quotes = 0 # quotes seen from start up to offset
+        chunk_start = start
+        target = start + chunk_size
+        while True:
+            block = f.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            pos = target - offset
+            if pos < len(block):
+                pos = max(pos, 0)
+                block_quotes = quotes + block.count(b'"', 0, pos)
+                while True:
+                    newline = block.find(b'\n', pos)
+                    if newline == -1:
+                        break
+                    block_quotes += block.count(b'"', pos, newline)
+                    pos = newline + 1
+                    if block_quotes % 2 == 0:
+                        yield chunk_start, offset + pos
+                        chunk_start = offset + pos
+                        target = chunk_start + chunk_size
+                        if target - offset >= len(block):
+                            break
+                        block_quotes += block.count(b'"', pos, target - offset)
+                        pos = target - offset
+            quotes += block.count(b'"')
+            offset += len(block)
+        if chunk_start < offset:
+            yield chunk_start, offset
+
+def _decode(data, strip_nulls, encoding):
+    if strip_nulls and b'\x00' in data:
+        data = data.translate(None, b'\x00')
+    # newline=None translates line endings just like reading the file in text mode
+    return io.StringIO(data.decode(encoding), newline=None)
+
+def read_header(path, delimiter=',', strip_nulls=True, encoding='utf-8-sig'):
+    '''Returns the header row of the csv file and the offset where the data rows start'''
+    ranges = iter_chunk_ranges(path, 0, 0)
+    _, data_start = next(ranges, (0, 0))
+    ranges.close()
+    with open(path, 'rb') as f:
+        data = f.read(data_start)
+    headers = next(csv.reader(_decode(data, strip_nulls, encoding), delimiter=delimiter), [])
+    return headers, data_start
+
+def parse_chunk(path, start, end, delimiter=',', strip_nulls=True, encoding='utf-8',
+                headers=None, schema=None, fields=None):
+    '''
+        Parses the rows in the byte range start:end of the csv file, which
+        must start and end on record boundaries. Returns a list of rows.
+          - schema : a TableSchema, rows are converted with it (as lists)
+          - fields : list of field names, rows are tuples of just those
+                     fields, and rows with too few columns are skipped
+    '''
+    csv.field_size_limit(FIELD_SIZE_LIMIT)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    reader = csv.reader(_decode(data, strip_nulls, encoding), delimiter=delimiter)
+    if fields:
+        indexes = [headers.index(name) for name in fields]
+        num_cols = max(indexes) + 1
+        return [tuple([row[i] for i in indexes]) for row in reader if len(row) >= num_cols]
+    if schema:
+        _, convert_row = schema.prepare(headers)
+        return [convert_row(row) for row in reader]
+    return list(reader)
+
+class ParallelCsvReader:
+    '''
+        Reads the rows of a csv file, parsing chunks of it in a process
+        pool of num_workers. Iterating gives the header row first, then
+        the data rows in file order (converted by schema, or restricted to
+        fields, see parse_chunk). Use batches() to get the data rows as
+        lists, as returned by the workers. Up to 2 * num_workers chunks are
+        held in memory at a time.
+
+        Files smaller than a chunk are parsed in this process.
+    '''
+    def __init__(self, path, delimiter=',', strip_nulls=True, num_workers=None,
+                 chunk_size=CHUNK_SIZE, schema=None, fields=None):
+        self.path = path
+        self.delimiter = delimiter
+        self.strip_nulls = strip_nulls
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.schema = schema
+        self.fields = fields
+        self.headers, self._data_start = read_header(path, delimiter, strip_nulls)
+        self._executor = None
+        if fields:
+            missing = [name for name in fields if name not in self.headers]
+            if missing:
+                raise ValueError(f'Columns {", ".join(missing)} not found in {path}')
+
+    def _chunk_args(self, start, end):
+        return (self.path, start, end, self.delimiter, self.strip_nulls, 'utf-8',
+                self.headers, self.schema, self.fields)
+
+    def batches(self):
+        '''Generator, yields lists of data rows in file order'''
+        chunk_ranges = iter_chunk_ranges(self.path, self._data_start, self.chunk_size)
+        if self.num_workers <= 1 or os.path.getsize(self.path) - self._data_start <= self.chunk_size:
+            for start, end in chunk_ranges:
+                yield parse_chunk(*self._chunk_args(start, end))
+            return
+
+        self._executor = ProcessPoolExecutor(max_workers=self.num_workers)
+        try:
+            pending = collections.deque()
+            for start, end in chunk_ranges:
+                pending.append(self._executor.submit(parse_chunk, *self._chunk_args(start, end)))
+                if len(pending) >= 2 * self.num_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            self.close()
+
+    def __iter__(self):
+        yield self.headers
+        for batch in self.batches():
+            yield from batch
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
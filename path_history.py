@@ -0,0 +1,127 @@
+"""
+(c) 2024 CyberCX
+
+Temporal path index, written by the rewind to the PathHistory table.
+
+Each row of PathHistory holds the name and parent of an entry for an
+interval of the journal:
+
+    EntryKey, Name, ParentKey, ValidFromUsn, ValidToUsn
+
+and is valid for USNs where ValidFromUsn < USN <= ValidToUsn. ValidFromUsn
+is BEFORE_JOURNAL for the state the entry had before the oldest journal
+record, and ValidToUsn is CURRENT for the state it has in the MFT. Keys
+are make_key() keys, as in the EntryKey column of the other tables.
+
+Intervals are in USN order, the order records were written to the
+journal. The rewind itself walks the journal in timestamp order, so the
+two only disagree where timestamps go backwards (eg. clock changes).
+
+With the index on (EntryKey, ValidToUsn), the full path of any entry at
+any USN (or timestamp) is found with one index lookup per path component,
+without replaying the journal.
+
+License : MIT
+
+"""
+from path_resolver import ROOT_KEY, UNKNOWN_PATH
+
+PATH_HISTORY_TABLE = 'PathHistory'
+BEFORE_JOURNAL = -1
+CURRENT = (1 << 63) - 1
+
+class PathHistoryRecorder:
+    '''
+        Collects PathHistory rows while the rewind walks the journal
+        backwards. Call record_change() just before the rewind changes an
+        entry in parent_lookup, and all_rows() once the rewind is done.
+    '''
+    def __init__(self, parent_lookup):
+        self.parent_lookup = parent_lookup
+        self.rows = []
+        self._valid_to = {} # { Entry : ValidToUsn } for entries changed so far
+
+    def record_change(self, key, usn):
+        '''
+            key is about to be changed by the journal record at usn, so
+            its current (newer) state was valid from usn onwards.
+        '''
+        try:
+            usn = int(usn)
+        except (TypeError, ValueError):
+            return # can't place it in time
+        value = self.parent_lookup.get(key)
+        if value is not None:
+            self.rows.append((key, value[0], value[1], usn, self._valid_to.get(key, CURRENT)))
+        self._valid_to[key] = usn
+
+    def all_rows(self):
+        '''
+            Generator, yields the recorded rows, then the state every entry
+            had before the journal began (the lookup after the rewind).
+        '''
+        yield from self.rows
+        valid_to = self._valid_to
+        for key, (name, parent_key, _) in self.parent_lookup.items():
+            yield key, name, parent_key, BEFORE_JOURNAL, valid_to.get(key, CURRENT)
+
+def write_path_history(db, rows, table_name=PATH_HISTORY_TABLE):
+    '''Creates table_name (replacing any existing one) with rows, and indexes it'''
+    db.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+    db.execute(f'CREATE TABLE "{table_name}" (EntryKey INTEGER, Name TEXT, ParentKey INTEGER, '
+                'ValidFromUsn INTEGER, ValidToUsn INTEGER)')
+    db.executemany(f'INSERT INTO "{table_name}" VALUES (?,?,?,?,?)', rows)
+    db.execute(f'CREATE INDEX "idx_{table_name}_EntryKey_ValidToUsn" ON "{table_name}" (EntryKey, ValidToUsn)')
+    db.commit()
+
+def entry_at_usn(db, key, usn, table_name=PATH_HISTORY_TABLE):
+    '''Returns (Name, ParentKey) of key as it was at usn, or None if unknown'''
+    return db.execute(f'SELECT Name, ParentKey FROM "{table_name}" '
+                       'WHERE EntryKey=? AND ValidToUsn >= ? AND ValidFromUsn < ? '
+                       'ORDER BY ValidToUsn LIMIT 1', (key, usn, usn)).fetchone()
+
+def full_path_at_usn(db, key, usn, table_name=PATH_HISTORY_TABLE):
+    '''
+        Returns the full path (eg. '.\\Windows\\notepad.exe') of key as it
+        was at usn, in the same form as the rewind output. The path starts
+        with <UNKNOWN> if an ancestor is not known at that usn. Returns None
+        if key itself is not known at that usn.
+    '''
+    names = []
+    seen = set()
+    current = key
+    while current != ROOT_KEY:
+        value = None if current in seen else entry_at_usn(db, current, usn, table_name)
+        if value is None:
+            if current == key:
+                return None
+            names.append(UNKNOWN_PATH)
+            break
+        seen.add(current)
+        name, current = value
+        if name:
+            names.append(name)
+    else:
+        names.append('.')
+    return '\\'.join(reversed(names))
+
+def usn_at_time(db, timestamp, usn_table_name='USNJRNL'):
+    '''
+        Returns the USN of the last journal record at or before timestamp
+        (FILETIME ticks, see rewind_filter.parse_timestamp), or None if the
+        journal has nothing that old. Raises TypeError if timestamp is not
+        an int, as SQLite would compare text to the INTEGER column without
+        an error, but always as larger.
+    '''
+    if not isinstance(timestamp, int) or isinstance(timestamp, bool):
+        raise TypeError(f'timestamp must be FILETIME ticks (int), not {type(timestamp).__name__}')
+    row = db.execute(f'SELECT UpdateSequenceNumber FROM "{usn_table_name}" WHERE UpdateTimestamp <= ? '
+                      'ORDER BY UpdateTimestamp DESC, UpdateSequenceNumber DESC LIMIT 1',
+                     (timestamp,)).fetchone()
+    return row[0] if row else None
+
+def full_path_at_time(db, key, timestamp, table_name=PATH_HISTORY_TABLE, usn_table_name='USNJRNL'):
+    '''Same as full_path_at_usn, for the USN in effect at timestamp (FILETIME ticks)'''
+    usn = usn_at_time(db, timestamp, usn_table_name)
+    # 0 is the first USN, ie. before any journal changes
+    return full_path_at_usn(db, key, 0 if usn is None else usn, table_name)
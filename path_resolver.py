@@ -0,0 +1,396 @@
+"""
+(c) 2024 CyberCX
+
+Path resolution engine used by usnjrnl_rewind.
+
+ParentLookup holds the { Entry : (EntryName, ParentEntry, ParentName) }
+map that the rewind mutates as it walks the journal backwards. Resolved
+full paths are cached per entry, and a parent -> children index of the
+cached entries is kept so that a rename or delete only invalidates the
+subtree below the entry that changed.
+
+Entries are keyed by a packed 64 bit integer (EntryNumber << 16 | SequenceNumber)
+and stored in arrays indexed by entry number, with names kept in a utf8
+name table. This takes a fraction of the memory a dict of strings and
+tuples would, which matters for MFTs with millions of entries; the MFT
+rows are also loaded through arrays, so building it does not need more.
+
+Resolution is iterative, so very deep folder trees will not hit the
+python recursion limit. The path cache is bounded by an estimate of its
+memory use (max_cache_bytes), and is cleared when it is full; it only
+holds the paths of parent folders, which the rewind keeps coming back
+to, so it soon fills again with the ones still in use.
+
+License : MIT
+
+"""
+from array import array
+
+def make_key(entry_num, seq_num):
+    '''Packs an entry and sequence number into a single integer key'''
+    return (entry_num << 16) | (seq_num & 0xFFFF)
+
+def key_to_str(key):
+    '''Returns the key as an 'Entry-Seq' string, eg. "1234-5"'''
+    return f'{key >> 16}-{key & 0xFFFF}'
+
+ROOT_KEY = make_key(5, 5)
+UNKNOWN_PATH = "<UNKNOWN>"
+
+# Entry numbers up to this far past the current end of the arrays are
+# stored in the arrays (growing them), anything further goes in the dict.
+MAX_ARRAY_GROWTH = 1 << 20
+
+# Default memory for the path cache, and the rough memory each cached
+# path takes besides its text (dict slot, key, str header, children set)
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+PATH_CACHE_ENTRY_BYTES = 200
+# Rough memory of a record in the _extra dict (tuple, key and dict slot)
+EXTRA_RECORD_BYTES = 200
+
+# What is known of an entry number while loading the MFT rows
+INFO_NOT_IN_USE = 0
+INFO_IN_USE = 1
+INFO_UNKNOWN = 2 # InUse not known
+INFO_NONE = 3    # no row for the entry number
+
+class ParentLookup:
+    '''
+        Dictionary like store of { Entry : (EntryName, ParentEntry, ParentName) }
+        with a cache of resolved full paths. Entry and ParentEntry are keys
+        from make_key().
+
+        Storage is an array slot per entry number, holding the sequence number
+        of the key stored there, plus a dict (_extra) for the few keys whose
+        entry number slot is already taken by another sequence number, ie.
+        entries seen again with a different sequence number during the rewind.
+        Names are stored as ids into a name table. While building, each
+        MFT row's name is stored once, and entries share the name id of
+        their parent's name as ParentName; names are not interned.
+
+        Invariant: if an entry's path is cached, then so is the path of
+        every ancestor (that exists in the lookup), and each cached entry
+        is registered under its parent in _cached_children. Invalidating
+        an entry therefore only needs to walk _cached_children downwards.
+    '''
+    def __init__(self, max_cache_bytes=DEFAULT_CACHE_BYTES):
+        self._seqs = array('i')             # SequenceNumber stored for entry, -1 if none
+        self._name_ids = array('I')
+        self._parent_keys = array('Q')
+        self._parent_name_ids = array('I')
+        self._extra = {}                    # { Entry : (name_id, ParentEntry, parent_name_id) }
+        self._count = 0
+
+        self._name_data = bytearray()
+        self._name_offsets = array('Q', [0, 0]) # name id 0 is ''
+
+        self._path_cache = {}       # { Entry : full path }
+        self._cached_children = {}  # { ParentEntry : set(Entry, ..) }, cached entries only
+        self._cache_bytes = 0       # estimated memory of the path cache
+        self.max_cache_bytes = max_cache_bytes
+
+    def __getstate__(self):
+        # Pickled without the path cache, it is rebuilt as needed
+        state = self.__dict__.copy()
+        state['_path_cache'] = {}
+        state['_cached_children'] = {}
+        state['_cache_bytes'] = 0
+        return state
+
+    def _add_name(self, name):
+        '''Returns the name id for name, adding it to the name table if needed'''
+        # If name is number, python may treat as int, not str, hence explicit
+        # conversion to string below
+        name = '' if name is None else str(name)
+        if not name:
+            return 0
+        self._name_data += name.encode('utf8', 'surrogatepass')
+        self._name_offsets.append(len(self._name_data))
+        return len(self._name_offsets) - 2
+
+    def _name(self, name_id):
+        offsets = self._name_offsets
+        return self._name_data[offsets[name_id]:offsets[name_id + 1]].decode('utf8', 'surrogatepass')
+
+    def close(self):
+        '''Frees what the lookup holds outside of memory, nothing here (see SpillingParentLookup)'''
+        pass
+
+    def memory_size(self):
+        '''Rough memory (bytes) of the records and names, not counting the path cache, about its pickled size too'''
+        arrays = (self._seqs, self._name_ids, self._parent_keys, self._parent_name_ids, self._name_offsets)
+        return sum(a.itemsize * len(a) for a in arrays) + len(self._name_data) + len(self._extra) * EXTRA_RECORD_BYTES
+
+    def load_mft_records(self, mft_records):
+        '''
+            Adds the entries of mft_records, see build_parent_lookup(). The
+            rows are streamed into arrays, then added in a second pass, once
+            the entries they have as parents have all been seen.
+        '''
+        # { EntryNumber : (SequenceNumber, InUse, name id) } of all rows, in arrays
+        # indexed by entry number, and a dict for those too far past the end
+        info_seqs = array('q')
+        info_states = bytearray()   # INFO_* of the entry number
+        info_name_ids = array('I')
+        info_extra = {}
+        # The rows to add
+        entry_nums = array('Q')
+        seq_nums = array('q')
+        in_uses = bytearray()
+        parent_entry_nums = array('Q')
+        parent_seq_nums = array('q')
+        name_ids = array('I')
+
+        add_name = self._add_name
+        for entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, file_name in mft_records:
+            is_ads = ':' in file_name
+            num_slots = len(info_states)
+            if num_slots <= entry_num < num_slots + MAX_ARRAY_GROWTH:
+                grow_by = entry_num + 1 - num_slots
+                info_seqs.extend(array('q', [0]) * grow_by)
+                info_states.extend(bytes([INFO_NONE]) * grow_by)
+                info_name_ids.extend(array('I', [0]) * grow_by)
+                num_slots = entry_num + 1
+            if entry_num < num_slots:
+                has_info = info_states[entry_num] != INFO_NONE
+            else:
+                has_info = entry_num in info_extra
+            name_id = 0
+            if not is_ads or not has_info:
+                # prefer the real file name over ADS names for the same entry
+                name_id = add_name(file_name)
+                state = INFO_UNKNOWN if in_use is None else int(in_use)
+                if entry_num < num_slots:
+                    info_seqs[entry_num] = seq_num
+                    info_states[entry_num] = state
+                    info_name_ids[entry_num] = name_id
+                else:
+                    info_extra[entry_num] = (seq_num, state, name_id)
+            # Skip ADS entries — their names contain ':' (e.g. "$UpCase:$Info")
+            # and would overwrite the real filename for the same Entry key.
+            if is_ads or in_use is None:
+                continue
+            if parent_seq_num < 0:
+                # Older MFTECmd (fixed on 9 Mar 2024) wrote these as signed values
+                parent_seq_num &= 65535
+            entry_nums.append(entry_num)
+            seq_nums.append(seq_num)
+            in_uses.append(in_use)
+            parent_entry_nums.append(parent_entry_num)
+            parent_seq_nums.append(parent_seq_num)
+            name_ids.append(name_id)
+
+        num_slots = len(info_states)
+        for entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, name_id in \
+                zip(entry_nums, seq_nums, in_uses, parent_entry_nums, parent_seq_nums, name_ids):
+            parent_key = make_key(parent_entry_num, parent_seq_num)
+            if parent_entry_num < num_slots:
+                parent_seq = info_seqs[parent_entry_num]
+                parent_state = info_states[parent_entry_num]
+                parent_name_id = info_name_ids[parent_entry_num]
+            else:
+                parent_seq, parent_state, parent_name_id = info_extra.get(parent_entry_num, (0, INFO_NONE, 0))
+            if parent_state == INFO_NONE:
+                parent_seq = None
+            if in_use:
+                if parent_seq != parent_seq_num:
+                    parent_name_id = 0
+                self._set_record(make_key(entry_num, seq_num), name_id, parent_key, parent_name_id)
+            elif (parent_state == INFO_IN_USE and parent_seq == parent_seq_num) or \
+                 (parent_state == INFO_NOT_IN_USE and parent_seq == parent_seq_num + 1):
+                self._set_record(make_key(entry_num, seq_num - 1), name_id, parent_key, parent_name_id)
+
+    def _grow(self, grow_by):
+        '''Add grow_by empty slots to the arrays'''
+        if grow_by == 1:
+            self._seqs.append(-1)
+            self._name_ids.append(0)
+            self._parent_keys.append(0)
+            self._parent_name_ids.append(0)
+        else:
+            self._seqs.extend(array('i', [-1]) * grow_by)
+            self._name_ids.extend(array('I', [0]) * grow_by)
+            self._parent_keys.extend(array('Q', [0]) * grow_by)
+            self._parent_name_ids.extend(array('I', [0]) * grow_by)
+
+    def _record(self, key):
+        '''Returns (name_id, ParentEntry, parent_name_id) for key or None'''
+        entry_num = key >> 16
+        if 0 <= entry_num < len(self._seqs) and self._seqs[entry_num] == key & 0xFFFF:
+            return self._name_ids[entry_num], self._parent_keys[entry_num], self._parent_name_ids[entry_num]
+        return self._extra.get(key)
+
+    def __contains__(self, key):
+        return self._record(key) is not None
+
+    def __getitem__(self, key):
+        record = self._record(key)
+        if record is None:
+            raise KeyError(key)
+        return self._name(record[0]), record[1], self._name(record[2])
+
+    def __setitem__(self, key, value):
+        file_name, parent_key, parent_name = value
+        self._set_record(key, self._add_name(file_name), parent_key, self._add_name(parent_name))
+
+    def _set_record(self, key, name_id, parent_key, parent_name_id):
+        entry_num = key >> 16
+        seq_num = key & 0xFFFF
+        num_slots = len(self._seqs)
+        if num_slots <= entry_num < num_slots + MAX_ARRAY_GROWTH:
+            self._grow(entry_num + 1 - num_slots)
+            num_slots = entry_num + 1
+        if 0 <= entry_num < num_slots and self._seqs[entry_num] in (-1, seq_num):
+            if self._seqs[entry_num] == -1:
+                self._count += 1
+            self._seqs[entry_num] = seq_num
+            self._name_ids[entry_num] = name_id
+            self._parent_keys[entry_num] = parent_key
+            self._parent_name_ids[entry_num] = parent_name_id
+        else:
+            if key not in self._extra:
+                self._count += 1
+            self._extra[key] = (name_id, parent_key, parent_name_id)
+        self.invalidate(key)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for entry_num, seq_num in enumerate(self._seqs):
+            if seq_num != -1:
+                yield make_key(entry_num, seq_num)
+        yield from list(self._extra)
+
+    def get(self, key, default=None):
+        record = self._record(key)
+        if record is None:
+            return default
+        return self._name(record[0]), record[1], self._name(record[2])
+
+    def items(self):
+        for key in self:
+            yield key, self[key]
+
+    def name_of(self, key):
+        '''Returns the name of key, or '' if it is not in the lookup'''
+        record = self._record(key)
+        return '' if record is None else self._name(record[0])
+
+    def invalidate(self, key):
+        '''Drop the cached path of key and of everything cached below it'''
+        if key not in self._path_cache and key not in self._cached_children:
+            return
+        stack = [key]
+        while stack:
+            item = stack.pop()
+            path = self._path_cache.pop(item, None)
+            if path is not None:
+                self._cache_bytes -= PATH_CACHE_ENTRY_BYTES + len(path)
+            children = self._cached_children.pop(item, None)
+            if children:
+                stack.extend(children)
+
+    def clear_cache(self):
+        self._path_cache.clear()
+        self._cached_children.clear()
+        self._cache_bytes = 0
+
+    def full_path(self, key):
+        '''
+            Returns the full path of key, which must exist in the lookup.
+            Paths for the entry and all its ancestors are cached as a side
+            effect.
+        '''
+        path = self._path_cache.get(key)
+        if path is not None:
+            return path
+
+        if self._cache_bytes >= self.max_cache_bytes:
+            self.clear_cache()
+
+        # Walk upwards until we reach the root, a cached ancestor or
+        # an ancestor that is not in the lookup.
+        path_cache = self._path_cache
+        chain = []
+        seen = set()
+        current = key
+        record = self._record(current)
+        if record is None:
+            raise KeyError(key)
+        while True:
+            chain.append((current, record))
+            seen.add(current)
+            parent_key = record[1]
+            if parent_key == ROOT_KEY:
+                prefix = '.'
+                break
+            prefix = path_cache.get(parent_key)
+            if prefix is not None:
+                break
+            parent_record = None if parent_key in seen else self._record(parent_key)
+            if parent_record is None:
+                # Unknown parent (or a corrupt loop in the parent chain)
+                parent_name = self._name(record[2])
+                prefix = UNKNOWN_PATH + '\\' + parent_name if parent_name else UNKNOWN_PATH
+                break
+            current = parent_key
+            record = parent_record
+
+        # Now build the paths back down the chain, caching each one
+        for current, (name_id, parent_key, _) in reversed(chain):
+            if name_id:
+                prefix = prefix + '\\' + self._name(name_id)
+            path_cache[current] = prefix
+            self._cache_bytes += PATH_CACHE_ENTRY_BYTES + len(prefix)
+            children = self._cached_children.get(parent_key)
+            if children is None:
+                self._cached_children[parent_key] = {current}
+            else:
+                children.add(current)
+        return prefix
+
+def mft_records(rows):
+    '''
+        Converts rows of (EntryNumber, SequenceNumber, InUse, ParentEntryNumber,
+        ParentSequenceNumber, FileName) read from the MFT table or csv to the
+        types build_parent_lookup expects. Rows with non-numeric entry values
+        are skipped.
+    '''
+    for entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, file_name in rows:
+        try:
+            entry_num = int(entry_num)
+            seq_num = int(seq_num)
+            parent_entry_num = int(parent_entry_num)
+            parent_seq_num = int(parent_seq_num)
+        except (TypeError, ValueError):
+            continue
+        if entry_num < 0 or parent_entry_num < 0:
+            continue
+        # InUse is 'True'/'False' in the csv, 1/0 in the typed MFT table
+        if in_use == 'True' or in_use == 1:
+            in_use = True
+        elif in_use == 'False' or in_use == 0:
+            in_use = False
+        else:
+            in_use = None
+        yield entry_num, seq_num, in_use, parent_entry_num, parent_seq_num, \
+              '' if file_name is None else str(file_name)
+
+def build_parent_lookup(mft_records, parent_lookup=None):
+    '''
+        Builds a ParentLookup from mft_records, an iterable of
+        (EntryNumber, SequenceNumber, InUse, ParentEntryNumber, ParentSequenceNumber, FileName)
+        with numbers as int and InUse as bool (or None if unknown).
+
+        This is the python equivalent of the MFT self-join; an entry is keyed as:
+          - Entry-Seq      if in use
+          - Entry-(Seq-1)  if not in use and its parent (ParentEntry-ParentSeq) is in use
+          - Entry-(Seq-1)  if not in use and its parent was deleted too, ie. the
+                           parent's current sequence number is ParentSeq + 1
+        Entries that are not in use and whose parent cannot be found are left out.
+    '''
+    if parent_lookup is None:
+        parent_lookup = ParentLookup()
+    parent_lookup.load_mft_records(mft_records)
+    return parent_lookup
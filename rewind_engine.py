@@ -0,0 +1,266 @@
+"""
+(c) 2024 CyberCX
+
+The rewind engine, usable as a library without the csv files or the
+SQLite database the command line tool works with.
+
+    from rewind_engine import rewind_records
+
+    for row in rewind_records(mft_rows, usn_rows):
+        ...
+
+mft_rows is an iterable of (EntryNumber, SequenceNumber, InUse,
+ParentEntryNumber, ParentSequenceNumber, FileName) and usn_rows an
+iterable of USN_FIELDS rows, newest first (see USN_ORDER). Rows can be
+tuples, or MftRecord and UsnRecord objects. Values may be strings, as in
+the csv, or typed, as in the database. Resolved rows are yielded one at a
+time as tuples in OUTPUT_FIELDS order, or as RewoundRecord objects, so
+memory use is that of the parent lookup (built from the MFT) whatever
+the size of the journal.
+
+Rewinder is the same engine for callers that want the lookup, path
+history or unknown path counts, or that feed the journal in batches.
+The csv, --no_db and sharded rewinds in usnjrnl_rewind all use it.
+
+License : MIT
+
+"""
+import re
+
+from csv_stream import USN_FIELDS
+from metrics import UnknownPathStats
+from mft_parser import MFT_RECORD_FIELDS
+from output_sinks import OUTPUT_FIELDS
+from path_history import PathHistoryRecorder
+from path_resolver import build_parent_lookup, make_key, mft_records, ROOT_KEY, UNKNOWN_PATH
+from usn_parser import Reason
+
+INVALID_KEY = -1
+
+RENAME_OLD_NAME = int(Reason.RenameOldName)
+FILE_DELETE = int(Reason.FileDelete)
+REASON_FLAGS = { flag.name : int(flag) for flag in Reason } # { 'FileCreate' : 0x100, .. }
+REASON_SEPARATORS = re.compile(r'[|,\s]+')
+MAX_CACHED_REASONS = 65536 # a journal has a few hundred distinct values
+
+_reason_cache = {} # { UpdateReasons value : (mask, display string) }, see decode_reasons()
+
+# Rewind order of the journal, newest first. rowid breaks any ties, so 
+# that shards of the journal can be queried separately in the same order.
+USN_ORDER = 'UpdateTimestamp DESC, UpdateSequenceNumber DESC, rowid DESC'
+
+class FieldRecord:
+    '''
+        Base of the record classes, a light object with a slot per column.
+        Iterating gives the values in column order, so a record can be
+        used wherever a row tuple is.
+    '''
+    __slots__ = ()
+
+    def __init__(self, *values, **named_values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+        for name in self.__slots__[len(values):]:
+            setattr(self, name, named_values.pop(name, None))
+        if named_values:
+            raise TypeError(f'{type(self).__name__} has no field(s) {", ".join(named_values)}')
+
+    def __iter__(self):
+        for name in self.__slots__:
+            yield getattr(self, name)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        values = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({values})'
+
+    def astuple(self):
+        return tuple(self)
+
+class MftRecord(FieldRecord):
+    '''An MFT entry, MFT_RECORD_FIELDS'''
+    __slots__ = MFT_RECORD_FIELDS
+
+class UsnRecord(FieldRecord):
+    '''A journal row, USN_FIELDS'''
+    __slots__ = USN_FIELDS
+
+class RewoundRecord(FieldRecord):
+    '''A journal row with its ParentPath, OUTPUT_FIELDS'''
+    __slots__ = OUTPUT_FIELDS
+
+def parse_reasons(reasons):
+    '''
+        Returns (mask, display string) for an UpdateReasons value, either
+        MFTECmd's flag names (eg. "RenameOldName|Close") or a number, which
+        MFTECmd writes as is when it finds unknown flags. A number is
+        displayed as the flag names. Use decode_reasons(), which caches this.
+    '''
+    try:
+        value = int(reasons)
+    except (TypeError, ValueError):
+        # Flag names, or None
+        if not isinstance(reasons, str):
+            return 0, reasons
+        mask = 0
+        for name in REASON_SEPARATORS.split(reasons):
+            flag = REASON_FLAGS.get(name)
+            if flag:
+                mask |= flag
+        return mask, reasons
+    try:
+        return value, repr(Reason(value))
+    except ValueError:
+        return 0, reasons
+
+def decode_reasons(reasons):
+    '''(mask, display string) of an UpdateReasons value, parsed once per distinct value'''
+    decoded = _reason_cache.get(reasons)
+    if decoded is None:
+        if len(_reason_cache) >= MAX_CACHED_REASONS:
+            _reason_cache.clear() # corrupt data, with too many distinct values
+        decoded = _reason_cache[reasons] = parse_reasons(reasons)
+    return decoded
+
+def decode_reasons_batch(values):
+    '''Returns [ (mask, display string), .. ] for a batch of UpdateReasons values'''
+    cache_get = _reason_cache.get
+    return [ cache_get(reasons) or decode_reasons(reasons) for reasons in values ]
+
+def clean_reasons_string(reasons):
+    '''
+        This functions checks if 'reasons' is an integer, if so
+        it will convert it to the flags equivalent string.
+        This happens when MFtEcmd encounters unknown flags and 
+        returns the reasons integer value as is. 
+    '''
+    return decode_reasons(reasons)[1]
+
+def update_lookup(parent_lookup, entry, parent_entry, name, reason_mask, update_seq_number=None, history=None):
+    '''
+        Applies the change a journal row makes to parent_lookup, for the
+        rows that change it (renames and deletes). entry and parent_entry
+        are make_key() keys (INVALID_KEY if corrupt), reason_mask is the
+        UpdateReasons flags (see decode_reasons). Changes are recorded in
+        history (a PathHistoryRecorder) if given.
+    '''
+    if entry < 0 or parent_entry < 0:
+        pass # Corrupt entry numbers, can't use this to update the lookup
+
+    elif reason_mask & RENAME_OLD_NAME:
+        # Replace entry in lookup dict, need parent name for this
+        parent_name = parent_lookup.name_of(parent_entry)
+        if history:
+            history.record_change(entry, update_seq_number)
+        # Replace with new parent entry & parent name
+        parent_lookup[entry] = name, parent_entry, parent_name
+
+    elif reason_mask & FILE_DELETE:
+        # Check if it currently exits. If not, add to parent_lookup
+        if entry not in parent_lookup:
+            # try to lookup parent name
+            p_name = parent_lookup.name_of(parent_entry)
+            if history:
+                history.record_change(entry, update_seq_number)
+            parent_lookup[entry] = (name, parent_entry, p_name)
+
+def row_keys(entry_num, seq_num, parent_entry_num, parent_seq_num):
+    '''Returns the (entry, parent_entry) keys of a journal row, INVALID_KEY for both if corrupt'''
+    try:
+        return make_key(int(entry_num), int(seq_num)), make_key(int(parent_entry_num), int(parent_seq_num))
+    except (TypeError, ValueError):
+        return INVALID_KEY, INVALID_KEY
+
+def rewind_journal(parent_lookup, usn_rows, history=None, row_filter=None, unknown_paths=None):
+    '''
+        Generator that walks usn_rows (tuples in USN_FIELDS order or
+        UsnRecords, newest first) updating parent_lookup as it goes, and yields a tuple in
+        OUTPUT_FIELDS order for each row with the ParentPath computed.
+        Lookup changes are recorded in history if given. If row_filter (a
+        RewindFilter) is given, only the rows it selects are yielded, and 
+        the walk stops at the first row older than its time window. Rows
+        with an unknown parent are counted in unknown_paths (an
+        UnknownPathStats) if given.
+    '''
+    reason_cache_get = _reason_cache.get
+    for name, extension, entry_num, seq_num, parent_entry_num, parent_seq_num, \
+            update_seq_number, ts, reasons, attributes, off_to_data, source_file in usn_rows:
+
+        if row_filter and row_filter.is_older(ts):
+            break
+        entry, parent_entry = row_keys(entry_num, seq_num, parent_entry_num, parent_seq_num)
+        reason_mask, reasons = reason_cache_get(reasons) or decode_reasons(reasons)
+        update_lookup(parent_lookup, entry, parent_entry, name, reason_mask, update_seq_number, history)
+        if row_filter and row_filter.is_newer(ts):
+            continue # only its lookup change matters
+
+        if parent_entry == ROOT_KEY:
+            path_prefix = '.' # nothing to do
+
+        elif parent_entry in parent_lookup:
+            # Resolved prefixes are cached by parent_lookup, and only
+            # invalidated for the subtree a rename/delete touches
+            path_prefix = parent_lookup.full_path(parent_entry)
+        else:
+            # unknown
+            path_prefix = UNKNOWN_PATH
+            if unknown_paths is not None:
+                unknown_paths.add(update_seq_number, parent_entry)
+
+        if row_filter and not row_filter.matches_path(path_prefix, name):
+            continue
+        yield (name, extension, entry_num, seq_num, parent_entry_num, parent_seq_num, 
+               path_prefix, update_seq_number, ts, reasons, attributes, off_to_data, source_file)
+
+class Rewinder:
+    '''
+        Rewinds the journal of one volume. parent_lookup (a ParentLookup,
+        see build_parent_lookup) is updated as the journal is walked, so
+        rewind() must be given the journal rows in order, newest first,
+        though they may come in several calls (eg. a batch at a time).
+        If record_history is set, lookup changes are recorded in history
+        (a PathHistoryRecorder). Rows are selected by row_filter (a
+        RewindFilter) if given, and rows with an unknown parent are
+        counted in unknown_paths.
+    '''
+    def __init__(self, parent_lookup, record_history=False, row_filter=None, unknown_paths=None):
+        self.parent_lookup = parent_lookup
+        self.history = PathHistoryRecorder(parent_lookup) if record_history else None
+        self.row_filter = row_filter
+        self.unknown_paths = UnknownPathStats() if unknown_paths is None else unknown_paths
+
+    @classmethod
+    def from_mft_records(cls, records, *args, parent_lookup=None, **kwargs):
+        '''
+            Returns a Rewinder with the lookup built from records, rows or
+            MftRecords (see mft_records for the values accepted), into
+            parent_lookup if given (eg. a SpillingParentLookup)
+        '''
+        return cls(build_parent_lookup(mft_records(records), parent_lookup), *args, **kwargs)
+
+    def rewind(self, usn_rows):
+        '''Generator, yields a tuple in OUTPUT_FIELDS order for each (selected) row of usn_rows'''
+        return rewind_journal(self.parent_lookup, usn_rows, self.history, self.row_filter, self.unknown_paths)
+
+    def rewind_records(self, usn_rows):
+        '''As rewind(), yielding RewoundRecord objects'''
+        for row in self.rewind(usn_rows):
+            yield RewoundRecord(*row)
+
+def rewind_records(mft_rows, usn_rows, row_filter=None, as_records=False, parent_lookup=None):
+    '''
+        Generator, rewinds the journal in usn_rows (newest first) using
+        the MFT in mft_rows, yielding each resolved row (selected by
+        row_filter if given) as a tuple in OUTPUT_FIELDS order, or as a
+        RewoundRecord if as_records is set. The lookup is built from
+        mft_rows when the first row is asked for, after that rows are
+        resolved as usn_rows is read. Pass a SpillingParentLookup as
+        parent_lookup to keep the lookup on disk (the caller closes it).
+    '''
+    rewinder = Rewinder.from_mft_records(mft_rows, row_filter=row_filter, parent_lookup=parent_lookup)
+    if as_records:
+        yield from rewinder.rewind_records(usn_rows)
+    else:
+        yield from rewinder.rewind(usn_rows)
@@ -0,0 +1,98 @@
+"""
+(c) 2024 CyberCX
+
+Time window and path filters for the rewind (--from, --to and --path).
+
+The rewind walks the journal newest first, so rows newer than the window
+only need their lookup changes applied (no path is resolved or written),
+and the walk can stop at the first row older than the window.
+
+License : MIT
+
+"""
+from mftecmd_schema import ticks_to_timestamp, timestamp_to_ticks, TIMESTAMP_LEN
+
+def parse_timestamp(text):
+    '''
+        Converts a time given on the command line, eg. "2024-03-01",
+        "2024-03-01 10:20", "2024-03-01 10:20:30" or "2024-03-01T10:20:30.123", to FILETIME
+        ticks. Missing parts are taken as zero. Raises ValueError if the
+        time is not valid.
+    '''
+    value = text.strip().replace('T', ' ')
+    if len(value) == 10:
+        value += ' 00:00'
+    if len(value) == 16:
+        value += ':00'
+    if len(value) == 19:
+        value += '.'
+    value = value.ljust(TIMESTAMP_LEN, '0')
+    ticks = timestamp_to_ticks(value)
+    if not isinstance(ticks, int):
+        raise ValueError(f'Invalid time "{text}", use the format "YYYY-MM-DD HH:MM:SS.fffffff"')
+    return ticks
+
+def normalize_path_prefix(path):
+    '''
+        Returns path in the form of the rewind output, ie. starting with
+        '.\\', without a trailing backslash and in lower case for a case
+        insensitive compare (as NTFS is). Returns '' for the root folder,
+        ie. no filter.
+    '''
+    path = path.strip().replace('/', '\\').rstrip('\\')
+    if path in ('', '.'):
+        return ''
+    if path.startswith('.\\'):
+        path = path[2:]
+    return ('.\\' + path.lstrip('\\')).lower()
+
+class RewindFilter:
+    '''
+        Selects the journal rows the rewind outputs. from_ticks and to_ticks
+        (FILETIME ticks, either can be None) bound the UpdateTimestamp, both
+        inclusive. path_prefix (see normalize_path_prefix) keeps only rows
+        for items at or below that folder.
+    '''
+    def __init__(self, from_ticks=None, to_ticks=None, path_prefix=''):
+        self.from_ticks = from_ticks
+        self.to_ticks = to_ticks
+        self.path_prefix = path_prefix
+        self._prefix_slash = path_prefix + '\\'
+
+    @staticmethod
+    def _ticks(ts):
+        # UpdateTimestamp is ticks in the db, the MFTECmd string in --no_db mode
+        return ts if isinstance(ts, int) else timestamp_to_ticks(ts)
+
+    def is_newer(self, ts):
+        '''True if ts is after the window'''
+        if self.to_ticks is None:
+            return False
+        ticks = self._ticks(ts)
+        return isinstance(ticks, int) and ticks > self.to_ticks
+
+    def is_older(self, ts):
+        '''True if ts is before the window, ie. the walk is done'''
+        if self.from_ticks is None:
+            return False
+        ticks = self._ticks(ts)
+        return isinstance(ticks, int) and ticks < self.from_ticks
+
+    def matches_path(self, parent_path, name):
+        if not self.path_prefix:
+            return True
+        full_path = f'{parent_path}\\{name}'.lower()
+        return full_path == self.path_prefix or full_path.startswith(self._prefix_slash)
+
+    def __bool__(self):
+        return self.from_ticks is not None or self.to_ticks is not None or bool(self.path_prefix)
+
+    def __str__(self):
+        parts = []
+        if self.from_ticks is not None:
+            parts.append(f'from {ticks_to_timestamp(self.from_ticks)}')
+        if self.to_ticks is not None:
+            parts.append(f'to {ticks_to_timestamp(self.to_ticks)}')
+        if self.path_prefix:
+            parts.append(f'under {self.path_prefix}')
+        return ', '.join(parts)
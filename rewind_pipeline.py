@@ -0,0 +1,222 @@
+"""
+(c) 2024 CyberCX
+
+Runs the journal rewind as three pipelined stages connected by bounded
+queues, so that reading rows and writing output overlap with the path
+resolution:
+
+    fetch (thread)  -->  resolve (calling thread)  -->  write (thread)
+
+Each stage keeps a StageStats counter of rows, time spent working and
+time spent waiting on its queues, to show where the bottleneck is.
+
+A checkpoint function can be given to save the state of a long run at
+batch boundaries (see checkpoint.py). It is called on the resolve
+thread, and what it captures is saved on the write thread once the
+rows resolved before it have been written.
+
+License : MIT
+
+"""
+import itertools
+import operator
+import queue
+import threading
+import time
+
+FETCH_BATCH_SIZE = 10000
+MAX_QUEUED_BATCHES = 8
+
+_END = object() # end of stream marker
+
+class StageStats:
+    '''Throughput counters for a pipeline stage'''
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.batches = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+    def rows_per_sec(self):
+        return int(self.rows / self.busy_time) if self.busy_time > 0 else 0
+
+    def __str__(self):
+        return f'{self.name:<8}: {self.rows} rows in {self.batches} batches, busy {self.busy_time:.1f} s ' \
+               f'({self.rows_per_sec()} rows/sec), waited {self.wait_time:.1f} s'
+
+class _StageError:
+    def __init__(self, ex):
+        self.ex = ex
+
+class _SavePoint:
+    '''Queued to the write stage after a batch, save(sinks) is called once that batch is written'''
+    def __init__(self, save):
+        self.save = save
+
+class _InputPosition:
+    '''
+        Iterable of row iterators over batches, for chain.from_iterable(),
+        that can tell how many rows have been taken from it so far, and the
+        last of them, without a per row cost.
+    '''
+    def __init__(self, batches):
+        self.batches = batches
+        self._rows_before = 0 # rows of the batches before the current one
+        self._batch = []
+        self._rows = iter(self._batch)
+        self._last_row = None # last row of the previous batch
+
+    def __iter__(self):
+        for batch in self.batches:
+            if self._batch:
+                self._rows_before += len(self._batch)
+                self._last_row = self._batch[-1]
+            self._batch = batch
+            self._rows = iter(batch)
+            yield self._rows
+
+    def rows_taken(self):
+        '''Returns (number of rows taken, last row taken)'''
+        taken = len(self._batch) - operator.length_hint(self._rows)
+        return self._rows_before + taken, self._batch[taken - 1] if taken else self._last_row
+
+def _put(out_queue, item, stats):
+    start_time = time.perf_counter()
+    out_queue.put(item)
+    stats.wait_time += time.perf_counter() - start_time
+
+def _iter_queue(in_queue, stats):
+    '''Yields batches from in_queue until the end marker, re-raising stage errors'''
+    while True:
+        start_time = time.perf_counter()
+        item = in_queue.get()
+        stats.wait_time += time.perf_counter() - start_time
+        if item is _END:
+            return
+        if isinstance(item, _StageError):
+            raise item.ex
+        yield item
+
+def batched(rows, batch_size=FETCH_BATCH_SIZE):
+    '''Groups an iterable of rows into lists of up to batch_size rows'''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def cursor_batches(cursor, batch_size=FETCH_BATCH_SIZE):
+    '''Yields lists of rows (plain tuples) from an sqlite cursor with fetchmany'''
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        yield batch
+
+def _fetch_stage(batches, out_queue, stats, stop_event):
+    try:
+        batches = iter(batches)
+        while not stop_event.is_set():
+            start_time = time.perf_counter()
+            batch = next(batches, None)
+            stats.busy_time += time.perf_counter() - start_time
+            if batch is None:
+                break
+            stats.rows += len(batch)
+            stats.batches += 1
+            _put(out_queue, batch, stats)
+        out_queue.put(_END)
+    except Exception as ex: # passed on to the resolve stage
+        out_queue.put(_StageError(ex))
+
+def _write_stage(in_queue, sinks, stats, errors):
+    try:
+        for batch in _iter_queue(in_queue, stats):
+            start_time = time.perf_counter()
+            if isinstance(batch, _SavePoint):
+                batch.save(sinks)
+                stats.busy_time += time.perf_counter() - start_time
+                continue
+            for sink in sinks:
+                sink.write(batch)
+            stats.busy_time += time.perf_counter() - start_time
+            stats.rows += len(batch)
+            stats.batches += 1
+    except Exception as ex: # re-raised in the calling thread
+        errors.append(ex)
+        # Keep consuming so that the resolve stage never blocks on a full queue
+        while in_queue.get() is not _END:
+            pass
+
+def run_pipeline(batches, resolve, sinks, batch_size=FETCH_BATCH_SIZE, max_queued=MAX_QUEUED_BATCHES, progress=None,
+                 checkpoint=None):
+    '''
+        batches : iterable of lists of input rows, read on the fetch thread
+        resolve : function taking an iterable of input rows and returning
+                  an iterable of output rows, run on the calling thread
+        sinks   : objects with write(rows) and close(), written to on the
+                  write thread and closed at the end
+        progress: object with update(rows), called with the rows of each
+                  resolved batch (eg. a metrics.Progress)
+        checkpoint: function called after each resolved batch with the
+                  number of input rows resolve has taken, the last of them
+                  and the number of output rows so far. It may return a
+                  function save(sinks), which is called on the write thread
+                  once the rows so far have been given to the sinks.
+        Returns a list of StageStats, one per stage.
+    '''
+    fetch_stats = StageStats('fetch')
+    resolve_stats = StageStats('resolve')
+    write_stats = StageStats('write')
+    fetch_queue = queue.Queue(maxsize=max_queued)
+    write_queue = queue.Queue(maxsize=max_queued)
+    stop_event = threading.Event()
+    write_errors = []
+
+    fetch_thread = threading.Thread(target=_fetch_stage, name='rewind-fetch', daemon=True,
+                                    args=(batches, fetch_queue, fetch_stats, stop_event))
+    write_thread = threading.Thread(target=_write_stage, name='rewind-write', daemon=True,
+                                    args=(write_queue, sinks, write_stats, write_errors))
+    fetch_thread.start()
+    write_thread.start()
+    try:
+        start_time = time.perf_counter()
+        input_position = _InputPosition(_iter_queue(fetch_queue, resolve_stats))
+        input_rows = itertools.chain.from_iterable(input_position)
+        for batch in batched(resolve(input_rows), batch_size):
+            resolve_stats.rows += len(batch)
+            resolve_stats.batches += 1
+            if progress:
+                progress.update(len(batch))
+            if write_errors:
+                break
+            _put(write_queue, batch, resolve_stats)
+            if checkpoint:
+                save = checkpoint(*input_position.rows_taken(), resolve_stats.rows)
+                if save is not None:
+                    _put(write_queue, _SavePoint(save), resolve_stats)
+        resolve_stats.busy_time = time.perf_counter() - start_time - resolve_stats.wait_time
+    finally:
+        stop_event.set()
+        # unblock the fetch thread if it is waiting on a full queue
+        while fetch_thread.is_alive():
+            try:
+                fetch_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        write_queue.put(_END)
+        write_thread.join()
+        for sink in sinks:
+            sink.close()
+    if write_errors:
+        raise write_errors[0]
+    return [fetch_stats, resolve_stats, write_stats]
+
+def print_stage_stats(stage_stats):
+    print('[.] Rewind pipeline stages:')
+    for stats in stage_stats:
+        print(f'[.]   {stats}')
+    busiest = max(stage_stats, key=lambda s: s.busy_time)
+    print(f'[.]   Bottleneck stage was "{busiest.name}"')
@@ -0,0 +1,36 @@
+"""
+(c) 2024 CyberCX
+
+Tests of the batch runner.
+
+License : MIT
+
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_rewind import BatchJob, JOB_METRICS_FILE_NAME, run_job
+
+def succeeding_rewind(output_path, mft_path, usn_path, metrics_json_path=''):
+    with open(metrics_json_path, 'w', encoding='utf8') as f:
+        json.dump({ 'peak_rss_mb' : 100.0, 'phases' : [ { 'name' : 'rewind', 'seconds' : 1.0, 'rows' : 10 } ] }, f)
+    return True
+
+def failing_rewind(output_path, mft_path, usn_path, metrics_json_path=''):
+    return False
+
+def test_failed_job_has_no_metrics_of_earlier_run(tmp_path):
+    job = BatchJob('volume', 'mft.csv', 'usn.csv', str(tmp_path / 'volume'))
+
+    result = run_job(succeeding_rewind, job, {})
+    assert result['status'] == 'ok'
+    assert result['rows'] == 10
+
+    result = run_job(failing_rewind, job, {})
+    assert result['status'] == 'failed'
+    assert 'rows' not in result
+    assert 'peak_rss_mb' not in result
+    assert not os.path.exists(os.path.join(job.output_path, JOB_METRICS_FILE_NAME))
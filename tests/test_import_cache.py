@@ -0,0 +1,55 @@
+"""
+(c) 2024 CyberCX
+
+Tests of the reuse of the tables of an existing NTFS.sqlite.
+
+License : MIT
+
+"""
+import os
+import sqlite3
+import sys
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_FOLDER)
+sys.path.insert(0, os.path.join(REPO_FOLDER, 'benchmarks'))
+
+from generate_workload import generate_workload
+from import_cache import EDGE_SIZE, file_fingerprint, fingerprints_match, SAMPLE_COUNT, SAMPLE_SIZE
+from usnjrnl_rewind import create_sqlitedb
+
+def edit_between_samples(path, old, new):
+    '''Replaces old with new (same length) in a part of the file that is not sampled for the fingerprint'''
+    size = os.path.getsize(path)
+    step = (size - 2 * EDGE_SIZE) // (SAMPLE_COUNT + 1)
+    assert step > 2 * SAMPLE_SIZE, 'file too small to have unsampled blocks'
+    with open(path, 'r+b') as f:
+        f.seek(EDGE_SIZE + SAMPLE_SIZE)
+        data = f.read(step - 2 * SAMPLE_SIZE)
+        index = data.index(old)
+        f.seek(EDGE_SIZE + SAMPLE_SIZE + index)
+        f.write(new)
+
+def test_same_size_edit_is_imported_again(tmp_path):
+    mft_csv_path = str(tmp_path / 'mft.csv')
+    usn_csv_path = str(tmp_path / 'usn.csv')
+    generate_workload(mft_csv_path, usn_csv_path, 2000, 60000, null_rate=0)
+    out_folder = str(tmp_path / 'out')
+    os.makedirs(out_folder)
+    sqlite_path = create_sqlitedb(out_folder, mft_csv_path, usn_csv_path, parallel=False)
+    assert sqlite_path
+
+    fingerprint = file_fingerprint(usn_csv_path)
+    edit_between_samples(usn_csv_path, b'file', b'fixe')
+    os.utime(usn_csv_path, ns=(fingerprint[1] + 10**9, fingerprint[1] + 10**9))
+    new_fingerprint = file_fingerprint(usn_csv_path)
+    # Only the modified time tells the files apart
+    assert new_fingerprint[0::2] == fingerprint[0::2]
+    assert not fingerprints_match(new_fingerprint, fingerprint)
+
+    assert create_sqlitedb(out_folder, mft_csv_path, usn_csv_path, parallel=False) == sqlite_path
+    db = sqlite3.connect(sqlite_path)
+    try:
+        assert db.execute("SELECT COUNT(*) FROM USNJRNL WHERE Name LIKE '%fixe%'").fetchone()[0] == 1
+    finally:
+        db.close()
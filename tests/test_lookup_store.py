@@ -0,0 +1,30 @@
+"""
+(c) 2024 CyberCX
+
+Tests of the disk backed parent lookup.
+
+License : MIT
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lookup_store import SpillingParentLookup
+from path_resolver import make_key, ROOT_KEY
+
+def test_setitem_keeps_lru_bounded(tmp_path):
+    lookup = SpillingParentLookup(str(tmp_path), memory_mb=1)
+    try:
+        num_keys = lookup.max_records * 3
+        for entry_num in range(100, 100 + num_keys):
+            lookup[make_key(entry_num, 1)] = (f'file{entry_num}.txt', ROOT_KEY, '.')
+            assert len(lookup._records) <= lookup.max_records
+
+        assert len(lookup) == num_keys
+        # Evicted records are still in the file
+        assert lookup[make_key(100, 1)] == ('file100.txt', ROOT_KEY, '.')
+        assert len(lookup._records) <= lookup.max_records
+    finally:
+        lookup.close()
@@ -0,0 +1,48 @@
+"""
+(c) 2024 CyberCX
+
+Tests of a rewind that stops early at the start of its --from window.
+
+License : MIT
+
+"""
+import csv
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_FOLDER, 'benchmarks'))
+
+from generate_workload import generate_workload
+
+def test_from_on_sequential_rewind(tmp_path):
+    mft_csv_path = str(tmp_path / 'mft.csv')
+    usn_csv_path = str(tmp_path / 'usn.csv')
+    # More rows than the fetch stage queues up, so the walk stops mid-SELECT
+    generate_workload(mft_csv_path, usn_csv_path, 2000, 150000, null_rate=0)
+    with open(usn_csv_path, newline='', encoding='utf-8') as f:
+        timestamps = sorted(row['UpdateTimestamp'] for row in csv.DictReader(f))
+    from_time = timestamps[len(timestamps) * 3 // 4]
+    out_folder = tmp_path / 'out'
+    metrics_path = tmp_path / 'metrics.json'
+
+    result = subprocess.run([sys.executable, os.path.join(REPO_FOLDER, 'usnjrnl_rewind.py'), '-m', mft_csv_path,
+                             '-u', usn_csv_path, '--workers', '1', '--from', from_time,
+                             '--metrics_json', str(metrics_path), str(out_folder)],
+                            capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Traceback' not in result.stderr
+    assert metrics_path.exists()
+    assert json.loads(metrics_path.read_text())
+    db = sqlite3.connect(out_folder / 'NTFS.sqlite')
+    try:
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+        timestamps_out = [ row[0] for row in db.execute('SELECT UpdateTimestamp FROM USNJRNL_FullPaths') ]
+    finally:
+        db.close()
+    assert timestamps_out
+    assert min(timestamps_out) >= from_time
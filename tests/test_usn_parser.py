@@ -0,0 +1,35 @@
+"""
+(c) 2024 CyberCX
+
+Tests of the raw $J parser.
+
+License : MIT
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from usn_parser import iter_usn_records, UsnJournalStats, USN_RECORD_HEADER, USN_RECORD_V2
+
+def v2_record(name, entry_num, seq_num, parent_entry_num, parent_seq_num, usn):
+    name_bytes = name.encode('utf-16-le')
+    record_length = (USN_RECORD_V2.size + len(name_bytes) + 7) & ~7
+    header = USN_RECORD_V2.pack(record_length, 2, 0, (seq_num << 48) | entry_num,
+                                (parent_seq_num << 48) | parent_entry_num, usn, 133485408000000000,
+                                0x100, 0, 0, 0x20, len(name_bytes), USN_RECORD_V2.size)
+    return (header + name_bytes).ljust(record_length, b'\0')
+
+def test_truncated_v4_record_at_end(tmp_path):
+    path = tmp_path / 'J'
+    # A V4 header claiming 16 bytes, less than the V4 record itself, right before EOF
+    path.write_bytes(v2_record('a.txt', 40, 1, 5, 5, 0) + USN_RECORD_HEADER.pack(16, 4, 0) + b'\0' * 8)
+    stats = UsnJournalStats()
+
+    records = list(iter_usn_records(str(path), stats))
+
+    assert [ record[0] for record in records ] == ['a.txt']
+    assert stats.records == 1
+    assert stats.range_records == 0
+    assert stats.bad_offsets >= 1
@@ -0,0 +1,238 @@
+"""
+(c) 2024 CyberCX
+
+Parser for a raw $UsnJrnl:$J file, so that the rewind can read the
+journal directly instead of needing the MFTECmd csv of it.
+
+Reads USN_RECORD_V2 and USN_RECORD_V3 records, and steps over V4 (range
+tracking) records, which have no file name or timestamp. The file is
+mmap'ed and each record header is decoded with a precompiled Struct.
+Extracted $J files are mostly sparse (zeros), and records are padded
+with zeros to the end of each page, so runs of zeros are skipped with
+bytes.lstrip() over growing chunks (up to a MB) of the file.
+
+Records are returned with the same columns, in the same order, as the
+MFTECmd csv, but with numbers as int and UpdateTimestamp as FILETIME
+ticks (see mftecmd_schema).
+
+License : MIT
+
+"""
+import mmap
+import os
+import struct
+
+from enum import IntFlag
+
+class Reason(IntFlag):
+    DataOverwrite       = 0x00000001
+    DataExtend          = 0x00000002
+    DataTruncation      = 0x00000004
+    UNK_0x8             = 0x00000008
+    NamedDataOverwrite  = 0x00000010
+    NamedDataExtend     = 0x00000020
+    NamedDataTruncation = 0x00000040
+    UNK_0x80            = 0x00000080
+    FileCreate          = 0x00000100
+    FileDelete          = 0x00000200
+    EaChange            = 0x00000400
+    SecurityChange      = 0x00000800
+    RenameOldName       = 0x00001000
+    RenameNewName       = 0x00002000
+    IndexableChange     = 0x00004000
+    BasicInfoChange     = 0x00008000
+    HardLinkChange      = 0x00010000
+    CompressionChange   = 0x00020000
+    EncryptionChange    = 0x00040000
+    ObjectIdChange      = 0x00080000
+    ReparsePointChange  = 0x00100000
+    StreamChange        = 0x00200000
+    TransactedChange    = 0x00400000
+    IntegrityChange     = 0x00800000
+    UNK_0x1000000       = 0x01000000
+    UNK_0x2000000       = 0x02000000
+    UNK_0x4000000       = 0x04000000
+    UNK_0x8000000       = 0x08000000
+    UNK_0x10000000      = 0x10000000
+    UNK_0x20000000      = 0x20000000
+    UNK_0x40000000      = 0x40000000
+    Close               = 0x80000000
+
+    def __repr__(self):
+        return '|'.join(val.name for val in Reason if self.value & val)
+
+class FileAttribute(IntFlag):
+    ReadOnly            = 0x00000001
+    Hidden              = 0x00000002
+    System              = 0x00000004
+    UNK_0x8             = 0x00000008
+    Directory           = 0x00000010
+    Archive             = 0x00000020
+    Device              = 0x00000040
+    Normal              = 0x00000080
+    Temporary           = 0x00000100
+    SparseFile          = 0x00000200
+    ReparsePoint        = 0x00000400
+    Compressed          = 0x00000800
+    Offline             = 0x00001000
+    NotContentIndexed   = 0x00002000
+    Encrypted           = 0x00004000
+    IntegrityStream     = 0x00008000
+    Virtual             = 0x00010000
+    NoScrubData         = 0x00020000
+    RecallOnOpen        = 0x00040000
+    Pinned              = 0x00080000
+    Unpinned            = 0x00100000
+    UNK_0x200000        = 0x00200000
+    RecallOnDataAccess  = 0x00400000
+
+    def __repr__(self):
+        return '|'.join(val.name for val in FileAttribute if self.value & val)
+
+# Columns of the MFTECmd $J csv
+USN_RECORD_FIELDS = ('Name', 'Extension', 'EntryNumber', 'SequenceNumber', 'ParentEntryNumber',
+                     'ParentSequenceNumber', 'ParentPath', 'UpdateSequenceNumber', 'UpdateTimestamp',
+                     'UpdateReasons', 'FileAttributes', 'OffsetToData', 'SourceFile')
+
+# RecordLength, MajorVersion, MinorVersion, FileReferenceNumber, ParentFileReferenceNumber,
+# Usn, TimeStamp, Reason, SourceInfo, SecurityId, FileAttributes, FileNameLength, FileNameOffset
+USN_RECORD_V2 = struct.Struct('<IHHQQqqIIIIHH')
+# Same, with 128 bit file references (low and high 64 bits)
+USN_RECORD_V3 = struct.Struct('<IHHQQQQqqIIIIHH')
+# RecordLength, MajorVersion, MinorVersion, FileReferenceNumber (128), ParentFileReferenceNumber (128),
+# Usn, Reason, SourceInfo, RemainingExtents, NumberOfExtents, ExtentSize
+USN_RECORD_V4 = struct.Struct('<IHHQQQQqIIIHH')
+USN_RECORD_HEADER = struct.Struct('<IHH')
+USN_RECORD_V4_EXTENT_SIZE = 16
+
+MAX_RECORD_LENGTH = 0x10000 # records never cross a page, this is generous
+ENTRY_MASK = 0xFFFFFFFFFFFF
+ZERO_SCAN_SIZE = 1024 * 1024
+UTF8_BOM = b'\xef\xbb\xbf'
+
+_flag_strings = {} # { (flag class, value) : string }
+
+def flags_string(flag_class, value):
+    '''Returns eg. "FileCreate|Close" for Reason 0x80000100, cached per value'''
+    text = _flag_strings.get((flag_class, value))
+    if text is None:
+        text = repr(flag_class(value))
+        _flag_strings[(flag_class, value)] = text
+    return text
+
+def get_extension(name):
+    '''Extension (with the dot) as MFTECmd shows it, '' if none'''
+    dot = name.rfind('.')
+    return name[dot:] if 0 <= dot < len(name) - 1 else ''
+
+def skip_zeros(mm, pos, file_size):
+    '''Returns the offset of the next non-zero byte at or after pos, or file_size if none'''
+    scan_size = 64 # most runs are just the padding at the end of a page
+    while pos < file_size:
+        chunk = mm[pos:pos + scan_size]
+        rest = chunk.lstrip(b'\x00')
+        if rest:
+            return pos + len(chunk) - len(rest)
+        pos += len(chunk)
+        scan_size = min(scan_size * 2, ZERO_SCAN_SIZE)
+    return file_size
+
+def is_raw_usn_journal(path):
+    '''
+        True if the file at path looks like a raw $J, rather than a csv;
+        after any leading zeros (the sparse part) it has a valid V2, V3 or
+        V4 record header. A csv can also start with NULs, but then has a
+        text line of comma separated headers after them.
+    '''
+    file_size = os.path.getsize(path)
+    if file_size < USN_RECORD_HEADER.size:
+        return False
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = skip_zeros(mm, 0, file_size)
+            if pos == file_size:
+                return True # all zeros, a journal with nothing left in it
+            first_line = mm[pos:pos + 4096].split(b'\n', 1)[0]
+            if first_line.startswith(UTF8_BOM) or (b',' in first_line and first_line.rstrip(b'\r').isascii()):
+                return False
+            pos &= ~7 # records are 8 byte aligned
+            if pos + USN_RECORD_HEADER.size > file_size:
+                return False
+            record_length, major_version, minor_version = USN_RECORD_HEADER.unpack_from(mm, pos)
+        finally:
+            mm.close()
+    return 2 <= major_version <= 4 and minor_version == 0 and record_length % 8 == 0 and \
+           USN_RECORD_HEADER.size < record_length <= MAX_RECORD_LENGTH
+
+class UsnJournalStats:
+    def __init__(self):
+        self.records = 0
+        self.range_records = 0 # V4, skipped
+        self.bad_offsets = 0   # non-zero data that was not a valid record
+
+def iter_usn_records(path, stats=None):
+    '''
+        Generator, yields a tuple (USN_RECORD_FIELDS order) for each V2/V3
+        record in the raw $J file at path, in file (USN) order. ParentPath
+        is always ''. Counts go in stats (a UsnJournalStats) if given.
+    '''
+    if stats is None:
+        stats = UsnJournalStats()
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        return
+    source_file = os.path.abspath(path)
+    unpack_v2 = USN_RECORD_V2.unpack_from
+    unpack_v3 = USN_RECORD_V3.unpack_from
+    unpack_v4 = USN_RECORD_V4.unpack_from
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(mm)
+            pos = 0
+            while pos + USN_RECORD_HEADER.size <= file_size:
+                record_length, major_version, minor_version = USN_RECORD_HEADER.unpack_from(mm, pos)
+                if record_length == 0:
+                    next_pos = skip_zeros(mm, pos, file_size) & ~7 # records are 8 byte aligned
+                    if next_pos <= pos: # zero length, but not zeros
+                        stats.bad_offsets += 1
+                        next_pos = pos + 8
+                    pos = next_pos
+                    continue
+                end = pos + record_length
+                if record_length % 8 or record_length > MAX_RECORD_LENGTH or end > file_size or minor_version != 0:
+                    stats.bad_offsets += 1
+                    pos += 8
+                    continue
+
+                if major_version == 2 and record_length >= USN_RECORD_V2.size:
+                    _, _, _, file_ref, parent_ref, usn, timestamp, reason, _, _, attributes, \
+                        name_length, name_offset = unpack_v2(mm, pos)
+                elif major_version == 3 and record_length >= USN_RECORD_V3.size:
+                    _, _, _, file_ref, _, parent_ref, _, usn, timestamp, reason, _, _, attributes, \
+                        name_length, name_offset = unpack_v3(mm, pos)
+                elif major_version == 4 and record_length >= USN_RECORD_V4.size and \
+                        record_length >= USN_RECORD_V4.size + USN_RECORD_V4_EXTENT_SIZE * unpack_v4(mm, pos)[11]:
+                    # The header is only read once it is known to be within the record (and the file)
+                    stats.range_records += 1
+                    pos = end
+                    continue
+                else:
+                    stats.bad_offsets += 1
+                    pos += 8
+                    continue
+                if name_offset + name_length > record_length:
+                    stats.bad_offsets += 1
+                    pos += 8
+                    continue
+
+                name = str(view[pos + name_offset:end][:name_length], 'utf-16-le', 'replace')
+                stats.records += 1
+                yield (name, get_extension(name), file_ref & ENTRY_MASK, file_ref >> 48,
+                       parent_ref & ENTRY_MASK, parent_ref >> 48, '', usn, timestamp,
+                       flags_string(Reason, reason), flags_string(FileAttribute, attributes), pos, source_file)
+                pos = end
+        finally:
+            del view
+            mm.close()
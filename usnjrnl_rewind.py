@@ -14,54 +14,47 @@ License : MIT
 
 """
 import argparse
+import collections
 import csv
+import json
 import os
+import pickle
 import random
 import sqlite3
+import sys
 import time
 
 version = "0.6.1"
 
-from csv_to_sqlite import import_csv, sanitize_remove_nulls
-from enum import IntFlag
+from batch_rewind import estimate_memory_mb, find_volumes, print_batch_summary, read_manifest, run_batch, safe_name, \
+                         SUMMARY_FILE_NAME, total_memory_mb
+from checkpoint import checkpoint_path, checkpoint_settings, load_checkpoint, outputs_cover, remove_checkpoint, \
+    restore_rewinder, RewindCheckpointer, TIMESTAMP_INDEX, USN_INDEX
+from csv_stream import read_mft_csv, sort_usn_csv, USN_FIELDS
+from csv_to_sqlite import BULK_PAGE_SIZE, copy_table, import_csv, import_rows, set_bulk_load_pragmas, table_exists
+from metrics import Progress, RunMetrics
+from mft_parser import is_raw_mft, iter_mft_records, MFT_RECORD_FIELDS
+from mftecmd_schema import MFT_SCHEMA, USN_SCHEMA
+from output_sinks import CsvSink, SqliteSink, NORMALIZED_SUFFIX, PARENT_PATHS_TABLE
+from rewind_filter import normalize_path_prefix, parse_timestamp, RewindFilter
+from rewind_pipeline import batched, cursor_batches, print_stage_stats, run_pipeline
+from import_cache import create_fingerprints_table, file_fingerprint, fingerprints_match, forget_fingerprint, \
+    load_fingerprints, only_modified_time_differs, save_fingerprint
+from path_history import full_path_at_time, full_path_at_usn, PATH_HISTORY_TABLE, write_path_history
+from lookup_store import SpillingParentLookup
+from path_resolver import build_parent_lookup, make_key, ParentLookup, UNKNOWN_PATH
+from rewind_engine import decode_reasons_batch, Rewinder, row_keys, update_lookup, USN_ORDER
+from usn_parser import is_raw_usn_journal, iter_usn_records, USN_RECORD_FIELDS, UsnJournalStats
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from string import ascii_uppercase
 
-class Reason(IntFlag):
-    DataOverwrite       = 0x00000001
-    DataExtend          = 0x00000002
-    DataTruncation      = 0x00000004
-    UNK_0x8             = 0x00000008
-    NamedDataOverwrite  = 0x00000010
-    NamedDataExtend     = 0x00000020
-    NamedDataTruncation = 0x00000040
-    UNK_0x80            = 0x00000080
-    FileCreate          = 0x00000100
-    FileDelete          = 0x00000200
-    EaChange            = 0x00000400
-    SecurityChange      = 0x00000800
-    RenameOldName       = 0x00001000
-    RenameNewName       = 0x00002000
-    IndexableChange     = 0x00004000
-    BasicInfoChange     = 0x00008000
-    HardLinkChange      = 0x00010000
-    CompressionChange   = 0x00020000
-    EncryptionChange    = 0x00040000
-    ObjectIdChange      = 0x00080000
-    ReparsePointChange  = 0x00100000
-    StreamChange        = 0x00200000
-    TransactedChange    = 0x00400000
-    IntegrityChange     = 0x00800000
-    UNK_0x1000000       = 0x01000000
-    UNK_0x2000000       = 0x02000000
-    UNK_0x4000000       = 0x04000000
-    UNK_0x8000000       = 0x08000000
-    UNK_0x10000000      = 0x10000000
-    UNK_0x20000000      = 0x20000000
-    UNK_0x40000000      = 0x40000000
-    Close               = 0x80000000
-    
-    def __repr__(self):
-        return '|'.join(val.name for val in Reason if self.value & val)
+# Shards of the parallel rewind; each one is sent a snapshot of the lookup,
+# so there are only a couple per worker, within these sizes
+SHARDS_PER_WORKER = 2
+MIN_SHARD_ROWS = 200000  # smaller journals are rewound sequentially
+MAX_SHARD_ROWS = 2000000 # bounds the rows of the shards in flight
+SHARD_ROW_BYTES = 1000   # rough memory of a resolved row, in its worker and again here
 
 def get_time_taken_string(start_time, end_time):
     time_taken = end_time - start_time
@@ -72,97 +65,293 @@ def get_time_taken_string(start_time, end_time):
         run_time_HMS = f'-failed-to-calc , time_taken={time_taken}'
     return run_time_HMS
 
-def add_to_sqlite(path, sqlite_db_path, table_name, perform_cleaning=True):
-    temp_folder = os.path.split(os.path.realpath(path))[0]
-    cleaned_csv_path = sanitize_remove_nulls(path, temp_folder) if perform_cleaning else path
-    ret = import_csv(cleaned_csv_path, sqlite_db_path, table_name, guess_column_types=True)
-    if cleaned_csv_path != path:
-        try:
-            os.remove(cleaned_csv_path)
-        except OSError as ex:
-            print(f'[!] Failed to remove temp file : {cleaned_csv_path} Error was:', str(ex))
-    return ret
+def add_to_sqlite(path, sqlite_db_path, table_name, perform_cleaning=True, bulk_load=False, index_columns=None, schema=None,
+                  num_workers=1):
+    if is_raw_mft(path):
+        # A raw $MFT, only the columns the rewind needs are imported
+        return import_rows(iter_mft_records(path, num_workers), MFT_RECORD_FIELDS, sqlite_db_path, table_name, 
+                           bulk_load=bulk_load, index_columns=index_columns, schema=schema)
+    if is_raw_usn_journal(path):
+        # A raw $J, not a csv, records are parsed directly
+        stats = UsnJournalStats()
+        if not import_rows(iter_usn_records(path, stats), USN_RECORD_FIELDS, sqlite_db_path, table_name, 
+                           bulk_load=bulk_load, index_columns=index_columns, schema=schema):
+            return False
+        if not stats.records:
+            print(f'[!] No USN records found in {path}, which looked like a raw $J file ({stats.bad_offsets} bad offsets)')
+            return False
+        return True
+    # Nulls (if any) are stripped while the csv is read, no temp file is created.
+    # Column types come from schema if given, else are guessed.
+    return import_csv(path, sqlite_db_path, table_name, guess_column_types=True, strip_nulls=perform_cleaning,
+                      bulk_load=bulk_load, index_columns=index_columns, schema=schema, num_workers=num_workers)
 
-def create_sqlitedb(output_path, mft_csv_path, usnjrnl_csv_path):
-    '''Create db and return path if successful, else return empty string'''
+def create_sqlitedb(output_path, mft_csv_path, usnjrnl_csv_path, parallel=True, num_workers=1, force_reimport=False):
+    '''
+        Create db and return path if successful, else return empty string.
+        If parallel, the MFT and USNJRNL csv files are imported at the same
+        time in separate processes; the larger one straight into the db and 
+        the other into a temp db, which is then copied in.
+        num_workers is the number of processes to parse the csv files with.
+
+        An existing NTFS.sqlite created by this tool is reused, only tables
+        whose csv file has changed (see import_cache) are imported again,
+        unless force_reimport is set, which recreates it. The bulk loader
+        is only used for a new db, tables imported again next to the kept
+        ones use the normal, durable settings.
+    '''
     start_time = time.time()
+    imports = [ (mft_csv_path, 'MFT', MFT_SCHEMA), (usnjrnl_csv_path, 'USNJRNL', USN_SCHEMA) ]
+    fingerprints = { table_name : file_fingerprint(csv_path) for csv_path, table_name, _ in imports }
+
     sqlite_path = os.path.join(output_path, 'NTFS.sqlite')
+    to_import = imports
     if os.path.exists(sqlite_path):
-        rand = ''.join(random.choice(ascii_uppercase) for i in range(4))
-        sqlite_path = os.path.join(output_path, f'NTFS_{rand}.sqlite')
-
-    print(f'[.] Creating an SQLite database here: {sqlite_path}')
-    
-    print('[.] Adding MFT data to database..')
-    if not add_to_sqlite(mft_csv_path, sqlite_path, 'MFT'):
-        print('[!] Failed to add to sqlite.')
-        return ''
+        existing = get_imported_tables(sqlite_path)
+        if existing is None: # Not created by this tool (or too old), leave it alone
+            rand = ''.join(random.choice(ascii_uppercase) for i in range(4))
+            sqlite_path = os.path.join(output_path, f'NTFS_{rand}.sqlite')
+        elif force_reimport:
+            print(f'[.] Forced reimport, recreating the database here: {sqlite_path}')
+            os.remove(sqlite_path)
+        else:
+            to_import = []
+            for item in imports:
+                table_name = item[1]
+                if fingerprints_match(fingerprints[table_name], existing.get(table_name)):
+                    print(f'[.] Reusing the {table_name} table in {sqlite_path}, its csv file is unchanged')
+                else:
+                    if only_modified_time_differs(fingerprints[table_name], existing.get(table_name)):
+                        print(f'[.] The {table_name} csv file has the same size and samples, but was modified since '
+                               'it was imported')
+                    to_import.append(item)
+            if not existing:
+                print('[.] The database has no complete imports (an earlier run was interrupted?), recreating it')
+                os.remove(sqlite_path)
+            elif len(to_import) == len(imports):
+                print('[.] Both csv files have changed, recreating the database')
+                os.remove(sqlite_path)
+
+    if not os.path.exists(sqlite_path):
+        print(f'[.] Creating an SQLite database here: {sqlite_path}')
+        try:
+            db = sqlite3.connect(sqlite_path)
+            # page_size must be set before the first table, the import would set it otherwise
+            db.execute(f'PRAGMA page_size={BULK_PAGE_SIZE}')
+            create_fingerprints_table(db)
+            db.close()
+        except sqlite3.Error as ex:
+            print('[!] Failed to create the database, error was', str(ex))
+            return ''
+        # The database is new here, so use the (non-durable) bulk loader
+        if parallel:
+            if not import_in_parallel(imports, sqlite_path, num_workers):
+                print('[!] Failed to add to sqlite.')
+                return ''
+        else:
+            for csv_path, table_name, schema in imports:
+                print(f'[.] Adding {table_name} data to database..')
+                if not add_to_sqlite(csv_path, sqlite_path, table_name, bulk_load=True, schema=schema, 
+                                     num_workers=num_workers):
+                    print('[!] Failed to add to sqlite.')
+                    return ''
+    else:
+        for csv_path, table_name, schema in to_import:
+            print(f'[.] {table_name} csv file has changed, adding {table_name} data to database again..')
+            try:
+                db = sqlite3.connect(sqlite_path)
+                forget_fingerprint(db, table_name) # so a failed import is not reused
+                db.close()
+            except sqlite3.Error as ex:
+                print('[!] Failed to update csv file fingerprints, error was', str(ex))
+                return ''
+            # Not the bulk loader, a crash must not corrupt the tables that are kept
+            if not add_to_sqlite(csv_path, sqlite_path, table_name, bulk_load=False, schema=schema, 
+                                 num_workers=num_workers):
+                print('[!] Failed to add to sqlite.')
+                return ''
 
-    print('[.] Adding USNJRNL:$J data to database..')
-    if not add_to_sqlite(usnjrnl_csv_path, sqlite_path, 'USNJRNL'):
-        print('[!] Failed to add to sqlite.')
-        return ''
+    try:
+        db = sqlite3.connect(sqlite_path)
+        for csv_path, table_name, _ in to_import:
+            save_fingerprint(db, table_name, csv_path, fingerprints[table_name])
+        db.close()
+    except sqlite3.Error as ex:
+        print('[!] Failed to save csv file fingerprints, error was', str(ex))
 
     end_time = time.time()
     print(f'[.] Database creation time: {get_time_taken_string(start_time, end_time)}')
     return sqlite_path
 
-def rewind(output_path, mft_csv_path, usnjrnl_csv_path):
+def get_imported_tables(sqlite_path):
+    '''
+        Returns the { TableName : fingerprint } of the existing tables in 
+        the db at sqlite_path, or None if it has no fingerprints to go by.
+    '''
+    try:
+        db = sqlite3.connect(sqlite_path)
+        try:
+            fingerprints = load_fingerprints(db)
+            if fingerprints is None:
+                return None
+            return { table_name : fingerprint for table_name, fingerprint in fingerprints.items()
+                        if table_exists(db, table_name) }
+        finally:
+            db.close()
+    except sqlite3.Error:
+        return None
+
+def import_in_parallel(imports, sqlite_path, num_workers=1):
+    '''
+        Imports each (csv_path, table_name, schema) of imports in its own
+        process. The largest csv goes straight into sqlite_path, the rest
+        into temp dbs next to it, whose tables are then copied into 
+        sqlite_path. The num_workers csv parsing processes are shared out
+        between the imports. Returns True if all imports succeeded.
+    '''
+    imports = sorted(imports, key=lambda item: os.path.getsize(item[0]), reverse=True)
+    db_paths = [sqlite_path] + [f'{sqlite_path}.{table_name}.tmp' for _, table_name, _ in imports[1:]]
+    print('[.] Adding ' + ' and '.join(table_name for _, table_name, _ in imports) + ' data to database in parallel..')
+    try:
+        with ProcessPoolExecutor(max_workers=len(imports)) as executor:
+            workers_each = max(1, num_workers // len(imports))
+            futures = [executor.submit(add_to_sqlite, csv_path, db_path, table_name, bulk_load=True, schema=schema,
+                                       num_workers=workers_each)
+                        for (csv_path, table_name, schema), db_path in zip(imports, db_paths)]
+            if not all(future.result() for future in futures):
+                return False
+        db = sqlite3.connect(sqlite_path)
+        try:
+            set_bulk_load_pragmas(db)
+            for (_, table_name, _), db_path in zip(imports[1:], db_paths[1:]):
+                copy_table(db, db_path, table_name)
+        finally:
+            db.close()
+    except (sqlite3.Error, OSError, BrokenProcessPool) as ex:
+        print('[!] Parallel import failed, error was', str(ex))
+        return False
+    finally:
+        for db_path in db_paths[1:]:
+            if os.path.exists(db_path):
+                try:
+                    os.remove(db_path)
+                except OSError as ex:
+                    print(f'[!] Failed to remove temp file : {db_path} Error was:', str(ex))
+    return True
+
+def rewind(output_path, mft_csv_path, usnjrnl_csv_path, no_db=False, memory_budget_mb=512, no_csv=False, num_workers=1,
+           force_reimport=False, row_filter=None, metrics_json_path='', profile_path='', normalize_paths=False,
+           lookup_memory_mb=0, checkpoint_minutes=0, resume=False, memory_limit_mb=4096):
+    '''Rewinds the journal of one volume, writing the output to output_path. Returns True if it succeeded.'''
     start_time = time.time()
-    sqlite_path = create_sqlitedb(output_path, mft_csv_path, usnjrnl_csv_path)
+    metrics = RunMetrics()
+    metrics.profile_path = profile_path
+    metrics.info = { 'version' : version, 'mft' : os.path.abspath(mft_csv_path), 
+                     'usnjrnl' : os.path.abspath(usnjrnl_csv_path), 'output_path' : os.path.abspath(output_path),
+                     'no_db' : no_db, 'workers' : num_workers, 'filter' : str(row_filter) if row_filter else '',
+                     'normalize_paths' : normalize_paths, 'lookup_memory_mb' : lookup_memory_mb,
+                     'checkpoint_minutes' : checkpoint_minutes, 'resume' : resume, 'memory_limit_mb' : memory_limit_mb }
+    if row_filter:
+        print(f'[.] Only output journal rows {row_filter}')
+    if no_db:
+        out_csv_path = os.path.join(output_path, 'USNJRNL.fullPaths.csv')
+        print('[.] ..Rewinding journal directly from the csv files (no database)..')
+        success = create_journal_rewind_csv_from_csv(mft_csv_path, usnjrnl_csv_path, out_csv_path, 
+                                                     output_path, memory_budget_mb, num_workers, row_filter, metrics,
+                                                     lookup_memory_mb)
+        if success:
+            print(f'[.] Created the USNJRNL full path csv here: {out_csv_path}')
+        finish_run(metrics, start_time, metrics_json_path)
+        return success
+
+    with metrics.phase('import'):
+        sqlite_path = create_sqlitedb(output_path, mft_csv_path, usnjrnl_csv_path, num_workers=num_workers, 
+                                      force_reimport=force_reimport)
     if not sqlite_path:
-        return
-    out_csv_path = os.path.join(output_path, 'USNJRNL.fullPaths.csv')
+        return False
+    out_csv_path = '' if no_csv else os.path.join(output_path, 'USNJRNL.fullPaths.csv')
     print('[.] ..Rewinding journal and computing the full paths now..')
-    create_journal_rewind_csv(sqlite_path, out_csv_path, 'MFT', 'USNJRNL')
-    print(f'[.] Created the USNJRNL full path csv here: {out_csv_path}')
-    print(f'[.] Adding full path data to database..')
-    if not add_to_sqlite(out_csv_path, sqlite_path, 'USNJRNL_FullPaths', perform_cleaning=False):
-        print('[!] Failed to add csv to sqlite.')
-
+    # Results go to the csv and the USNJRNL_FullPaths table in the same pass
+    success = create_journal_rewind_csv(sqlite_path, out_csv_path, 'MFT', 'USNJRNL', 'USNJRNL_FullPaths', num_workers,
+                                        PATH_HISTORY_TABLE, row_filter, metrics, normalize_paths, lookup_memory_mb,
+                                        checkpoint_minutes, resume, memory_limit_mb)
+    if success:
+        if out_csv_path:
+            print(f'[.] Created the USNJRNL full path csv here: {out_csv_path}')
+        if normalize_paths:
+            print(f'[.] Added full path data to database table USNJRNL_FullPaths_Normalized and {PARENT_PATHS_TABLE}, '
+                   'view USNJRNL_FullPaths joins them')
+        else:
+            print(f'[.] Added full path data to database table USNJRNL_FullPaths')
+        if not (row_filter and row_filter.from_ticks is not None):
+            print(f'[.] Added the path history index to database table {PATH_HISTORY_TABLE}')
+    else:
+        print('[!] Failed to create full path data.')
+    finish_run(metrics, start_time, metrics_json_path)
+    return success
+
+def finish_run(metrics, start_time, metrics_json_path=''):
+    metrics.print_summary()
+    if metrics_json_path:
+        try:
+            metrics.save_json(metrics_json_path)
+            print(f'[.] Saved run metrics here: {metrics_json_path}')
+        except OSError as ex:
+            print(f'[!] Failed to save run metrics to {metrics_json_path}, error was', str(ex))
     end_time = time.time()
-    
     print(f'[.] Finished in total time: {get_time_taken_string(start_time, end_time)}')
 
 def get_full_path(entry, lookup_dict, path):
-    parent_path = "<UNKNOWN>"
+    '''Returns the full path of entry (a make_key() key), lookup_dict is a ParentLookup'''
     if entry in lookup_dict:
-        file_name, parent_entry, parent_name = lookup_dict[entry]
-        # Use the current name from the dict rather than the caller's
+        # Use the current name from the lookup rather than the caller's
         # cached copy, which may be stale after rename events update
         # parent_lookup during the reverse-chronological walk.
-        path = file_name
-        if parent_entry == "5-5":
-            parent_path = "."
-        else:
-            parent_path = get_full_path(parent_entry, lookup_dict, parent_name)
+        return lookup_dict.full_path(entry)
     if path:
         # If parent is number, python may treat as int, not str, hence explicit
         # conversion to string below
-        return str(parent_path) + '\\' + str(path)
-    return parent_path
+        return UNKNOWN_PATH + '\\' + str(path)
+    return UNKNOWN_PATH
 
-def clean_reasons_string(reasons):
+def create_journal_rewind_csv(sqlite_db_path, out_csv_path, mft_table_name, usn_table_name, out_table_name='',
+                              num_workers=1, history_table_name='', row_filter=None, metrics=None,
+                              normalize_paths=False, lookup_memory_mb=0, checkpoint_minutes=0, resume=False,
+                              memory_limit_mb=4096):
     '''
-        This functions checks if 'reasons' is an integer, if so
-        it will convert it to the flags equivalent string.
-        This happens when MFtEcmd encounters unknown flags and 
-        returns the reasons integer value as is. 
+        Rewinds the journal in usn_table_name, writing the results to the 
+        csv at out_csv_path and/or to a new table out_table_name in the 
+        same db, in the same pass. If num_workers is more than 1 and the 
+        journal has more than MIN_SHARD_ROWS rows, the paths are resolved in 
+        parallel (see sharded_rewind_batches), with as many of the workers
+        and rows per shard as fit in memory_limit_mb (see plan_shards). If history_table_name is set,
+        the lookup changes are written to that table as a temporal path
+        index (see path_history). If row_filter (a RewindFilter) is given,
+        only the rows it selects are output, and the walk stops once it is
+        past the start of its time window. Timings, progress and unknown
+        path counts go in metrics (a RunMetrics) if given. If normalize_paths
+        is set, out_table_name is a view over a table with path ids and the
+        ParentPaths table (see SqliteSink). If lookup_memory_mb is set, the
+        lookup is kept on disk next to the db, using about that much memory
+        (see SpillingParentLookup), and the rewind is not sharded.
+        If checkpoint_minutes is set, a checkpoint is saved next to the db
+        that often (see checkpoint.py), and the rewind is not sharded. If
+        resume is set, the rewind carries on from the checkpoint of an
+        earlier run with the same settings, if there is one.
     '''
+    if metrics is None:
+        metrics = RunMetrics()
+    if lookup_memory_mb and (checkpoint_minutes or resume):
+        # SpillingParentLookup can not be pickled
+        print('[.] Checkpoints are not used when the lookup is kept on disk')
+        checkpoint_minutes, resume = 0, False
     try:
-        i = int(reasons)
-        reasons = repr(Reason(i))
-    except ValueError:
-        # Reasons is not an int
-        pass
-    return reasons
-
-def create_journal_rewind_csv(sqlite_db_path, out_csv_path, mft_table_name, usn_table_name):
-    
-    try:
-        db = sqlite3.connect(sqlite_db_path)
-        db.row_factory = sqlite3.Row
-    except:
+        # The USN rows are fetched on a separate pipeline thread
+        db = sqlite3.connect(sqlite_db_path, check_same_thread=False)
+        if out_table_name:
+            # WAL lets the sink's connection write while this one is reading
+            db.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.Error:
         print(f"[!] Failed to open db at {sqlite_db_path}")
         return False
     
@@ -184,179 +373,497 @@ def create_journal_rewind_csv(sqlite_db_path, out_csv_path, mft_table_name, usn_
         db.close()
         return False
     
+    # The lookup is built in a single pass over the MFT rows (see 
+    # build_parent_lookup), rather than a self-join of the MFT table.
     query = '''
-        SELECT m1.EntryNumber || '-' || m1.SequenceNumber as Entry, m1.FileName,
-        m1.ParentEntryNumber || '-' || m1.ParentSequenceNumber as ParentEntry, 
-        ifnull(m2.FileName, '') as ParentName
-        FROM {MFT_TABLE} m1 LEFT JOIN {MFT_TABLE} m2 
-        ON m1.ParentEntryNumber = m2.EntryNumber AND m1.ParentSequenceNumber = m2.SequenceNumber 
-        WHERE m1.InUse = "True"
-        UNION ALL
-        SELECT m1.EntryNumber || '-' || (m1.SequenceNumber - 1) as Entry, m1.FileName,
-        m1.ParentEntryNumber || '-' || m1.ParentSequenceNumber as ParentEntry, 
-        ifnull(m2.FileName, '') as ParentName
-        FROM {MFT_TABLE} m1 LEFT JOIN {MFT_TABLE} m2 
-        ON m1.ParentEntryNumber = m2.EntryNumber AND m1.ParentSequenceNumber = m2.SequenceNumber 
-        WHERE m1.InUse = "False" and m2.Inuse = "True"
-		UNION ALL
-		SELECT m1.EntryNumber || '-' || (m1.SequenceNumber - 1) as Entry, m1.FileName,
-        m1.ParentEntryNumber || '-' || m1.ParentSequenceNumber as ParentEntry, 
-        ifnull(m2.FileName, '') as ParentName
-        FROM {MFT_TABLE} m1 LEFT JOIN {MFT_TABLE} m2 
-        ON m1.ParentEntryNumber = m2.EntryNumber AND m1.ParentSequenceNumber = (m2.SequenceNumber  - 1)
-        WHERE m1.InUse = "False"  and m2.Inuse = "False"
+        SELECT EntryNumber, SequenceNumber, InUse, ParentEntryNumber, 
+        ParentSequenceNumber, FileName
+        FROM {MFT_TABLE}
     '''
-    # The above query produces multiple output for entry when ADS are encountered:
-    # EG:   10-10	$UpCase	        5-5	    .
-    #       10-10	$UpCase:$Info	5-5	    .
+    if history_table_name and row_filter and row_filter.from_ticks is not None:
+        # The walk stops early, so the history would not go back to the start of the journal
+        print(f'[.] Not writing the {history_table_name} table, as the rewind stops at the start of the time window')
+        history_table_name = ''
+    state = None
+    try:
+        # Also used for the progress ETA
+        row_count = db.execute(f'SELECT COUNT(*) FROM {usn_table_name}').fetchone()[0]
+        if checkpoint_minutes or resume:
+            state_path = checkpoint_path(sqlite_db_path)
+            settings = checkpoint_settings(db, usn_table_name, row_count, out_csv_path, out_table_name, 
+                                           history_table_name, row_filter, normalize_paths)
+            if resume:
+                state = load_checkpoint(state_path, settings)
+                data_table_name = out_table_name + NORMALIZED_SUFFIX if normalize_paths else out_table_name
+                if state and not outputs_cover(state, db, out_csv_path, data_table_name):
+                    print('[!] The output is missing rows written before the checkpoint, '
+                          'starting the rewind from the beginning')
+                    state = None
+            else:
+                remove_checkpoint(state_path) # of an earlier run, its output is about to be replaced
+    except sqlite3.Error as ex:
+        print(f"[!] Failed to read {usn_table_name}. Exception was " + str(ex))
+        db.close()
+        return False
+
+    db.row_factory = None
+    parent_lookup = make_parent_lookup(os.path.dirname(os.path.abspath(sqlite_db_path)), lookup_memory_mb)
     try:
         mft_query = query.format(MFT_TABLE=mft_table_name)
-        results = db.execute(mft_query)
+        with metrics.phase('lookup') as phase:
+            if state:
+                print(f'[.] Resuming from the checkpoint, {state["input_rows"]} of {row_count} journal rows were done')
+                rewinder = restore_rewinder(state, row_filter, metrics.unknown_paths)
+                parent_lookup = rewinder.parent_lookup
+            else:
+                rewinder = Rewinder.from_mft_records(db.execute(mft_query), bool(history_table_name), row_filter, 
+                                                     metrics.unknown_paths, parent_lookup=parent_lookup)
+            phase['rows'] = len(rewinder.parent_lookup)
     except sqlite3.Error as ex:
         print(f"[!] Failed query. Exception was " + str(ex))
         print(f"[!] Query was {mft_query}")
+        parent_lookup.close()
         db.close()
         return False
-    
-    parent_lookup = {} # { Entry : (EntryName, ParentEntry, ParentName), .. }
-
-    for result in results:
-        # Skip ADS entries — their names contain ':' (e.g. "$UpCase:$Info")
-        # and would overwrite the real filename for the same Entry key.
-        if ':' in result['FileName']:
-            continue
-        parent_lookup[result['Entry']] = (result['FileName'], result['ParentEntry'], result['ParentName'])
 
     query = '''
-        SELECT EntryNumber, ParentEntryNumber, Name, ParentPath,
-        UpdateReasons, UpdateTimestamp, ParentSequenceNumber, SequenceNumber, 
-        FileAttributes, Extension, UpdateSequenceNumber, OffsetToData, SourceFile,
-        EntryNumber||'-'||SequenceNumber as Entry, 
-        ParentEntryNumber||'-'||ParentSequenceNumber as ParentEntry
+        SELECT {USN_COLUMNS}
         FROM {USNJRNL_TABLE} 
-        ORDER BY UpdateTimestamp DESC, UpdateSequenceNumber DESC
+        ORDER BY {USN_ORDER}
     '''
+    try:
+        usn_query = query.format(USNJRNL_TABLE=usn_table_name, USN_COLUMNS=', '.join(USN_FIELDS), USN_ORDER=USN_ORDER)
+        rows_done = state['input_rows'] if state else 0
+        usn_cursor = None
+        shard_workers, shard_size = 1, 0
+        if num_workers > 1 and row_count > MIN_SHARD_ROWS and not lookup_memory_mb and not checkpoint_minutes and not state:
+            shard_workers, shard_size = plan_shards(row_count, num_workers, parent_lookup, memory_limit_mb)
+            if shard_workers < num_workers:
+                print(f'[.] The shards of {num_workers} processes would not fit in {memory_limit_mb} MB '
+                      f'(--memory_limit), rewinding with ' + 
+                      (f'{shard_workers} processes' if shard_workers > 1 else 'one process'))
+        if shard_workers > 1:
+            # Paths are resolved by worker processes, a shard each
+            num_shards = (row_count + shard_size - 1) // shard_size
+            print(f'[.] Rewinding in {num_shards} shards of {shard_size} rows with {shard_workers} processes')
+            batches = sharded_rewind_batches(db, sqlite_db_path, usn_table_name, rewinder, shard_workers, shard_size)
+            resolve = lambda rows: rows
+        elif state:
+            # From the last row done, which must be where the checkpoint left off
+            usn_cursor = db.execute(usn_query + ' LIMIT -1 OFFSET ?', (rows_done - 1,))
+            last_row = usn_cursor.fetchone()
+            if last_row is None or (last_row[TIMESTAMP_INDEX], last_row[USN_INDEX]) != tuple(state['position']):
+                print(f'[!] The {usn_table_name} table does not match the checkpoint, rerun without --resume')
+                parent_lookup.close()
+                db.close()
+                return False
+            batches = cursor_batches(usn_cursor)
+            resolve = rewinder.rewind
+        else:
+            usn_cursor = db.execute(usn_query)
+            batches = cursor_batches(usn_cursor)
+            resolve = rewinder.rewind
+    except sqlite3.Error as ex:
+        print(f"[!] Failed query. Exception was " + str(ex))
+        print(f"[!] Query was {usn_query}")
+        parent_lookup.close()
+        db.close()
+        return False
 
-    field_names = ('Name', 'Extension', 'EntryNumber', 'SequenceNumber', 'ParentEntryNumber', 
-                   'ParentSequenceNumber', 'ParentPath', 'UpdateSequenceNumber', 'UpdateTimestamp',
-                   'UpdateReasons', 'FileAttributes', 'OffsetToData', 'SourceFile')
-    with open(out_csv_path, 'w', encoding='utf8', newline='', buffering=50000) as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=field_names)
-        writer.writeheader()
-        items_to_write = []
-    
-        try:
-            db = sqlite3.connect(sqlite_db_path)
-            db.row_factory = sqlite3.Row
-        except:
-            print(f"[!] Failed to open db at {sqlite_db_path}")
-            return False
+    sinks = []
+    try:
+        sink_positions = state['sinks'] if state else {}
+        if out_table_name:
+            sinks.append(SqliteSink(sqlite_db_path, out_table_name, normalize_paths=normalize_paths,
+                                    resume_rows=sink_positions.get('SqliteSink')))
+        if out_csv_path:
+            sinks.append(CsvSink(out_csv_path, sink_positions.get('CsvSink')))
+        checkpointer = None
+        if checkpoint_minutes:
+            checkpointer = RewindCheckpointer(state_path, rewinder, settings, checkpoint_minutes * 60, state)
+        # Rows output are not known ahead when filtering, so no ETA then
+        progress = Progress('Rewind', None if row_filter else row_count - rows_done)
+        with metrics.phase('rewind') as phase, metrics.profile():
+            metrics.stage_stats = run_pipeline(batches, resolve, sinks, progress=progress, checkpoint=checkpointer)
+            phase['rows'] = progress.rows
+        if usn_cursor is not None:
+            # The walk stops early with a row_filter, leaving the SELECT unfinished
+            usn_cursor.close()
+        print_stage_stats(metrics.stage_stats)
+        metrics.unknown_paths.print_summary()
+        if rewinder.history:
+            with metrics.phase('history'):
+                write_path_history(db, rewinder.history.all_rows(), history_table_name)
+    except (sqlite3.Error, OSError, BrokenProcessPool) as ex:
+        print(f"[!] Failed to write rewind output. Exception was " + str(ex))
+        for sink in sinks:
+            sink.close()
+        parent_lookup.close()
+        db.close()
+        return False
+    parent_lookup.close()
+    if out_table_name:
         try:
-            usn_query = query.format(USNJRNL_TABLE=usn_table_name, MFT_TABLE=mft_table_name)
-            results = db.execute(usn_query)
+            db.commit()
+            db.execute('PRAGMA journal_mode=DELETE') # back to a single file db
         except sqlite3.Error as ex:
-            print(f"[!] Failed query. Exception was " + str(ex))
-            print(f"[!] Query was {usn_query}")
-            db.close()
-            return False
+            print(f'[!] Could not take the db out of WAL mode, it still works but has -wal and -shm files. '
+                   'Exception was ' + str(ex))
+    db.close()
+    success = not any(getattr(sink, 'error', None) for sink in sinks)
+    if success and (checkpoint_minutes or resume):
+        remove_checkpoint(state_path)
+    return success
+
+def get_shard_size(row_count, num_workers):
+    '''Rows per shard of the parallel rewind, for SHARDS_PER_WORKER shards per worker'''
+    shard_size = (row_count + num_workers * SHARDS_PER_WORKER - 1) // (num_workers * SHARDS_PER_WORKER)
+    return min(max(shard_size, MIN_SHARD_ROWS), MAX_SHARD_ROWS)
+
+def plan_shards(row_count, num_workers, parent_lookup, memory_limit_mb):
+    '''
+        Returns (workers, shard_size) for the parallel rewind, using fewer
+        than num_workers and smaller shards if needed so that the shards in
+        flight (workers + 1) fit in memory_limit_mb. Each one has a pickled
+        snapshot of parent_lookup here, an unpickled copy with a path cache
+        in its worker, and its rows. workers is 1 if even two do not fit.
+    '''
+    lookup_bytes = parent_lookup.memory_size()
+    for workers in range(num_workers, 1, -1):
+        rows_bytes = memory_limit_mb * 1024 * 1024 // (workers + 1) - 2 * lookup_bytes - parent_lookup.max_cache_bytes
+        shard_size = min(get_shard_size(row_count, workers), rows_bytes // SHARD_ROW_BYTES)
+        if shard_size >= MIN_SHARD_ROWS:
+            return workers, shard_size
+    return 1, 0
+
+def lookup_snapshots(db, usn_table_name, parent_lookup, shard_size=MIN_SHARD_ROWS, history=None, row_filter=None):
+    '''
+        Mutation only pass over the journal; replays just the lookup 
+        changes (see update_lookup), no paths are resolved. Generator, 
+        yields (shard_start, snapshot) for each shard of shard_size rows, 
+        where shard_start is the (UpdateTimestamp, UpdateSequenceNumber, rowid)
+        of the first row of the shard and snapshot is parent_lookup, pickled,
+        as it is just before that row. Lookup changes are recorded in
+        history if given. Stops at the first row older than the time window
+        of row_filter, if given.
+    '''
+    query = f'''
+        SELECT UpdateTimestamp, UpdateSequenceNumber, rowid, Name, EntryNumber, 
+        SequenceNumber, ParentEntryNumber, ParentSequenceNumber, UpdateReasons
+        FROM {usn_table_name}
+        ORDER BY {USN_ORDER}
+    '''
+    index = 0
+    for rows in cursor_batches(db.execute(query)):
+        # Reasons are decoded a batch at a time, only the mask is needed here
+        decoded_reasons = decode_reasons_batch([row[8] for row in rows])
+        for (ts, update_seq_number, rowid, name, entry_num, seq_num, parent_entry_num, parent_seq_num, _), \
+                (reason_mask, _) in zip(rows, decoded_reasons):
+            if row_filter and row_filter.is_older(ts):
+                return
+            if index % shard_size == 0:
+                yield (ts, update_seq_number, rowid), pickle.dumps(parent_lookup, pickle.HIGHEST_PROTOCOL)
+            index += 1
+            entry, parent_entry = row_keys(entry_num, seq_num, parent_entry_num, parent_seq_num)
+            update_lookup(parent_lookup, entry, parent_entry, name, reason_mask, update_seq_number, history)
+
+def rewind_shard(sqlite_db_path, usn_table_name, shard_start, num_rows, snapshot, row_filter=None):
+    '''
+        Runs in a worker process. Rewinds num_rows journal rows starting 
+        at shard_start, using the pickled lookup snapshot taken just before
+        it. Returns the rows (OUTPUT_FIELDS order, selected by row_filter
+        if given) as a list, and the UnknownPathStats of the shard.
+    '''
+    rewinder = Rewinder(pickle.loads(snapshot), row_filter=row_filter)
+    query = f'''
+        SELECT {', '.join(USN_FIELDS)}
+        FROM {usn_table_name}
+        WHERE (UpdateTimestamp, UpdateSequenceNumber, rowid) <= (?, ?, ?)
+        ORDER BY {USN_ORDER}
+        LIMIT ?
+    '''
+    db = sqlite3.connect(sqlite_db_path)
+    try:
+        usn_rows = db.execute(query, (*shard_start, num_rows)).fetchall()
+    finally:
+        db.close()
+    return list(rewinder.rewind(usn_rows)), rewinder.unknown_paths
 
-        last_item = {}
-        for result in results:
-            name = result['Name']
-            entry_num = int(result['EntryNumber'])
-            parent_entry_num = int(result['ParentEntryNumber'])
-            ts = result['UpdateTimestamp']
-            reasons = result['UpdateReasons']
-            attributes = result['FileAttributes']
-            extension = result['Extension']
-            seq_num = result['SequenceNumber']
-            parent_seq_num = result['ParentSequenceNumber']
-            update_seq_number = result['UpdateSequenceNumber']
-            off_to_data = result['OffsetToData']
-            source_file = result['SourceFile']
-
-            entry = result['Entry']
-            parent_entry = result['ParentEntry']
-            path_changed = False
-
-            reasons = clean_reasons_string(reasons)
-
-            if "RenameOldName" in reasons:
-                # Replace entry in lookup dict, need parent name for this
-                parent_name = parent_lookup.get(parent_entry, ('','',''))[0]
-                # Replace with new parent entry & parent name
-                parent_lookup[entry] = name, parent_entry, parent_name
-                path_changed = True
-
-            elif "FileDelete" in reasons:
-                # Check if it currently exits. If not, add to parent_lookup
-                if entry not in parent_lookup:
-                    # try to lookup parent name
-                    p_name = parent_lookup.get(parent_entry, ('','',''))[0]
-                    parent_lookup[entry] = (name, parent_entry, p_name)
-
-            if parent_entry == "5-5":
-                path_prefix = '.' # nothing to do
-
-            # see if prev computed full path
-            elif last_item and path_changed == False and \
-                    last_item['timestamp'] == ts and \
-                    last_item['entry'] == entry and \
-                    last_item['parent_entry'] == parent_entry:
-                path_prefix = last_item['path_prefix']
-            
-            elif parent_entry in parent_lookup:
-                parent_file_name, _, _ = parent_lookup[parent_entry]
-                path_prefix = get_full_path(parent_entry, parent_lookup, parent_file_name)
-            else:
-                # unknown
-                path_prefix = "<UNKNOWN>"
-                print(f'[!] Error: Encountered an UNKNOWN path, report this to the developer! Item update_seq_number={update_seq_number}')
-
-            #fullpath = path_prefix + '\\' + name
-
-            item = {'Name': name,
-                    'Extension': extension,
-                    'EntryNumber': entry_num,
-                    'SequenceNumber': seq_num, 
-                    'ParentEntryNumber': parent_entry_num, 
-                    'ParentSequenceNumber': parent_seq_num,
-                    'ParentPath': path_prefix,
-                    'UpdateSequenceNumber': update_seq_number,
-                    'UpdateTimestamp': ts,
-                    'UpdateReasons': reasons,
-                    'FileAttributes': attributes,
-                    'OffsetToData': off_to_data,
-                    'SourceFile': source_file
-                    }
-            items_to_write.append(item)
-
-            last_item['entry'] = entry
-            last_item['parent_entry'] = parent_entry
-            last_item['timestamp'] = ts
-            last_item['path_prefix'] = path_prefix
-
-            if len(items_to_write) >= 50000:
-                writer.writerows(items_to_write)
-                items_to_write = []
-        
-        if items_to_write:
-            writer.writerows(items_to_write)
+def sharded_rewind_batches(db, sqlite_db_path, usn_table_name, rewinder, num_workers, shard_size=MIN_SHARD_ROWS):
+    '''
+        Parallel version of the rewind. The journal is split into shards of
+        shard_size rows (in rewind order, see get_shard_size()), each resolved
+        by a worker process starting from a snapshot of the lookup taken by
+        lookup_snapshots().
+        As only renames and deletes change the lookup, the snapshot pass is
+        cheap. Generator, yields the list of output rows of each shard, in 
+        order, so the output is the same as the sequential rewind. Up to 
+        num_workers + 1 shards are in flight at a time. The lookup, history,
+        row filter and unknown path counts are those of rewinder (a Rewinder).
+    '''
+    def shard_rows(future):
+        rows, shard_unknown_paths = future.result()
+        rewinder.unknown_paths.merge(shard_unknown_paths)
+        return rows
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        pending = collections.deque()
+        for shard_start, snapshot in lookup_snapshots(db, usn_table_name, rewinder.parent_lookup, shard_size, 
+                                                      rewinder.history, rewinder.row_filter):
+            pending.append(executor.submit(rewind_shard, sqlite_db_path, usn_table_name, 
+                                           shard_start, shard_size, snapshot, rewinder.row_filter))
+            if len(pending) > num_workers:
+                yield shard_rows(pending.popleft())
+        while pending:
+            yield shard_rows(pending.popleft())
+
+def create_journal_rewind_csv_from_csv(mft_csv_path, usnjrnl_csv_path, out_csv_path, temp_folder, memory_budget_mb=512,
+                                       num_workers=1, row_filter=None, metrics=None, lookup_memory_mb=0):
+    '''
+        Streaming version of create_journal_rewind_csv that reads the MFTECmd
+        csv files directly and does not need an SQLite database. The USN
+        rows are sorted in memory, or with an external merge sort in 
+        temp_folder if they exceed memory_budget_mb. The csv files are
+        parsed with num_workers processes. Rows are selected by row_filter
+        if given. Timings, progress and unknown path counts go in metrics 
+        (a RunMetrics) if given. If lookup_memory_mb is set, the lookup is
+        kept on disk in temp_folder (see SpillingParentLookup).
+    '''
+    if metrics is None:
+        metrics = RunMetrics()
+    parent_lookup = make_parent_lookup(temp_folder, lookup_memory_mb)
+    try:
+        with metrics.phase('lookup') as phase:
+            # read_mft_csv() already converts the values, as mft_records() would
+            rewinder = Rewinder(build_parent_lookup(read_mft_csv(mft_csv_path, num_workers), parent_lookup), 
+                                row_filter=row_filter, unknown_paths=metrics.unknown_paths)
+            phase['rows'] = len(rewinder.parent_lookup)
+        # The USN row count is not known until the csv is sorted, so no ETA
+        progress = Progress('Rewind')
+        with metrics.phase('rewind') as phase, metrics.profile():
+            metrics.stage_stats = run_pipeline(
+                batched(sort_usn_csv(usnjrnl_csv_path, temp_folder, memory_budget_mb, num_workers)),
+                rewinder.rewind, [CsvSink(out_csv_path)], progress=progress)
+            phase['rows'] = progress.rows
+        print_stage_stats(metrics.stage_stats)
+        metrics.unknown_paths.print_summary()
+    except (ValueError, csv.Error, OSError, sqlite3.Error) as ex:
+        print(f"[!] Failed to process csv. Exception was " + str(ex))
+        return False
+    finally:
+        parent_lookup.close()
+    return True
+
+def make_parent_lookup(temp_folder, lookup_memory_mb=0):
+    '''A SpillingParentLookup in temp_folder if lookup_memory_mb is set, else an (in memory) ParentLookup'''
+    if lookup_memory_mb:
+        print(f'[.] Keeping the parent lookup on disk, with {lookup_memory_mb} MB of memory for its cache')
+        return SpillingParentLookup(temp_folder, lookup_memory_mb)
+    return ParentLookup()
+
+def query_main(argv):
+    '''The 'query' subcommand, looks up paths in the PathHistory table of a rewind database'''
+    parser = argparse.ArgumentParser(prog='usnjrnl_rewind.py query', 
+                description=f'USN full path builder v{version} - point in time path query',
+                epilog='Needs an NTFS.sqlite with a PathHistory table, as created by the rewind',
+                formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-d', '--db', help='NTFS.sqlite created by the rewind (required)', required=True)
+    parser.add_argument('-e', '--entry', type=int, help='EntryNumber (required)', required=True)
+    parser.add_argument('-s', '--seq', type=int, help='SequenceNumber (required)', required=True)
+    when = parser.add_mutually_exclusive_group(required=True)
+    when.add_argument('--usn', type=int, help='Get the path as it was at this UpdateSequenceNumber')
+    when.add_argument('--time', help='Get the path as it was at this time, eg. "2024-03-01 10:20:30"\n(UTC, as in the journal)')
+    args = parser.parse_args(argv)
 
+    try:
+        ticks = parse_timestamp(args.time) if args.time is not None else None
+    except ValueError as ex:
+        print(f'[!] Error: {ex}')
+        return
+
+    if not os.path.exists(args.db):
+        print(f'[!] Error: Database not found at {args.db}')
+        return
+    db = sqlite3.connect(args.db)
+    try:
+        if not table_exists(db, PATH_HISTORY_TABLE):
+            print(f'[!] Error: No {PATH_HISTORY_TABLE} table in {args.db}, rerun the rewind to create it')
+            return
+        key = make_key(args.entry, args.seq)
+        if args.usn is not None:
+            path = full_path_at_usn(db, key, args.usn)
+            when = f'USN {args.usn}'
+        else:
+            path = full_path_at_time(db, key, ticks)
+            when = args.time
+        if path is None:
+            print(f'[!] Entry {args.entry}-{args.seq} is not known at {when}')
+        else:
+            print(path)
+    except sqlite3.Error as ex:
+        print(f'[!] Failed query. Exception was ' + str(ex))
+    finally:
         db.close()
-        return True
+
+def add_filter_arguments(parser):
+    parser.add_argument('--from', dest='from_time', metavar='FROM', 
+                        help='Only output journal rows at or after this time, eg. "2024-03-01 10:00:00"')
+    parser.add_argument('--to', dest='to_time', metavar='TO', 
+                        help='Only output journal rows at or before this time')
+    parser.add_argument('--path', default='', 
+                        help='Only output journal rows for items in (or below) this folder,\neg. "\\Users\\john\\AppData" (not case sensitive)')
+
+def get_row_filter(args):
+    '''RewindFilter from the --from, --to and --path arguments, raises ValueError if they are not valid'''
+    from_ticks = parse_timestamp(args.from_time) if args.from_time else None
+    to_ticks = parse_timestamp(args.to_time) if args.to_time else None
+    if from_ticks is not None and to_ticks is not None and from_ticks > to_ticks:
+        raise ValueError('--from time is after the --to time')
+    return RewindFilter(from_ticks, to_ticks, normalize_path_prefix(args.path))
+
+def batch_main(argv):
+    '''The 'batch' subcommand, rewinds many volumes in a process pool (see batch_rewind)'''
+    memory_mb = total_memory_mb()
+    default_memory_limit = memory_mb * 3 // 4 if memory_mb else 4096
+    parser = argparse.ArgumentParser(prog='usnjrnl_rewind.py batch', 
+                description=f'USN full path builder v{version} - rewind many volumes',
+                epilog='A manifest is a csv with the columns name, mft, usn (and optionally output).\n'
+                       'Each volume\'s output goes in a folder named after it in output_path.',
+                formatter_class=argparse.RawTextHelpFormatter)
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--manifest', help='csv listing the volumes to rewind')
+    inputs.add_argument('--input_folder', '--input-folder', 
+                        help='Folder with a sub folder for each volume, holding its\n$MFT and $J files (MFTECmd csv or raw)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, 
+                        help='Most volumes to rewind at once (default is the number of CPUs)')
+    parser.add_argument('--memory_limit', '--memory-limit', type=int, default=default_memory_limit, 
+                        help=f'Memory (MB) the running volumes may use, by an estimate from\ntheir input sizes (default {default_memory_limit}, 3/4 of RAM)')
+    parser.add_argument('--workers', type=int, default=1, 
+                        help='Number of processes used by each volume\'s rewind (default 1)')
+    parser.add_argument('--no_db', '--no-db', action='store_true', help='As for a single volume')
+    parser.add_argument('--no_csv', action='store_true', help='As for a single volume')
+    parser.add_argument('--memory_budget', type=int, default=512, help='As for a single volume (default 512)')
+    parser.add_argument('--force_reimport', '--force-reimport', action='store_true', help='As for a single volume')
+    parser.add_argument('--normalize_paths', '--normalize-paths', action='store_true', help='As for a single volume')
+    parser.add_argument('--lookup_memory', '--lookup-memory', type=int, default=0, help='As for a single volume')
+    parser.add_argument('--checkpoint_minutes', '--checkpoint-minutes', type=float, default=0, 
+                        help='As for a single volume')
+    parser.add_argument('--resume', action='store_true', 
+                        help='As for a single volume, rerun a batch with this to carry on\nwhere its volumes got to')
+    add_filter_arguments(parser)
+    parser.add_argument('output_path', help='Output folder path (will create if non-existent)')
+    args = parser.parse_args(argv)
+
+    try:
+        row_filter = get_row_filter(args)
+        jobs = read_manifest(args.manifest) if args.manifest else find_volumes(args.input_folder)
+    except (ValueError, OSError) as ex:
+        print(f'[!] Error: {ex}')
+        return
+    if args.no_db and (args.no_csv or args.normalize_paths or args.checkpoint_minutes or args.resume):
+        print('[!] Error: --no_db can not be used with --no_csv, --normalize_paths, --checkpoint_minutes or --resume')
+        return
+    if args.resume and args.force_reimport:
+        print('[!] Error: --resume needs the existing database, it can not be used with --force_reimport')
+        return
+    if args.lookup_memory and (args.checkpoint_minutes or args.resume):
+        print('[!] Error: --checkpoint_minutes and --resume can not be used with --lookup_memory')
+        return
+    if not jobs:
+        print('[!] Error: No volumes found to rewind')
+        return
+
+    names = set()
+    for job in jobs:
+        if not (os.path.exists(job.mft_path) and os.path.exists(job.usn_path)):
+            print(f'[!] Error: Input file(s) of {job.name} not found ({job.mft_path}, {job.usn_path})')
+            return
+        job.name = safe_name(job.name)
+        while job.name in names:
+            job.name += '_'
+        names.add(job.name)
+        job.output_path = job.output_path or os.path.join(args.output_path, job.name)
+        job.estimated_mb = estimate_memory_mb(job.mft_path, job.usn_path, args.workers, args.no_db, args.memory_budget,
+                                              args.lookup_memory)
+    os.makedirs(args.output_path, exist_ok=True)
+
+    options = { 'no_db' : args.no_db, 'memory_budget_mb' : args.memory_budget, 'no_csv' : args.no_csv, 
+                'num_workers' : args.workers, 'force_reimport' : args.force_reimport, 
+                'row_filter' : row_filter if row_filter else None, 'normalize_paths' : args.normalize_paths,
+                'lookup_memory_mb' : args.lookup_memory, 'checkpoint_minutes' : args.checkpoint_minutes, 
+                'resume' : args.resume }
+    max_jobs = max(1, min(args.jobs, len(jobs)))
+    # Each running volume's parallel rewind gets its share
+    options['memory_limit_mb'] = max(1, args.memory_limit // max_jobs)
+    print(f'[.] Rewinding {len(jobs)} volumes, up to {max_jobs} at once in {args.memory_limit} MB')
+    start_time = time.time()
+    results = run_batch(jobs, rewind, options, max_jobs, args.memory_limit)
+    print_batch_summary(results)
+    summary_path = os.path.join(args.output_path, SUMMARY_FILE_NAME)
+    summary = { 'version' : version, 'date' : time.strftime('%Y-%m-%d %H:%M:%S'), 'jobs' : max_jobs, 
+                'memory_limit_mb' : args.memory_limit, 'workers' : args.workers, 
+                'total_seconds' : round(time.time() - start_time, 3), 'volumes' : results }
+    try:
+        with open(summary_path, 'w', encoding='utf8') as f:
+            json.dump(summary, f, indent=2)
+        print(f'[.] Saved the batch summary here: {summary_path}')
+    except OSError as ex:
+        print(f'[!] Failed to save the batch summary to {summary_path}, error was', str(ex))
+    print(f'[.] Finished in total time: {get_time_taken_string(start_time, time.time())}')
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'query':
+        query_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+        return
+
+    memory_mb = total_memory_mb()
+    default_memory_limit = memory_mb // 2 if memory_mb else 4096
     usage = '''(c) 2024 Yogesh Khatri, CyberCX. \n\n
 This tool needs the output of Mftecmd for both USN and MFT 
-(no need to process both together when processing the USN in mftecmd)\n '''
+(no need to process both together when processing the USN in mftecmd)\n
+Use "usnjrnl_rewind.py query -h" to look up past paths in an existing database.
+Use "usnjrnl_rewind.py batch -h" to rewind many volumes in one run.\n '''
     parser = argparse.ArgumentParser(description=f'USN full path builder v{version}', epilog=usage, 
                 formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-m', '--mft_processed_csv_file', help='processed $MFT csv from MFTECMD (required)', required=True)
-    parser.add_argument('-u', '--usnjrnl_processed_csv_file', help='processed $Usnjrnl:$J csv from MFTECMD (required)', required=True)
+    parser.add_argument('-m', '--mft_processed_csv_file', help='processed $MFT csv from MFTECMD, or the raw $MFT file (required)', required=True)
+    parser.add_argument('-u', '--usnjrnl_processed_csv_file', help='processed $Usnjrnl:$J csv from MFTECMD, or the raw $J file (required)', required=True)
+    parser.add_argument('--no_db', '--no-db', action='store_true', 
+                        help='Stream the csv files directly to the output csv, no SQLite database is created')
+    parser.add_argument('--no_csv', action='store_true', 
+                        help='Do not write USNJRNL.fullPaths.csv, results only go in the database')
+    parser.add_argument('--memory_budget', type=int, default=512, 
+                        help='Memory (MB) to use for sorting USN data in --no_db mode\nbefore spilling to temp files (default 512)')
+    parser.add_argument('--lookup_memory', '--lookup-memory', type=int, default=0, 
+                        help='Keep the parent lookup on disk (in output_path), using about this much\nmemory (MB) for its cache, for MFTs too large for memory (default 0, off)')
+    parser.add_argument('--force_reimport', '--force-reimport', action='store_true', 
+                        help='Import the csv files again even if an existing NTFS.sqlite\nin output_path already has them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, 
+                        help='Number of processes used to parse the csv files and to rewind\nthe journal (default is the number of CPUs)')
+    parser.add_argument('--memory_limit', '--memory-limit', type=int, default=default_memory_limit, 
+                        help=f'Memory (MB) the parallel rewind may use for the lookup copies and rows of\nits shards, fewer --workers rewind if needed (default {default_memory_limit}, half of RAM)')
+    add_filter_arguments(parser)
+    parser.add_argument('--normalize_paths', '--normalize-paths', action='store_true', 
+                        help='Store each distinct ParentPath once in a ParentPaths table, USNJRNL_FullPaths\nis then a view (smaller database, the csv is not changed)')
+    parser.add_argument('--checkpoint_minutes', '--checkpoint-minutes', type=float, default=0, 
+                        help='Save a checkpoint of the rewind this often (minutes), so that if the run\nis stopped it can carry on with --resume (default 0, off). The rewind\nthen runs in one process.')
+    parser.add_argument('--resume', action='store_true', 
+                        help='Reuse the database in output_path and carry on the rewind from its\nlast checkpoint, if there is one')
+    parser.add_argument('--metrics_json', '--metrics-json', default='', 
+                        help='Save run metrics (phase times, rows/sec, memory, unknown paths) to this JSON file')
+    parser.add_argument('--profile', default='', 
+                        help='Profile the rewind loop with cProfile and save the stats to this file')
     parser.add_argument('output_path', help='Output folder path (will create if non-existent)')
     args = parser.parse_args()
 
+    try:
+        row_filter = get_row_filter(args)
+    except ValueError as ex:
+        print(f'[!] Error: {ex}')
+        return
+
     output_path = args.output_path
     usnjrnl_csv_path = args.usnjrnl_processed_csv_file
     mft_csv_path = args.mft_processed_csv_file
@@ -368,10 +875,29 @@ This tool needs the output of Mftecmd for both USN and MFT
         print('[!] Error: Need to specify processed $Usnjrnl:$J\'s csv path to proceed')
         return
     
+    if args.no_db and args.no_csv:
+        print('[!] Error: --no_db and --no_csv can not be used together, there would be no output')
+        return
+    if args.no_db and args.normalize_paths:
+        print('[!] Error: --normalize_paths needs the database, it can not be used with --no_db')
+        return
+    if args.no_db and (args.checkpoint_minutes or args.resume):
+        print('[!] Error: Checkpoints are kept with the database, --checkpoint_minutes and --resume\n'
+              '    can not be used with --no_db')
+        return
+    if args.resume and args.force_reimport:
+        print('[!] Error: --resume needs the existing database, it can not be used with --force_reimport')
+        return
+    if args.lookup_memory and (args.checkpoint_minutes or args.resume):
+        print('[!] Error: --checkpoint_minutes and --resume can not be used with --lookup_memory')
+        return
+
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    rewind(output_path, mft_csv_path, usnjrnl_csv_path)
+    rewind(output_path, mft_csv_path, usnjrnl_csv_path, args.no_db, args.memory_budget, args.no_csv, args.workers,
+           args.force_reimport, row_filter if row_filter else None, args.metrics_json, args.profile,
+           args.normalize_paths, args.lookup_memory, args.checkpoint_minutes, args.resume, args.memory_limit)
         
 if __name__ == "__main__":
     main()